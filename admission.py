@@ -0,0 +1,180 @@
+"""
+In-process admission control for expensive endpoints
+
+Requests to the endpoints listed in config.py pass three checks before
+they reach the view:
+    - a token bucket per client and endpoint (ADMISSION_RATE_LIMITS),
+      answered with 429 Too Many Requests when empty
+    - a cap on concurrent requests per endpoint (ADMISSION_CONCURRENCY_LIMITS),
+      answered with 503 Service Unavailable instead of queueing
+    - database latency: while the moving average of statement durations is
+      above ADMISSION_LATENCY_THRESHOLD, concurrency limited endpoints are shed
+      with 503 so the database can recover for all other pages. Only statements
+      of requests are averaged, background tasks & commands don't shed requests
+Views decorated with @admission.deferred call admission.check() themselves,
+e.g. after answering redirects that cost nothing.
+Clients are told apart by their address. Behind a reverse proxy set
+PROXY_COUNT (see app.py), otherwise all clients share the proxy's buckets.
+Counters of admitted and rejected requests are served as JSON under
+ADMISSION_STATS_URL, if set. The counters are not secret but tell how to
+overload the site, serve them only where the public can't reach them.
+"""
+
+import threading
+import time
+from collections import Counter, OrderedDict
+from flask import g, has_request_context, jsonify, request, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class TokenBucket(object):
+    """
+    Allows <rate> requests per second on average and bursts of up to <burst> requests
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class AdmissionController(object):
+    """
+    Flask extension rejecting requests early when a client or the database is overloaded
+    """
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+        self.semaphores = {}
+        self.counters = Counter()
+        self.deferred_endpoints = set()
+        self.latency = 0.0
+        self.latency_updated = time.monotonic()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ADMISSION_RATE_LIMITS', {})
+        app.config.setdefault('ADMISSION_CONCURRENCY_LIMITS', {})
+        app.config.setdefault('ADMISSION_LATENCY_THRESHOLD', 0.5)
+        app.config.setdefault('ADMISSION_LATENCY_HALF_LIFE', 5.0)
+        app.config.setdefault('ADMISSION_MAX_CLIENTS', 10000)
+        app.config.setdefault('ADMISSION_STATS_URL', None)
+        self.app = app
+        for endpoint, limit in app.config['ADMISSION_CONCURRENCY_LIMITS'].items():
+            self.semaphores[endpoint] = threading.BoundedSemaphore(limit)
+
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+        event.listen(Engine, 'handle_error', self._handle_error)
+        app.before_request(self.admit)
+        app.teardown_request(self.release)
+        if app.config['ADMISSION_STATS_URL']:
+            app.add_url_rule(app.config['ADMISSION_STATS_URL'], 'admission_stats', self.stats)
+
+    #  Database latency
+    #  ----------------------------------------------------------------
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # Statements outside of requests (tasks, commands) are not timed, None keeps the stack aligned
+        started = time.monotonic() if has_request_context() else None
+        conn.info.setdefault('admission_started', []).append(started)
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['admission_started'].pop()
+        if started is None:
+            return
+        duration = time.monotonic() - started
+        with self.lock:
+            self.latency = self.current_latency() * 0.8 + duration * 0.2
+            self.latency_updated = time.monotonic()
+
+    def _handle_error(self, context):
+        # Failed statements never reach after_cursor_execute
+        if context.connection is not None and context.connection.info.get('admission_started'):
+            context.connection.info['admission_started'].pop()
+
+    def current_latency(self):
+        '''Moving average of statement durations in seconds
+        It decays while no statements run, so shedding stops once the database had time to recover.
+        '''
+        idle = time.monotonic() - self.latency_updated
+        return self.latency * 0.5 ** (idle / self.app.config['ADMISSION_LATENCY_HALF_LIFE'])
+
+    #  Admission
+    #  ----------------------------------------------------------------
+
+    def deferred(self, view):
+        '''Decorator for views calling check() themselves, place it below @app.route'''
+        self.deferred_endpoints.add(view.__name__)
+        return view
+
+    def admit(self):
+        if request.endpoint in self.deferred_endpoints:
+            return None
+        return self.check()
+
+    def check(self):
+        '''Admits the current request, returns the rejection response or None'''
+        endpoint = request.endpoint
+        limit = self.app.config['ADMISSION_RATE_LIMITS'].get(endpoint)
+        semaphore = self.semaphores.get(endpoint)
+        if limit is None and semaphore is None:
+            return None
+
+        if limit is not None and not self._take_token(endpoint, *limit):
+            return self.reject(endpoint, 'rate_limited', 429, 'Too many requests, please slow down.')
+        if semaphore is not None:
+            if self.current_latency() > self.app.config['ADMISSION_LATENCY_THRESHOLD']:
+                return self.reject(endpoint, 'shed', 503, 'The site is busy, please try again shortly.')
+            if not semaphore.acquire(blocking=False):
+                return self.reject(endpoint, 'over_capacity', 503, 'The site is busy, please try again shortly.')
+            g.admission_semaphore = semaphore
+        self.count(endpoint, 'admitted')
+        return None
+
+    def release(self, exception=None):
+        semaphore = g.pop('admission_semaphore', None)
+        if semaphore is not None:
+            semaphore.release()
+
+    def _take_token(self, endpoint, rate, burst):
+        key = (request.remote_addr, endpoint)
+        with self.lock:
+            bucket = self.buckets.pop(key, None)
+            if bucket is None:
+                bucket = TokenBucket(rate, burst)
+                # Forget the least recently seen client
+                if len(self.buckets) >= self.app.config['ADMISSION_MAX_CLIENTS']:
+                    self.buckets.popitem(last=False)
+            self.buckets[key] = bucket
+            return bucket.take()
+
+    def reject(self, endpoint, reason, status, message):
+        self.count(endpoint, reason)
+        return Response(message, status=status, headers={'Retry-After': '1'}, mimetype='text/plain')
+
+    def count(self, endpoint, outcome):
+        with self.lock:
+            self.counters[(endpoint, outcome)] += 1
+
+    def stats(self):
+        '''Counters of admitted and rejected requests per endpoint'''
+        with self.lock:
+            counters = {}
+            for (endpoint, outcome), count in self.counters.items():
+                counters.setdefault(endpoint, {})[outcome] = count
+        return jsonify({
+            'db_latency': round(self.current_latency(), 4),
+            'endpoints': counters,
+        })
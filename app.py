@@ -3,17 +3,39 @@
 #----------------------------------------------------------------------------#
 
 import json
+import os
+import time
+from collections import OrderedDict, namedtuple
+import threading
+import click
+import numpy as np
 import dateutil.parser
 import babel
-from datetime import datetime
-from flask import Flask, render_template, request, Response, flash, redirect, url_for, jsonify
+from datetime import datetime, timedelta
+from flask import Flask, render_template, request, Response, flash, redirect, url_for, jsonify, abort, stream_with_context, make_response, g
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func, inspect
+from routing import RoutingSQLAlchemy
+from admission import AdmissionController
+from compression import CompressionMiddleware
+from profiler import RequestProfiler, sign_path
+from slowlog import SlowQueryLog
+from broadcast import LiveEvents
+from tasks import BackgroundTasks
+from sqlalchemy import func, event, DDL
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.dialects.postgresql import insert as pg_insert, array as pg_array
 import logging
 from logging import Formatter, FileHandler
 from flask_wtf import Form
 from forms import *
+from records import RecordType
+from catalog import CatalogSnapshot, last_change, read_changes
+from geo import Gazetteer, covering_cells, haversine, encode as encode_geohash
+from duplicates import MAX_CANDIDATES, area, blocking_keys, likely_duplicates
+from prerender import page_path, write_file, remove_file, rendered_ids, load_manifest, save_manifest, run_pool
+from export import FORMATS, get_writer, iter_batches, Throughput
 
 # Import local database URI from Config File
 from config import SQLALCHEMY_DATABASE_URI
@@ -27,48 +49,258 @@ from flask_migrate import Migrate
 app = Flask(__name__)
 moment = Moment(app)
 app.config.from_object('config')
-db = SQLAlchemy(app)
+# Reads of GET requests are routed to the read replicas configured in config.py
+db = RoutingSQLAlchemy(app)
 migrate = Migrate(app,db)
+# Rate limits & load shedding for the search endpoints, configured in config.py
+admission = AdmissionController(app)
+# Opt-in sampling profiler writing flamegraphs to PROFILE_DIR
+profiler = RequestProfiler(app)
+# Statements slower than SLOW_QUERY_THRESHOLD are logged with their query plan
+slow_queries = SlowQueryLog(app)
+# Server-Sent Events of new Shows, delivered to the clients of all server processes
+live_events = LiveEvents(app, db)
+# Work following writes, added to an outbox table & run by worker threads of every server process
+tasks = BackgroundTasks(app, db)
+# gzip/brotli compression of responses
+app.wsgi_app = CompressionMiddleware(app.wsgi_app,
+  minimum_size=app.config['COMPRESS_MIN_SIZE'], level=app.config['COMPRESS_LEVEL'])
+# Client addresses (e.g. the rate limits of admission.py) from the X-Forwarded-For of trusted proxies
+if app.config['PROXY_COUNT']:
+  app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_COUNT'])
 # TODO--Done: connect to a local postgresql database
 app.config['SQLALCHEMY_DATABASE_URI'] = SQLALCHEMY_DATABASE_URI
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 # TODO --Done Implement Show and Artist models, and complete all model relationships and properties, as a database migration.
 # Instead of creating a new Table, the documentation recommends to create a association table
+# On Postgres the table is range partitioned by month of start_time (see "flask partition-shows"),
+# so queries for upcoming Shows only scan the partitions of current and future months.
+# Deleting a Venue or Artist deletes its Shows in the same statement (ON DELETE CASCADE).
 Show = db.Table('Show', db.Model.metadata,
-    db.Column('Venue_id', db.Integer, db.ForeignKey('Venue.id')),
-    db.Column('Artist_id', db.Integer, db.ForeignKey('Artist.id')),
-    db.Column('start_time', db.DateTime))
+    db.Column('Venue_id', db.Integer, db.ForeignKey('Venue.id', ondelete='CASCADE'), index=True),
+    db.Column('Artist_id', db.Integer, db.ForeignKey('Artist.id', ondelete='CASCADE'), index=True),
+    db.Column('start_time', db.DateTime),
+    postgresql_partition_by='RANGE (start_time)')
+# "What's on next" of the homepage reads upcoming Shows in start_time order from this index
+db.Index('ix_Show_start_time', Show.c.start_time)
+# Shows outside of all monthly partitions
+event.listen(Show, 'after_create',
+    DDL('CREATE TABLE "Show_default" PARTITION OF "Show" DEFAULT').execute_if(dialect='postgresql'))
+
+# Old monthly partitions get moved from "Show" to "Show_archive"
+ShowArchive = db.Table('Show_archive', db.Model.metadata,
+    db.Column('Venue_id', db.Integer, db.ForeignKey('Venue.id', ondelete='CASCADE'), index=True),
+    db.Column('Artist_id', db.Integer, db.ForeignKey('Artist.id', ondelete='CASCADE'), index=True),
+    db.Column('start_time', db.DateTime),
+    postgresql_partition_by='RANGE (start_time)')
 
 
 #----------------------------------------------------------------------------#
 # Custom Functions.
 #----------------------------------------------------------------------------#
 
-def object_as_dict(obj):
-  '''Converts SQLALchemy Query Results to Dict
-  *Input: ORM Object
-  *Output: Single Object as Dict
-  Makes use of the SQLAlchemy inspection system (https://docs.sqlalchemy.org/en/13/core/inspection.html)
+def genres_list(genres):
+  '''Returns genres as list
+  Artist genres are stored as text in Postgres array notation, e.g. "{Jazz,Classical}"
+  '''
+  if genres is None:
+    return []
+  if isinstance(genres, str):
+    return [genre.strip('"') for genre in genres.strip('{}').split(',') if genre]
+  return list(genres)
+
+def similar_entities(model, kind, entity_id):
+  '''Returns the stored recommendations of a Venue or Artist, best first
+  * Input: Venue or Artist, 'venue' or 'artist', <int> id
+  * Output: list of rows with id, name, image_link & score
+  One query on the primary key of Recommendation, deleted entities are left out.
+  Used in following Views:
+    - /venues/<id>
+    - /artists/<id>
+  '''
+  return (db.session.query(model.id, model.name, model.image_link, Recommendation.score)
+    .join(Recommendation, Recommendation.similar_id == model.id)
+    .filter(Recommendation.kind == kind)
+    .filter(Recommendation.entity_id == entity_id)
+    .filter(model.deleted_at.is_(None))
+    .order_by(Recommendation.rank)
+    .all())
+
+def find_duplicates(model, kind, listing, name, city, state):
+  '''Venues or Artists of a city & state with a name similar to <name>
+  * Input: Venue or Artist, 'venue' or 'artist', RecordType with name, the new name, city & state
+  * Output: list of (score, record), most similar first
+  Only the MAX_CANDIDATES entities sharing most blocking keys with the name are read & scored,
+  however many entities there are.
+  Used in following Views:
+    - /venues/create
+    - /artists/create
+  '''
+  keys = blocking_keys(name)
+  if not keys:
+    return []
+  city, state = area(city, state)
+  table = DuplicateKey.__table__
+  shared = (db.select([table.c.entity_id, func.count().label('shared')])
+    .where(table.c.kind == kind)
+    .where(table.c.state == state)
+    .where(table.c.city == city)
+    .where(table.c.key.in_(keys))
+    .group_by(table.c.entity_id)
+    .order_by(func.count().desc(), table.c.entity_id)
+    .limit(MAX_CANDIDATES)
+    .alias('shared'))
+  candidates = listing.all(db.session, listing.select()
+    .where(model.id == shared.c.entity_id)
+    .where(model.deleted_at.is_(None)))
+  return likely_duplicates(name, candidates)
+
+def index_duplicate_keys(kind, entity_id, name, city, state):
+  '''Replaces the blocking keys of a Venue or Artist, run it in the transaction of the write
+  Used in following Views:
+    - /venues/create, /artists/create, editing a name, city or state (see update_entity)
+  '''
+  table = DuplicateKey.__table__
+  db.session.execute(table.delete().where(table.c.kind == kind).where(table.c.entity_id == entity_id))
+  city, state = area(city, state)
+  keys = blocking_keys(name)
+  if keys:
+    db.session.execute(table.insert(),
+      [{'kind': kind, 'entity_id': entity_id, 'key': key, 'city': city, 'state': state} for key in keys])
+
+def upcoming_show_counts(venue_ids, only=None):
+  '''Returns the number of upcoming Shows of every Venue
+  * Input: sorted numpy array of Venue ids, optionally the ids to count the Shows of
+  * Output: numpy array of the numbers, in the order of venue_ids (0 for Venues not counted)
+  One grouped query on the upcoming partitions of Show. Shows of soft deleted Artists are
+  not counted, like on the page of the Venue.
   Used in following Views:
     - /venues
   '''
-  return {c.key: getattr(obj, c.key)
-        for c in inspect(obj).mapper.column_attrs}
+  counts = np.zeros(len(venue_ids), dtype=np.int64)
+  if not len(venue_ids):
+    return counts
+  statement = (db.select([Show.c.Venue_id, func.count()])
+    .where(Show.c.Artist_id == Artist.id)
+    .where(Artist.deleted_at.is_(None))
+    .where(Show.c.start_time > datetime.now())
+    .group_by(Show.c.Venue_id))
+  if only is not None:
+    if not len(only):
+      return counts
+    statement = statement.where(Show.c.Venue_id.in_(only.tolist()))
+  rows = db.session.execute(statement).fetchall()
+  if rows:
+    ids, numbers = np.array(rows, dtype=np.int64).T
+    # Shows of Venues created after the snapshot was taken are left out
+    positions = np.minimum(np.searchsorted(venue_ids, ids), len(venue_ids) - 1)
+    found = venue_ids[positions] == ids
+    counts[positions[found]] = numbers[found]
+  return counts
+
+def bulk_insert(table, columns, rows):
+  '''Inserts many rows, BULK_INSERT_BATCH_SIZE per statement
+  * Input: Table, list of column names, list of tuples in the order of columns
+  '''
+  batch_size = app.config['BULK_INSERT_BATCH_SIZE']
+  for start in range(0, len(rows), batch_size):
+    db.session.execute(table.insert(), [dict(zip(columns, row)) for row in rows[start:start + batch_size]])
+
+def record_catalog_changes(changes):
+  '''Adds entries to the catalog change log, for changes the triggers don't see
+  * Input: list of (kind, entity_id), kind is 'venue' or 'artist'
+  Run it in the transaction of the change.
+  Used in following Views:
+    - /shows/create (the pages of the Venue & Artist list the new Shows)
+  '''
+  db.session.execute(CatalogChange.__table__.insert(),
+    [{'kind': kind, 'entity_id': entity_id} for kind, entity_id in changes])
 
-def get_dict_list_from_result(result):
-  '''Converts SQLALchemy Collections Results to Dict
-  * Input: sqlalchemy.util._collections.result
-  * Output: Result as list
-  Source: https://stackoverflow.com/questions/48232222/how-to-deal-with-sqlalchemy-util-collections-result
+def venue_location(city, state):
+  '''Location columns of a Venue in <city>, <state>
+  * Output: dict of latitude, longitude & geohash, all None for cities missing from the gazetteer
+  Venues are located at the center of their city, the gazetteer has no street addresses.
+  Used in following Views:
+    - /venues/create, editing the city or state of a Venue (see update_entity)
+  '''
+  location = get_gazetteer().locate(city, state)
+  if location is None:
+    return {'latitude': None, 'longitude': None, 'geohash': None}
+  return {'latitude': location[0], 'longitude': location[1], 'geohash': encode_geohash(*location)}
+
+@tasks.task
+def refresh_venue_stats(venue_id, start_times):
+  '''Recounts the months of a Venue in which Shows were added
+  * Input: <int> venue_id, start times of the new Shows as ISO 8601 strings
+  Only the Shows of this Venue in these months are read.
+  Background task, added in the transaction of the insert (see tasks.py).
+  Recounts of the same Venue run one after the other, the Venue row is locked first:
+  a recount waiting for the lock counts the Shows committed by the one before.
+  Used in following Views:
+    - /shows/create
+  '''
+  # FOR NO KEY UPDATE, inserts of Shows of the Venue (foreign key checks) don't wait for it
+  db.session.execute(db.select([Venue.id]).where(Venue.id == venue_id).with_for_update(key_share=True))
+  months = sorted({month_start(dateutil.parser.parse(start_time)) for start_time in start_times})
+  month = func.date_trunc('month', ShowHistory.c.start_time)
+  counts = (db.select([
+      ShowHistory.c.Venue_id,
+      db.cast(month, db.Date),
+      func.count(),
+      func.count(ShowHistory.c.Artist_id.distinct()),
+      func.count(db.cast(ShowHistory.c.start_time, db.Date).distinct())])
+    .where(ShowHistory.c.Venue_id == venue_id)
+    .where(ShowHistory.c.start_time >= months[0])
+    .where(ShowHistory.c.start_time < month_start(months[-1], 1))
+    .where(month.in_(months))
+    .group_by(ShowHistory.c.Venue_id, month))
+  columns = ['venue_id', 'month', 'show_count', 'distinct_artists', 'booked_days']
+  table = VenueMonthlyStats.__table__
+  upsert = pg_insert(table).from_select(columns, counts)
+  db.session.execute(upsert.on_conflict_do_update(
+    index_elements=[table.c.venue_id, table.c.month],
+    set_={column: upsert.excluded[column] for column in columns[2:]}))
+
+def stream_template(template_name, **context):
+  '''Renders a template as a streamed response
+  * Input: <str> template_name, template context
+  * Output: Response sending the page in chunks while it gets rendered
+  The browser can start painting the layout while rows are still being produced,
+  so pass rows as iterators (e.g. a query with yield_per) rather than lists.
   Used in following Views:
     - /venues
+    - /artists
+    - /shows
+  '''
+  app.update_template_context(context)
+  stream = app.jinja_env.get_template(template_name).stream(context)
+  # Send a chunk every STREAM_BUFFER_SIZE template outputs instead of every single one
+  stream.enable_buffering(app.config['STREAM_BUFFER_SIZE'])
+  return Response(stream_with_context(stream))
+
+def expand_show_series(start_time, interval_days=None, count=None, until=None):
+  '''Expands a recurring Show series into the start times of all its occurrences
+  * Input: <datetime> start_time, <int> interval_days, <int> count, <datetime> until
+  * Output: List of datetimes, starting with start_time
+  Without an interval the series consists of the single start_time. Otherwise it
+  repeats every interval_days until count occurrences exist or until is passed,
+  whichever comes first.
+  Raises ValueError if the series exceeds SHOW_SERIES_MAX_OCCURRENCES.
+  Used in following Views:
+    - /shows/create
   '''
-  list_dict = []
-  for i in result:
-      i_dict = i._asdict()
-      list_dict.append(i_dict)
-  return list_dict
+  if not interval_days:
+    return [start_time]
+  max_occurrences = app.config['SHOW_SERIES_MAX_OCCURRENCES']
+  occurrences = []
+  occurrence = start_time
+  while (count is None or len(occurrences) < count) and (until is None or occurrence <= until):
+    if len(occurrences) == max_occurrences:
+      raise ValueError('A series can have at most {} Shows.'.format(max_occurrences))
+    occurrences.append(occurrence)
+    occurrence += timedelta(days=interval_days)
+  return occurrences
 
 #----------------------------------------------------------------------------#
 # Models.
@@ -90,11 +322,31 @@ class Venue(db.Model):
     seeking_talent = db.Column(db.Boolean, nullable=False, default=False)
     seeking_description = db.Column(db.String(500))
     website_link = db.Column(db.String(120))
-    venues = db.relationship('Artist', secondary=Show, backref=db.backref('shows', lazy='joined'))
+    # Location of the city, geocoded from GAZETTEER_FILE (see venue_location), NULL if unknown.
+    # The geohash is compared byte by byte ("C" collation), the Venues of a grid cell are one index range.
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    geohash = db.Column(db.String(12, collation='C'))
+    # Soft deleted Venues are hidden at once, their Shows get purged in the background
+    deleted_at = db.Column(db.DateTime)
+    # Incremented by every update, guards against concurrent edits (see update_entity)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    venues = db.relationship('Artist', secondary=Show, passive_deletes=True,
+                             backref=db.backref('shows', lazy='joined', passive_deletes=True))
 
     def __repr__(self):
         return 'Venue Id:{} | Name: {}'.format(self.id, self.name)
-db.create_all()
+
+# Venues browsed by booking agents (see /venues/seeking). The partial indexes only hold
+# the few Venues seeking talent, so they stay small however large the catalog gets.
+venue_seeking = db.and_(Venue.seeking_talent, Venue.deleted_at.is_(None))
+db.Index('ix_venue_seeking', Venue.id, postgresql_where=venue_seeking)
+db.Index('ix_venue_seeking_location', Venue.state, func.lower(Venue.city), Venue.id,
+         postgresql_where=venue_seeking)
+db.Index('ix_venue_seeking_genres', Venue.genres, postgresql_using='gin',
+         postgresql_where=venue_seeking)
+# Grid index of /venues/near (see geo.py)
+db.Index('ix_venue_geohash', Venue.geohash, postgresql_where=Venue.deleted_at.is_(None))
 
 class Artist(db.Model):
     __tablename__ = 'Artist'
@@ -111,18 +363,317 @@ class Artist(db.Model):
     website_link = db.Column(db.String(120))
     seeking_venue = db.Column(db.Boolean, nullable=False, default=False)
     seeking_description = db.Column(db.String(500))
+    # Soft deleted Artists are hidden at once, their Shows get purged in the background
+    deleted_at = db.Column(db.DateTime)
+    # Incremented by every update, guards against concurrent edits (see update_entity)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
     def __repr__(self):
         return 'Artist Id:{} | Name: {}'.format(self.id, self.name)
+
+# Artist genres are text like '{Jazz,"Rock n Roll"}'. Casting text to an array can't be indexed,
+# this expression splitting the text can (use it for queries on the genres of Artists).
+artist_genres_array = func.string_to_array(func.translate(Artist.genres, '{}"', ''), ',',
+                                           type_=db.ARRAY(db.Text))
+# Artists browsed by booking agents (see /artists/seeking), indexed like the Venues above
+artist_seeking = db.and_(Artist.seeking_venue, Artist.deleted_at.is_(None))
+db.Index('ix_artist_seeking', Artist.id, postgresql_where=artist_seeking)
+db.Index('ix_artist_seeking_location', Artist.state, func.lower(Artist.city), Artist.id,
+         postgresql_where=artist_seeking)
+db.Index('ix_artist_seeking_genres', artist_genres_array, postgresql_using='gin',
+         postgresql_where=artist_seeking)
+
+class Recommendation(db.Model):
+    '''Similar Venues & Artists, computed by "flask recommend" (see recommend.py)
+    kind is 'venue' or 'artist', entity_id & similar_id are ids of that kind.
+    '''
+    __tablename__ = 'Recommendation'
+
+    kind = db.Column(db.String(6), primary_key=True)
+    entity_id = db.Column(db.Integer, primary_key=True)
+    rank = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+    similar_id = db.Column(db.Integer, nullable=False)
+    score = db.Column(db.REAL, nullable=False)
+
+    def __repr__(self):
+        return 'Recommendation {} {} #{}: {}'.format(self.kind, self.entity_id, self.rank, self.similar_id)
+
+class VenueMonthlyStats(db.Model):
+    '''Bookings of a Venue per month, kept up to date on Show inserts (see refresh_venue_stats)
+    Rebuilt from all Shows by "flask rollup-venue-stats".
+    '''
+    __tablename__ = 'VenueMonthlyStats'
+
+    venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id', ondelete='CASCADE'), primary_key=True)
+    month = db.Column(db.Date, primary_key=True)
+    show_count = db.Column(db.Integer, nullable=False)
+    distinct_artists = db.Column(db.Integer, nullable=False)
+    # Days of the month with at least one Show
+    booked_days = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return 'Venue Id:{} | Month: {:%Y-%m} | Shows: {}'.format(self.venue_id, self.month, self.show_count)
+
+class DuplicateKey(db.Model):
+    '''Blocking keys of the names of Venues & Artists, per city & state (see duplicates.py)
+    Written together with the Venue or Artist, rebuilt by "flask index-duplicates".
+    '''
+    __tablename__ = 'DuplicateKey'
+
+    kind = db.Column(db.String(6), primary_key=True)
+    entity_id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(10), primary_key=True)
+    # Lower case city, see duplicates.area
+    city = db.Column(db.String(120), nullable=False)
+    state = db.Column(db.String(120), nullable=False)
+
+    def __repr__(self):
+        return 'Duplicate key {} of {} {}'.format(self.key, self.kind, self.entity_id)
+
+# Candidates of a name: the entities of its city & state sharing one of its keys
+db.Index('ix_duplicate_key_lookup', DuplicateKey.kind, DuplicateKey.state, DuplicateKey.city,
+         DuplicateKey.key, DuplicateKey.entity_id)
+
+class CatalogChange(db.Model):
+    '''Inserts, updates & deletes of Venues & Artists, recorded by the triggers below
+    New Shows are recorded as changes of their Venue & Artist (see record_catalog_changes).
+    The increasing id is the change counter of the catalog snapshot (see catalog.py)
+    and of the static detail pages (see prerender.py).
+    Old entries are removed by "flask prune-catalog-changes".
+    '''
+    __tablename__ = 'CatalogChange'
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    kind = db.Column(db.String(6), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return 'Catalog change #{}: {} {}'.format(self.id, self.kind, self.entity_id)
+
+# Triggers record every write, including the bulk UPDATE & DELETE statements of the handlers.
+# They are created together with the table, which therefore has to come after Venue & Artist.
+CatalogChange.__table__.add_is_dependent_on(Venue.__table__)
+CatalogChange.__table__.add_is_dependent_on(Artist.__table__)
+event.listen(CatalogChange.__table__, 'after_create', DDL('''
+    CREATE OR REPLACE FUNCTION record_catalog_change() RETURNS trigger AS $$
+    BEGIN
+      INSERT INTO "CatalogChange" (kind, entity_id)
+      VALUES (TG_ARGV[0], CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END);
+      RETURN NULL;
+    END $$ LANGUAGE plpgsql''').execute_if(dialect='postgresql'))
+for table, kind in ((Venue.__table__, 'venue'), (Artist.__table__, 'artist')):
+  event.listen(CatalogChange.__table__, 'after_create', DDL(
+    'CREATE TRIGGER "{0}_catalog_change" AFTER INSERT OR UPDATE OR DELETE ON "{0}" '
+    'FOR EACH ROW EXECUTE PROCEDURE record_catalog_change(\'{1}\')'.format(table.name, kind))
+    .execute_if(dialect='postgresql'))
 db.create_all()
 
+# All Shows, including archived ones. Use it for queries on past Shows.
+ShowHistory = db.union_all(Show.select(), ShowArchive.select()).alias('show_history')
+
+
+#----------------------------------------------------------------------------#
+# Records.
+#----------------------------------------------------------------------------#
+
+# Columns of the list pages, selected as lightweight records (see records.py)
+# Venues & Artists as held by the catalog snapshot of /venues & /artists (see catalog.py)
+CATALOG_VENUE = RecordType('CatalogVenue', [
+  ('id', Venue.id),
+  ('name', Venue.name),
+  ('city', Venue.city),
+  ('state', Venue.state),
+  ('genres', Venue.genres),
+  ('latitude', Venue.latitude),
+  ('longitude', Venue.longitude),
+])
+CATALOG_ARTIST = RecordType('CatalogArtist', [
+  ('id', Artist.id),
+  ('name', Artist.name),
+  ('city', Artist.city),
+  ('state', Artist.state),
+  ('genres', artist_genres_array),
+])
+SHOW_LISTING = RecordType('ShowListing', [
+  ('venue_id', Venue.id),
+  ('venue_name', Venue.name),
+  ('artist_id', Artist.id),
+  ('artist_name', Artist.name),
+  ('artist_image_link', Artist.image_link),
+  ('start_time', ShowHistory.c.start_time),
+])
+SEEKING_VENUE_LISTING = RecordType('SeekingVenueListing', [
+  ('id', Venue.id),
+  ('name', Venue.name),
+  ('city', Venue.city),
+  ('state', Venue.state),
+  ('genres', Venue.genres),
+  ('image_link', Venue.image_link),
+  ('seeking_description', Venue.seeking_description),
+])
+SEEKING_ARTIST_LISTING = RecordType('SeekingArtistListing', [
+  ('id', Artist.id),
+  ('name', Artist.name),
+  ('city', Artist.city),
+  ('state', Artist.state),
+  ('genres', artist_genres_array),
+  ('image_link', Artist.image_link),
+  ('seeking_description', Artist.seeking_description),
+])
+HOME_FEED_SHOW = RecordType('HomeFeedShow', [
+  ('venue_id', Venue.id),
+  ('venue_name', Venue.name),
+  ('venue_city', Venue.city),
+  ('venue_state', Venue.state),
+  ('artist_id', Artist.id),
+  ('artist_name', Artist.name),
+  ('artist_image_link', Artist.image_link),
+  ('start_time', Show.c.start_time),
+])
+NEAR_VENUE = RecordType.for_model('NearVenue', Venue,
+  'id', 'name', 'city', 'state', 'image_link', 'latitude', 'longitude')
+DUPLICATE_VENUE = RecordType.for_model('DuplicateVenue', Venue, 'id', 'name', 'city', 'state')
+DUPLICATE_ARTIST = RecordType.for_model('DuplicateArtist', Artist, 'id', 'name', 'city', 'state')
+VENUE_SEARCH_RESULT = RecordType.for_model('VenueSearchResult', Venue, 'id', 'name')
+ARTIST_SEARCH_RESULT = RecordType.for_model('ArtistSearchResult', Artist, 'id', 'name')
+# Rows of /venues & /artists, built from the catalog snapshot
+VenueListing = namedtuple('VenueListing', ['id', 'name', 'num_shows'])
+ArtistListing = namedtuple('ArtistListing', ['id', 'name'])
+# Venues of one city in the list of /venues
+Area = namedtuple('Area', ['city', 'state', 'venues'])
+# Results of /venues/near, distance in km
+NearbyVenue = namedtuple('NearbyVenue', ['venue', 'distance'])
+
+
+#----------------------------------------------------------------------------#
+# Caches.
+#----------------------------------------------------------------------------#
+
+# id -> name of all Venues & Artists, used as choices of ShowForm.
+# Every handler creating, editing or deleting Venues or Artists invalidates it.
+# Other worker processes pick up changes after CATALOG_NAMES_TTL seconds.
+catalog_names = {}
+
+def get_catalog_names(model):
+  '''Returns the cached id -> name mapping of all Venues or Artists
+  * Input: Venue or Artist
+  * Output: dict of id -> name, ordered by name
+  '''
+  cached = catalog_names.get(model)
+  if cached is None or cached[0] < time.time():
+    names = dict(db.session.query(model.id, model.name)
+      .filter(model.deleted_at.is_(None))
+      .order_by(model.name))
+    cached = catalog_names[model] = (time.time() + app.config['CATALOG_NAMES_TTL'], names)
+  return cached[1]
+
+def invalidate_catalog_names(model):
+  catalog_names.pop(model, None)
+  # The change is in the change log already, the snapshot of this process picks it up at once
+  catalog.expire()
+
+# Columnar snapshot of all Venues & Artists for /venues & /artists (see catalog.py).
+# Every process checks the change log for writes at most every CATALOG_SNAPSHOT_CHECK_SECONDS.
+catalog = CatalogSnapshot(CatalogChange.__table__,
+  {'venue': (CATALOG_VENUE, Venue), 'artist': (CATALOG_ARTIST, Artist)},
+  check_seconds=app.config['CATALOG_SNAPSHOT_CHECK_SECONDS'],
+  max_age=app.config['CATALOG_SNAPSHOT_MAX_AGE'])
+
+# Next upcoming Shows of the homepage, site-wide (key None) and per city (lower case name).
+# Shared by all requests of the process for HOME_FEED_TTL seconds, at most HOME_FEED_MAX_CITIES cities.
+# home_feeds_lock guards the dicts only, a feed is loaded holding the lock of its key in home_feed_loads.
+home_feeds = OrderedDict()
+home_feed_loads = {}
+home_feeds_lock = threading.Lock()
+
+def is_venue_city(city):
+  '''True if a listed Venue of the catalog snapshot is located in <city> (lower case name)'''
+  table = catalog.get(db.session)['venue']
+  codes = table.pool.matching(city)
+  return len(codes) > 0 and bool(np.isin(table.cities, codes).any())
+
+def get_home_feed(city=None):
+  '''Returns the cached next HOME_FEED_SIZE upcoming Shows
+  * Input: <str> city, None for all cities
+  * Output: list of HomeFeedShow records, soonest first
+  While one thread reloads an expired feed, the others keep using the expired one,
+  so a busy homepage runs the query at most once per HOME_FEED_TTL.
+  Feeds of different cities load in parallel. Cities without Venues get an empty
+  feed without querying, they are not cached and don't push real cities out.
+  '''
+  key = city.strip().lower() if city else None
+  cached = home_feeds.get(key)
+  if cached is None and key is not None and not is_venue_city(key):
+    return []
+  if cached is None or cached[0] < time.time():
+    with home_feeds_lock:
+      lock = home_feed_loads.setdefault(key, threading.Lock())
+    if lock.acquire(blocking=cached is None):
+      try:
+        cached = home_feeds.get(key)
+        if cached is None or cached[0] < time.time():
+          cached = (time.time() + app.config['HOME_FEED_TTL'], load_home_feed(key))
+          with home_feeds_lock:
+            home_feeds[key] = cached
+            home_feeds.move_to_end(key)
+            while len(home_feeds) > app.config['HOME_FEED_MAX_CITIES'] + 1:
+              home_feeds.popitem(last=False)
+      finally:
+        with home_feeds_lock:
+          if home_feed_loads.get(key) is lock:
+            del home_feed_loads[key]
+        lock.release()
+  # Shows starting while the feed is cached drop out of it
+  now = datetime.now()
+  return [show for show in cached[1] if show.start_time > now]
+
+def load_home_feed(city):
+  '''Next HOME_FEED_SIZE upcoming Shows, in a city (lower case name) or everywhere
+  Reads ix_Show_start_time of the current & future partitions in order and stops after
+  HOME_FEED_SIZE Shows of listed Venues & Artists, however many Shows there are.
+  '''
+  statement = (HOME_FEED_SHOW.select()
+    .where(Show.c.Venue_id == Venue.id)
+    .where(Show.c.Artist_id == Artist.id)
+    .where(Show.c.start_time > datetime.now())
+    .where(Venue.deleted_at.is_(None))
+    .where(Artist.deleted_at.is_(None))
+    .order_by(Show.c.start_time)
+    .limit(app.config['HOME_FEED_SIZE']))
+  if city is not None:
+    statement = statement.where(func.lower(Venue.city) == city)
+  return HOME_FEED_SHOW.all(db.session, statement)
+
+def invalidate_home_feeds():
+  with home_feeds_lock:
+    home_feeds.clear()
+
+# City locations by gazetteer file (GAZETTEER_FILE), read once per process
+gazetteers = {}
+
+def get_gazetteer():
+  path = app.config['GAZETTEER_FILE']
+  if path not in gazetteers:
+    gazetteers[path] = Gazetteer(path)
+  return gazetteers[path]
+
+def populate_show_form(form):
+  '''Sets the Venue & Artist choices of a ShowForm from the cache
+  Used in following Views:
+    - /shows/create
+  '''
+  form.venue_id.choices = get_catalog_names(Venue)
+  form.artist_id.choices = get_catalog_names(Artist)
+  return form
+
 
 #----------------------------------------------------------------------------#
 # Filters.
 #----------------------------------------------------------------------------#
 
 def format_datetime(value, format='medium'):
-  date = dateutil.parser.parse(value)
+  date = dateutil.parser.parse(value) if isinstance(value, str) else value
   if format == 'full':
       format="EEEE MMMM, d, y 'at' h:mma"
   elif format == 'medium':
@@ -137,7 +688,16 @@ app.jinja_env.filters['datetime'] = format_datetime
 
 @app.route('/')
 def index():
-  return render_template('pages/home.html')
+  '''Homepage
+  * Input: query parameter city (optional)
+  Contains following features:
+    - "What's on next": the next upcoming Shows site-wide, or of one city
+  The Shows come from a cache shared by all requests (see get_home_feed).
+  Corresponding HTML:
+    - templates/pages/home.html
+  '''
+  city = request.args.get('city', '').strip() or None
+  return render_template('pages/home.html', upcoming_shows=get_home_feed(city), city=city)
 
 
 #  Venues
@@ -147,35 +707,87 @@ def index():
 def venues():
   # TODO--Done: replace with real venues data.
   #       num_shows should be aggregated based on number of upcoming shows per venue.
+  '''List all Venues grouped by area
+  * Input: query parameters city, state & genre, all optional (see CatalogFilterForm)
+  Contains following features:
+    - Venues grouped by City & State, with their number of upcoming Shows
+    - Browse an area or a genre by filtering on it
+  Venues are filtered, sorted & grouped on the catalog snapshot of this process, the
+  database is only asked for the numbers of upcoming Shows.
+  Corresponding HTML:
+    - templates/pages/venues.html
+  '''
+  # Step 1: Validate the filters
+  form = CatalogFilterForm(request.args)
+  if not form.validate():
+    return render_template('pages/venues.html', form=form, areas=[]), 400
+
+  # Step 2: Select the Venues matching the filters from the snapshot
+  table = catalog.get(db.session)['venue']
+  selected = table.where(form.city.data, form.state.data, form.genre.data)
+  filtered = any((form.city.data, form.state.data, form.genre.data))
+  num_shows = upcoming_show_counts(table.ids, table.ids[selected] if filtered else None)
+
+  # Step 3: Group the Venues by City & State
+  # Areas are produced one by one while the page streams to the browser
+  def areas():
+    for city, state, rows in table.areas(selected):
+      yield Area(city, state, list(map(VenueListing, table.ids[rows].tolist(), table.names[rows].tolist(),
+                                       num_shows[rows].tolist())))
+
+  return stream_template('pages/venues.html', form=form, areas=areas())
+
+@app.route('/venues/seeking')
+def seeking_venues():
+  '''Browse Venues seeking talent
+  * Input: query parameters city, state, genre & after (see browse_seeking)
+  Corresponding HTML:
+    - templates/pages/seeking.html
+  '''
+  return browse_seeking(Venue, venue_seeking, Venue.genres, SEEKING_VENUE_LISTING,
+    title='Venues seeking talent', url='/venues')
 
-  # Step 1: Get a list of dicts that contains City & State names
-  groupby_venues_result = (db.session.query(
-                Venue.city,
-                Venue.state
-                )
-        .group_by(
-                Venue.city,
-                Venue.state
-                )
-  )
-  data=get_dict_list_from_result(groupby_venues_result)
-
-  # Step 2: loop through areas and append Venue data
-  for area in data:
-    # This will add a new key to the dictionary called "venues".
-    # It gets filled with a list of venues that are in the same city-
-    area['venues'] = [object_as_dict(ven) for ven in Venue.query.filter_by(city = area['city']).all()]
-    # Step 3: Append num_shows
-    for ven in area['venues']:
-      # This will add a new subkey to the dictionarykey "venues" called "num_shows".
-      # It gets filled with a number that counts how many upcoming shows the venue has.
-      ven['num_shows'] = db.session.query(func.count(Show.c.Venue_id)).filter(Show.c.Venue_id == ven['id']).filter(Show.c.start_time > datetime.now()).all()[0][0]
-
-  return render_template('pages/venues.html', areas=data);
-
-
-
-@app.route('/venues/search', methods=['POST'])
+def browse_seeking(model, seeking, genres, listing, **page):
+  '''Lists Venues or Artists that are seeking, one page at a time
+  * Input: Venue or Artist, seeking condition, genres column, RecordType of the rows
+  Contains following features:
+    - Filter by city (case-insensitive), state & genre
+    - Pages of BROWSE_PAGE_SIZE entries ordered by id, the next page starts after the last id
+  All filters are served by the partial indexes on the seeking rows.
+  Used in following Views:
+    - /venues/seeking
+    - /artists/seeking
+  '''
+  # Step 1: Validate the filters
+  form = SeekingFilterForm(request.args)
+  if not form.validate():
+    return render_template('pages/seeking.html', form=form, results=[], next_page=None, **page), 400
+
+  # Step 2: Select one entry more than a page, to know if there is a next page
+  page_size = app.config['BROWSE_PAGE_SIZE']
+  statement = listing.select().where(seeking)
+  if form.state.data:
+    statement = statement.where(model.state == form.state.data)
+  if form.city.data:
+    statement = statement.where(func.lower(model.city) == form.city.data.strip().lower())
+  if form.genre.data:
+    # "@>": the genres contain the genre, which the GIN indexes can answer
+    statement = statement.where(genres.op('@>')(db.cast(pg_array([form.genre.data]), genres.type)))
+  if form.after.data:
+    statement = statement.where(model.id > form.after.data)
+  results = listing.all(db.session, statement.order_by(model.id).limit(page_size + 1))
+
+  # Step 3: Link to the next page with the same filters
+  next_page = None
+  if len(results) > page_size:
+    results = results[:page_size]
+    filters = {name: value for name, value in request.args.items() if name != 'after' and value}
+    next_page = url_for(request.endpoint, after=results[-1].id, **filters)
+
+  return render_template('pages/seeking.html', form=form, results=results, next_page=next_page, **page)
+
+@app.route('/venues/search', methods=['GET', 'POST'])
+@admission.deferred
 def search_venues():
   # TODO--Done: implement search on artists with partial string search. Ensure it is case-insensitive.
   # seach for Hop should return "The Musical Hop".
@@ -189,7 +801,7 @@ def search_venues():
     }]
   }"""
   '''Search for venues
-  * Input: None
+  * Input: query parameters search_term & fragment (see search_entities)
   Contains following features:
     - Search for venues with search term & get a list of results
     - See how many database entries are matched with the search term
@@ -197,26 +809,135 @@ def search_venues():
   Corresponding HTML:
     - templates/pages/search_venues.html
   '''
-  # get search term from request
-  search_term=request.form.get('search_term', '')
-
-  # use search term to count, how many occurance can be find in database
-  search_venues_count = (db.session.query(
-    func.count(Venue.id))
-    .filter(Venue.name.contains(search_term))
-    .all())
+  return search_entities(Venue, VENUE_SEARCH_RESULT, 'pages/search_venues.html')
 
-  # use search term to find all Venue records in database
-  search_venues_result = Venue.query.filter(Venue.name.contains(search_term)).all()
+def normalize_search_term(search_term):
+  '''Lowercases & collapses whitespace, so equal searches share one URL (and cache entry)'''
+  return ' '.join(search_term.split()).lower()
 
-  # create a well formatted response with above results
-  response={
-    "count": search_venues_count[0][0],
-    "data": search_venues_result
-  }
-
-
-  return render_template('pages/search_venues.html', results=response, search_term=search_term)
+def search_entities(model, listing, template):
+  '''Case-insensitive search for Venues or Artists by name
+  * Input: Venue or Artist, RecordType of the results, template of the full page
+  Contains following features:
+    - POST (old forms) redirects to the GET url of the search
+    - Query parameters are normalized, other urls redirect to the canonical one
+    - Only the search itself counts towards the rate limits (see admission.py), redirects are free
+    - ?fragment=html returns only the list of results, ?fragment=json the results as JSON
+    - Responses may be cached for SEARCH_CACHE_MAX_AGE seconds by browsers & proxies
+      and carry an ETag, a repeated request with If-None-Match gets a 304
+  Used in following Views:
+    - /venues/search
+    - /artists/search
+  '''
+  # Step 1: Redirect posted searches to the cacheable GET url
+  if request.method == 'POST':
+    search_term = normalize_search_term(request.form.get('search_term', ''))
+    return redirect(url_for(request.endpoint, search_term=search_term), 303)
+
+  # Step 2: Redirect to the canonical url of the search
+  search_term = normalize_search_term(request.args.get('search_term', ''))
+  fragment = request.args.get('fragment')
+  if fragment not in (None, 'html', 'json'):
+    abort(400)
+  canonical = url_for(request.endpoint, search_term=search_term, fragment=fragment)
+  # url_for includes the prefix the app is mounted under (SCRIPT_NAME), full_path doesn't
+  if request.script_root + request.full_path != canonical:
+    return redirect(canonical, 301)
+
+  # Step 3: Admission control, once the request is known to run the search
+  rejected = admission.check()
+  if rejected is not None:
+    return rejected
+
+  # Step 4: Find the matching records
+  results = listing.all(db.session, listing.select()
+    .where(func.lower(model.name).contains(search_term, autoescape=True))
+    .where(model.deleted_at.is_(None))
+    .order_by(model.name, model.id))
+
+  # Step 5: Render the page, the list of results or JSON
+  if fragment == 'json':
+    response = jsonify({'search_term': search_term, 'count': len(results), 'data': [result._asdict() for result in results]})
+  else:
+    response = make_response(render_template(
+      'fragments/search_results.html' if fragment else template,
+      results=results, search_term=search_term, url=url_for(request.endpoint.replace('search_', ''))))
+
+  # Step 6: Let browsers & proxies cache the response
+  response.cache_control.public = True
+  response.cache_control.max_age = app.config['SEARCH_CACHE_MAX_AGE']
+  response.add_etag()
+  return response.make_conditional(request)
+
+@app.route('/venues/near')
+def venues_near():
+  '''Venues near a location
+  * Input: query parameters lat, lon, radius (km) & k, see NearbyForm, and fragment
+  Contains following features:
+    - The Venues within radius of the location, nearest first
+    - Without radius, the k (default NEAR_DEFAULT_K) nearest Venues, however far
+    - "Use my location" fills in the location of the browser
+    - ?fragment=json returns the results as JSON
+  Corresponding HTML:
+    - templates/pages/venues_near.html
+  '''
+  # Step 1: Validate the location, show the empty form without one
+  form = NearbyForm(request.args)
+  fragment = request.args.get('fragment')
+  if fragment not in (None, 'json'):
+    abort(400)
+  if not request.args.get('lat') and not request.args.get('lon'):
+    return render_template('pages/venues_near.html', form=form, results=None)
+  if not form.validate():
+    if fragment == 'json':
+      return jsonify({'success': False, 'errors': form.errors}), 400
+    return render_template('pages/venues_near.html', form=form, results=None), 400
+
+  # Step 2: Find the Venues
+  results = near_venues(form.lat.data, form.lon.data, form.radius.data, form.k.data)
+  if fragment == 'json':
+    return jsonify({'count': len(results), 'data': [
+      dict(result.venue._asdict(), distance=round(result.distance, 3)) for result in results]})
+  return render_template('pages/venues_near.html', form=form, results=results)
+
+def near_venues(latitude, longitude, radius_km=None, k=None):
+  '''Venues within <radius_km> of a location and/or the <k> nearest ones
+  * Output: list of NearbyVenue (NearVenue record, distance in km), nearest first
+  The grid cells covering the search circle are read from ix_venue_geohash, only the Venues
+  of these cells are compared by distance. Without radius, the search starts at 1 km and grows
+  4 times at a time until it finds k Venues. Searches too large for the grid (see geo.covering_cells)
+  use the KD-tree of the catalog snapshot of this process instead.
+  Used in following Views:
+    - /venues/near
+  '''
+  limit = k or app.config['NEAR_MAX_RESULTS' if radius_km else 'NEAR_DEFAULT_K']
+  search_radius = radius_km or 1.0
+  while True:
+    cells = covering_cells(latitude, longitude, search_radius)
+    if cells is None:
+      return near_venues_in_process(latitude, longitude, radius_km, limit)
+    venues = NEAR_VENUE.all(db.session, NEAR_VENUE.select()
+      .where(Venue.deleted_at.is_(None))
+      .where(db.or_(*[db.and_(Venue.geohash >= cell, Venue.geohash < cell + '{') for cell in cells])))
+    distances = haversine(latitude, longitude,
+                          np.array([venue.latitude for venue in venues], dtype=np.float64),
+                          np.array([venue.longitude for venue in venues], dtype=np.float64))
+    nearest = [position for position in np.argsort(distances, kind='stable').tolist()
+               if distances[position] <= search_radius][:limit]
+    if radius_km or len(nearest) == limit:
+      return [NearbyVenue(venues[position], float(distances[position])) for position in nearest]
+    search_radius *= 4
+
+def near_venues_in_process(latitude, longitude, radius_km, limit):
+  '''near_venues() on the KD-tree of the catalog snapshot, for searches covering a large area'''
+  table = catalog.get(db.session)['venue']
+  ids, distances = table.kdtree().search(latitude, longitude, radius_km, limit)
+  ids, distances = ids[:limit].tolist(), distances[:limit].tolist()
+  venues = {venue.id: venue for venue in NEAR_VENUE.all(db.session, NEAR_VENUE.select()
+    .where(Venue.deleted_at.is_(None))
+    .where(Venue.id.in_(ids)))}
+  # Venues deleted since the snapshot was taken are left out
+  return [NearbyVenue(venues[venue_id], distance) for venue_id, distance in zip(ids, distances) if venue_id in venues]
 
 @app.route('/venues/<int:venue_id>')
 def show_venue(venue_id):
@@ -309,18 +1030,34 @@ def show_venue(venue_id):
     "upcoming_shows_count": 1,
  }
   data = list(filter(lambda d: d['id'] == venue_id, [data1, data2, data3]))[0]"""
+  single_venue = venue_page(venue_id)
+  if single_venue is None:
+    abort(404)
+  return render_template('pages/show_venue.html', venue=single_venue)
+
+def venue_page(venue_id):
+  '''Loads a Venue with everything its detail page shows
+  * Input: <int> venue_id
+  * Output: Venue with past & upcoming Shows, their numbers & similar Venues, None if there is no such Venue
+  Used in following Views:
+    - /venues/<id>
+    - "flask prerender" (static copies of the page)
+  '''
   # Step 1: Get single Venue
   single_venue = Venue.query.get(venue_id)
+  if single_venue is None or single_venue.deleted_at is not None:
+    return None
 
   # Step 2: Get all past shows filtered by venue_id and artist_id
   single_venue.past_shows = (db.session.query(
     Artist.id.label("artist_id"),
     Artist.name.label("artist_name"),
     Artist.image_link.label("artist_image_link"),
-    Show)
-    .filter(Show.c.Venue_id == venue_id)
-    .filter(Show.c.Artist_id == Artist.id)
-    .filter(Show.c.start_time <= datetime.now())
+    ShowHistory)
+    .filter(ShowHistory.c.Venue_id == venue_id)
+    .filter(ShowHistory.c.Artist_id == Artist.id)
+    .filter(Artist.deleted_at.is_(None))
+    .filter(ShowHistory.c.start_time <= datetime.now())
     .all())
 
   # Step 3: Get upcomming shows filtered by venue_id and artist_id
@@ -331,24 +1068,68 @@ def show_venue(venue_id):
     Show)
     .filter(Show.c.Venue_id == venue_id)
     .filter(Show.c.Artist_id == Artist.id)
+    .filter(Artist.deleted_at.is_(None))
     .filter(Show.c.start_time > datetime.now())
     .all())
 
   # Step 4: Get Number of past Shows
   single_venue.past_shows_count = (db.session.query(
-    func.count(Show.c.Venue_id))
-    .filter(Show.c.Venue_id == venue_id)
-    .filter(Show.c.start_time < datetime.now())
+    func.count(ShowHistory.c.Venue_id))
+    .filter(ShowHistory.c.Venue_id == venue_id)
+    .filter(ShowHistory.c.Artist_id == Artist.id)
+    .filter(Artist.deleted_at.is_(None))
+    .filter(ShowHistory.c.start_time < datetime.now())
     .all())[0][0]
 
   # Step 5: Get Number of Upcoming Shows
   single_venue.upcoming_shows_count = (db.session.query(
     func.count(Show.c.Venue_id))
     .filter(Show.c.Venue_id == venue_id)
+    .filter(Show.c.Artist_id == Artist.id)
+    .filter(Artist.deleted_at.is_(None))
     .filter(Show.c.start_time > datetime.now())
     .all())[0][0]
 
-  return render_template('pages/show_venue.html', venue=single_venue)
+  # Step 6: Get similar Venues
+  single_venue.similar_venues = similar_entities(Venue, 'venue', venue_id)
+
+  return single_venue
+
+@app.route('/venues/<int:venue_id>/stats')
+def venue_stats(venue_id):
+  '''See monthly booking statistics of a Venue
+  * Input: <int> venue_id
+  Contains following features:
+    - Shows, distinct artists & booked days per month
+    - Utilization: share of the days of a month with at least one Show
+  Only reads VenueMonthlyStats, never the Shows themselves.
+  Corresponding HTML:
+    - templates/pages/venue_stats.html
+  '''
+  # Step 1: Get single Venue
+  single_venue = Venue.query.get(venue_id)
+  if single_venue is None or single_venue.deleted_at is not None:
+    abort(404)
+
+  # Step 2: Get monthly statistics, latest month first
+  months = (VenueMonthlyStats.query
+    .filter(VenueMonthlyStats.venue_id == venue_id)
+    .order_by(VenueMonthlyStats.month.desc())
+    .all())
+
+  # Step 3: Add utilization
+  stats = []
+  for row in months:
+    days_in_month = (month_start(row.month, 1) - month_start(row.month)).days
+    stats.append({
+      'month': row.month,
+      'show_count': row.show_count,
+      'distinct_artists': row.distinct_artists,
+      'booked_days': row.booked_days,
+      'utilization': row.booked_days / days_in_month,
+    })
+
+  return render_template('pages/venue_stats.html', venue=single_venue, stats=stats)
 
 #  Create Venue
 #  ----------------------------------------------------------------
@@ -368,6 +1149,7 @@ def create_venue_submission():
   Contains following features:
     - Called upon submitting the new Venue listing form
     - Handle data from VenueForm
+    - Warn about likely duplicates in the same city, listing them needs a confirmation
     - Create new Venue with given data
     - Handle success & error with declerative flashes & messages
   Corresponding HTML:
@@ -383,6 +1165,11 @@ def create_venue_submission():
   form = VenueForm(request.form) # Initialize form instance with values from the request
   flashType = 'danger' # Initialize flashType to danger. Either it will be changed to "success" on successfully db insert, or in all other cases it should be equal to "danger"
   if form.validate():
+    if not form.confirm_duplicate.data:
+      duplicates = find_duplicates(Venue, 'venue', DUPLICATE_VENUE, form.name.data, form.city.data, form.state.data)
+      if duplicates:
+        flash('Venue {} may already be listed. Please check the Venues below.'.format(form.name.data))
+        return render_template('forms/new_venue.html', form=form, duplicates=duplicates, flashType='warning')
     try:
       # Create a new instance of Venue with data from VenueForm
       newVenue = Venue(
@@ -392,10 +1179,14 @@ def create_venue_submission():
         address = request.form['address'],
         phone = request.form['phone'],
         genres = request.form.getlist('genres'),
-        facebook_link = request.form['facebook_link']
+        facebook_link = request.form['facebook_link'],
+        **venue_location(request.form['city'], request.form['state'])
         )
       db.session.add(newVenue)
+      db.session.flush()
+      index_duplicate_keys('venue', newVenue.id, newVenue.name, newVenue.city, newVenue.state)
       db.session.commit()
+      invalidate_catalog_names(Venue)
       # on successful db insert, flash success
       flashType = 'success'
       flash('Venue {} was successfully listed!'.format(newVenue.name))
@@ -410,7 +1201,7 @@ def create_venue_submission():
     flash('An error occurred due to form validation. Venue {} could not be listed.'.format(request.form['name']))
   return render_template('pages/home.html', flashType = flashType)
 
-@app.route('/venues/<venue_id>', methods=['DELETE'])
+@app.route('/venues/<int:venue_id>', methods=['DELETE'])
 def delete_venue(venue_id):
   '''Delete existing Venue
   Input: <int> venue_id
@@ -418,6 +1209,8 @@ def delete_venue(venue_id):
     - Delete venue when red button on "/venues/<int:venue_id>" has been clicked.
     - Route gets fetched by Ajax. Javascript can be found under templates/layouts/main.html
     - Communicate success or error with corresponding redirections and alerts
+    - "?mode=hard" deletes the venue and its shows with a single statement
+    - Otherwise the venue is soft deleted and its shows are purged in the background
   Corresponding HTML:
       - templates/pages/show_venue.html
   '''
@@ -426,18 +1219,99 @@ def delete_venue(venue_id):
   # BONUS CHALLENGE: Implement a button to delete a Venue on a Venue Page, have it so that
   # clicking that button delete it from the db then redirect the user to the homepage
   # NOTE: Javascript to handle Button click + success/error in "main.html"
+  return jsonify({ 'success': delete_entity(Venue, venue_id, request.args.get('mode', 'soft')) })
+
+def delete_entity(model, entity_id, mode):
+  '''Deletes a Venue or an Artist
+  * Input: Venue or Artist, <int> entity_id, <str> mode ("hard" or "soft")
+  * Output: True if the entity was deleted
+  A hard delete is a single DELETE, the database removes the Shows via ON DELETE CASCADE.
+  A soft delete only sets deleted_at, which hides the entity at once. Its Shows are
+  then deleted in small batches by a background task (see purge_deleted).
+  Used in following Views:
+    - DELETE /venues/<venue_id>
+    - DELETE /artists/<artist_id>
+  '''
+  table = model.__table__
   try:
-    Venue.query.filter_by(id=venue_id).delete()
+    if mode == 'hard':
+      statement = table.delete().where(table.c.id == entity_id)
+    else:
+      statement = (table.update()
+        .where(table.c.id == entity_id)
+        .where(table.c.deleted_at.is_(None))
+        .values(deleted_at=datetime.now()))
+    deleted = db.session.execute(statement).rowcount > 0
+    if deleted:
+      # Deleted entities are no duplicates of new ones
+      keys = DuplicateKey.__table__
+      db.session.execute(keys.delete().where(keys.c.kind == model.__name__.lower()).where(keys.c.entity_id == entity_id))
+    if deleted and mode != 'hard':
+      tasks.enqueue('purge_deleted')
     db.session.commit()
-  except:
+  except SQLAlchemyError:
     db.session.rollback()
-    # This will alert User that Venue could not be deleted because they are still Shows attached
-    return jsonify({ 'success': False })
+    app.logger.exception('{} {} could not be deleted'.format(model.__name__, entity_id))
+    return False
   finally:
     # Always close database session.
     db.session.close()
-  # This will return the User to the HomePage
-  return jsonify({ 'success': True })
+  invalidate_catalog_names(model)
+  if deleted and mode != 'hard':
+    tasks.wake()
+  return deleted
+
+@tasks.task
+def purge_deleted(batch_size=None):
+  '''Deletes soft deleted Venues & Artists together with their Shows
+  * Input: <int> batch_size, default PURGE_BATCH_SIZE
+  * Output: Number of deleted Shows
+  Shows are deleted in separate transactions of at most batch_size rows, so the Show
+  table is never locked for long. Once no Shows are left, the Venue or Artist itself
+  is deleted. Background task, added by soft deletes (see tasks.py).
+  Each Venue or Artist is purged by one task at a time: a transaction of its own
+  holds the row locked (FOR UPDATE SKIP LOCKED) until the entity is deleted, the
+  purges running at the same time, e.g. of other workers, skip it.
+  '''
+  batch_size = batch_size or app.config['PURGE_BATCH_SIZE']
+  purged = 0
+  for model, column in ((Venue, 'Venue_id'), (Artist, 'Artist_id')):
+    # Entities deleted while the purge is running get picked up as well
+    while True:
+      with db.engine.connect() as connection:
+        transaction = connection.begin()
+        entity_id = connection.execute(db.select([model.id])
+          .where(model.deleted_at.isnot(None))
+          .order_by(model.id)
+          .limit(1)
+          .with_for_update(skip_locked=True)).scalar()
+        if entity_id is None:
+          transaction.rollback()
+          break
+        purged += purge_shows(column, entity_id, batch_size)
+        # The entity itself goes in the locking transaction, only once its Shows are gone.
+        # Deleting it with Shows left would delete them in one statement (ON DELETE CASCADE).
+        left = connection.execute(db.select([db.exists().where(ShowHistory.c[column] == entity_id)])).scalar()
+        if not left:
+          connection.execute(model.__table__.delete().where(model.id == entity_id))
+        transaction.commit()
+  return purged
+
+def purge_shows(column, entity_id, batch_size):
+  '''Deletes the Shows of a Venue or Artist (<column> Venue_id or Artist_id), batch_size per transaction'''
+  purged = 0
+  for table in (Show, ShowArchive):
+    while True:
+      # Rows of a partitioned table are identified by the partition (tableoid) and their ctid
+      deleted = db.session.execute('''DELETE FROM "{0}" WHERE (tableoid, ctid) IN (
+                                        SELECT tableoid, ctid FROM "{0}" WHERE "{1}" = :id LIMIT :limit)'''
+                                   .format(table.name, column), {'id': entity_id, 'limit': batch_size}).rowcount
+      db.session.commit()
+      purged += deleted
+      if deleted < batch_size:
+        break
+      time.sleep(app.config['PURGE_BATCH_PAUSE'])
+  return purged
 
 
 #  Artists
@@ -456,17 +1330,38 @@ def artists():
     "name": "The Wild Sax Band",
   }]"""
   '''List all Artists
-  * Input: None
+  * Input: query parameters city, state & genre, all optional (see CatalogFilterForm)
   Contains following features:
     - See all Artists listed
+    - Browse an area or a genre by filtering on it
     - Clicking on a Artist links to its detail dage under "/artists/<int:artist_id>"
+  Artists are filtered on the catalog snapshot of this process, without a query.
   Corresponding HTML:
     - templates/pages/artists.html
   '''
-  artists = Artist.query.all()
-  return render_template('pages/artists.html', artists=artists)
+  # Step 1: Validate the filters
+  form = CatalogFilterForm(request.args)
+  if not form.validate():
+    return render_template('pages/artists.html', form=form, artists=[]), 400
+
+  # Step 2: Select the Artists matching the filters from the snapshot, ordered by id
+  table = catalog.get(db.session)['artist']
+  rows = np.flatnonzero(table.where(form.city.data, form.state.data, form.genre.data))
+  artists = map(ArtistListing, table.ids[rows].tolist(), table.names[rows].tolist())
+  return stream_template('pages/artists.html', form=form, artists=artists)
+
+@app.route('/artists/seeking')
+def seeking_artists():
+  '''Browse Artists seeking venues
+  * Input: query parameters city, state, genre & after (see browse_seeking)
+  Corresponding HTML:
+    - templates/pages/seeking.html
+  '''
+  return browse_seeking(Artist, artist_seeking, artist_genres_array, SEEKING_ARTIST_LISTING,
+    title='Artists seeking venues', url='/artists')
 
-@app.route('/artists/search', methods=['POST'])
+@app.route('/artists/search', methods=['GET', 'POST'])
+@admission.deferred
 def search_artists():
   # TODO: implement search on artists with partial string search. Ensure it is case-insensitive.
   # seach for "A" should return "Guns N Petals", "Matt Quevado", and "The Wild Sax Band".
@@ -480,7 +1375,7 @@ def search_artists():
     }]
   }"""
   '''Search for artists
-  * Input: None
+  * Input: query parameters search_term & fragment (see search_entities)
   Contains following features:
     - Search for artists with search term & get a list of results
     - See how many database entries are matched with the search term
@@ -488,21 +1383,7 @@ def search_artists():
   Corresponding HTML:
     - templates/pages/search_artists.html
   '''
-  # get search term from request
-  search_term = request.form.get('search_term', '')
-
-  # use search term to count, how many occurance can be find in database
-  search_artist_count = db.session.query(func.count(Artist.id)).filter(Artist.name.contains(search_term)).all()
-
-  # use search_term to find all Artist records in database
-  search_artist_result = Artist.query.filter(Artist.name.contains(search_term)).all()
-
-  # create a well formatted response with above results
-  response={
-    "count": search_artist_count[0][0],
-    "data": search_artist_result
-  }
-  return render_template('pages/search_artists.html', results=response, search_term=search_term)
+  return search_entities(Artist, ARTIST_SEARCH_RESULT, 'pages/search_artists.html')
 
 @app.route('/artists/<int:artist_id>')
 def show_artist(artist_id):
@@ -589,18 +1470,34 @@ def show_artist(artist_id):
   Corresponding HTML:
     - templates/pages/show_artists.html
   '''
+  single_artist = artist_page(artist_id)
+  if single_artist is None:
+    abort(404)
+  return render_template('pages/show_artist.html', artist=single_artist)
+
+def artist_page(artist_id):
+  '''Loads an Artist with everything its detail page shows
+  * Input: <int> artist_id
+  * Output: Artist with past & upcoming Shows, their numbers & similar Artists, None if there is no such Artist
+  Used in following Views:
+    - /artists/<id>
+    - "flask prerender" (static copies of the page)
+  '''
   # Step 1: Get single Artist
   single_artist = Artist.query.get(artist_id)
+  if single_artist is None or single_artist.deleted_at is not None:
+    return None
 
   # Step 2: Get Past Shows
   single_artist.past_shows = (db.session.query(
     Venue.id.label("venue_id"),
     Venue.name.label("venue_name"),
     Venue.image_link.label("venue_image_link"),
-    Show)
-    .filter(Show.c.Artist_id == artist_id)
-    .filter(Show.c.Venue_id == Venue.id)
-    .filter(Show.c.start_time <= datetime.now())
+    ShowHistory)
+    .filter(ShowHistory.c.Artist_id == artist_id)
+    .filter(ShowHistory.c.Venue_id == Venue.id)
+    .filter(Venue.deleted_at.is_(None))
+    .filter(ShowHistory.c.start_time <= datetime.now())
     .all())
 
   # Step 3: Get Upcomming Shows
@@ -611,24 +1508,46 @@ def show_artist(artist_id):
     Show)
     .filter(Show.c.Artist_id == artist_id)
     .filter(Show.c.Venue_id == Venue.id)
+    .filter(Venue.deleted_at.is_(None))
     .filter(Show.c.start_time > datetime.now())
     .all())
 
   # Step 4: Get Number of past Shows
   single_artist.past_shows_count = (db.session.query(
-    func.count(Show.c.Artist_id))
-    .filter(Show.c.Artist_id == artist_id)
-    .filter(Show.c.start_time < datetime.now())
+    func.count(ShowHistory.c.Artist_id))
+    .filter(ShowHistory.c.Artist_id == artist_id)
+    .filter(ShowHistory.c.Venue_id == Venue.id)
+    .filter(Venue.deleted_at.is_(None))
+    .filter(ShowHistory.c.start_time < datetime.now())
     .all())[0][0]
 
   # Step 5: Get Number of Upcoming Shows
   single_artist.upcoming_shows_count = (db.session.query(
     func.count(Show.c.Artist_id))
     .filter(Show.c.Artist_id == artist_id)
+    .filter(Show.c.Venue_id == Venue.id)
+    .filter(Venue.deleted_at.is_(None))
     .filter(Show.c.start_time > datetime.now())
     .all())[0][0]
 
-  return render_template('pages/show_artist.html', artist=single_artist)
+  # Step 6: Get similar Artists
+  single_artist.similar_artists = similar_entities(Artist, 'artist', artist_id)
+
+  return single_artist
+
+@app.route('/artists/<int:artist_id>', methods=['DELETE'])
+def delete_artist(artist_id):
+  '''Delete existing Artist
+  Input: <int> artist_id
+  Contains following features:
+    - Delete artist when red button on "/artists/<int:artist_id>" has been clicked.
+    - Route gets fetched by Ajax. Javascript can be found under templates/layouts/main.html
+    - "?mode=hard" deletes the artist and its shows with a single statement
+    - Otherwise the artist is soft deleted and its shows are purged in the background
+  Corresponding HTML:
+      - templates/pages/show_artist.html
+  '''
+  return jsonify({ 'success': delete_entity(Artist, artist_id, request.args.get('mode', 'soft')) })
 
 #  Update
 #  ----------------------------------------------------------------
@@ -660,14 +1579,17 @@ def edit_artist(artist_id):
   form = ArtistForm()
   # Get single artist entry
   artist = Artist.query.get(artist_id)
+  if artist is None or artist.deleted_at is not None:
+    abort(404)
 
   # Pre Fill form with data
   form.name.data = artist.name
   form.city.data = artist.city
   form.state.data = artist.state
   form.phone.data = artist.phone
-  form.genres.data = artist.genres
+  form.genres.data = genres_list(artist.genres)
   form.facebook_link.data = artist.facebook_link
+  prefill_edit_form(form, artist, ARTIST_EDIT_FIELDS)
 
   # TODO-Done: populate form with fields from artist with ID <artist_id>
   return render_template('forms/edit_artist.html', form=form, artist=artist)
@@ -679,21 +1601,13 @@ def edit_artist_submission(artist_id):
   Contains following features:
     - Called upon form submission by "edit_artist"
     - Update fields from existing artist with new values
+    - Only changed fields are written, with a single UPDATE guarded by the version
   Corresponding HTML:
     - templates/forms/edit_artist.html
   '''
-  # TODO: take values from the form submitted, and update existing
+  # TODO-Done: take values from the form submitted, and update existing
   # artist record with ID <artist_id> using the new attributes
-  artist = Venue.query.get(artist_id)
-  artist.name = request.form['name'],
-  artist.city = request.form['city'],
-  artist.state = request.form['state'],
-  artist.phone = request.form['phone'],
-  artist.genres = request.form['genres'],
-  artist.facebook_link = request.form['facebook_link']
-  db.session.add(artist)
-  db.session.commit()
-  db.session.close()
+  submit_edit_form(Artist, ArtistForm(request.form), artist_id)
   # Redirect user to artist detail page with updated values
   return redirect(url_for('show_artist', artist_id=artist_id))
 
@@ -728,6 +1642,8 @@ def edit_venue(venue_id):
   form = VenueForm()
   # Get single venue entry
   venue = Venue.query.get(venue_id)
+  if venue is None or venue.deleted_at is not None:
+    abort(404)
 
   # Pre Fill form with data
   form.name.data = venue.name
@@ -737,6 +1653,7 @@ def edit_venue(venue_id):
   form.phone.data = venue.phone
   form.genres.data = venue.genres
   form.facebook_link.data = venue.facebook_link
+  prefill_edit_form(form, venue, VENUE_EDIT_FIELDS)
 
   # TODO-DONE: populate form with values from venue with ID <venue_id>
   return render_template('forms/edit_venue.html', form=form, venue=venue)
@@ -748,27 +1665,154 @@ def edit_venue_submission(venue_id):
   Contains following features:
     - Called upon form submission by "edit_venue"
     - Update fields from existing venue with new values
+    - Only changed fields are written, with a single UPDATE guarded by the version
   Corresponding HTML:
     - templates/forms/edit_venue.html
   '''
-  # TODO: take values from the form submitted, and update existing
+  # TODO-Done: take values from the form submitted, and update existing
   # venue record with ID <venue_id> using the new attributes
-
-  venue = Venue.query.get(venue_id)
-  venue.name = request.form['name'],
-  venue.city = request.form['city'],
-  venue.state = request.form['state'],
-  venue.address = request.form['address'],
-  venue.phone = request.form['phone'],
-  venue.genres = request.form.getlist('genres'),
-  venue.facebook_link = request.form['facebook_link']
-  db.session.add(venue)
-  db.session.commit()
-  db.session.close()
-
+  submit_edit_form(Venue, VenueForm(request.form), venue_id)
   # Redirect user to venue detail page with updated values
   return redirect(url_for('show_venue', venue_id=venue_id))
 
+# Fields of the edit forms (templates/forms/edit_*.html)
+VENUE_EDIT_FIELDS = ('name', 'city', 'state', 'address', 'phone', 'genres', 'facebook_link')
+ARTIST_EDIT_FIELDS = ('name', 'city', 'state', 'phone', 'genres', 'facebook_link')
+
+def prefill_edit_form(form, entity, fields):
+  '''Stores version & prefilled values of an edit form in its hidden fields'''
+  form.version.data = entity.version
+  form.original.data = json.dumps({field: form[field].data for field in fields})
+
+def updatable_columns(model, form):
+  '''Names of the form fields that can be written to columns of model'''
+  return [name for name in form._fields if name in model.__table__.c and name not in ('id', 'version')]
+
+def update_entity(model, entity_id, changes, version):
+  '''Updates the changed columns of a Venue or Artist without reading it first
+  * Input: Venue or Artist, <int> entity_id, <dict> changes (column -> value), <int> version
+  * Output: The new version, or None if the entity does not exist or is no longer at version
+  A single UPDATE ... WHERE version = <version> writes only the changed columns and increments
+  the version. A concurrent edit has already incremented the version, so the later writer
+  matches no row instead of overwriting the first edit (optimistic concurrency, no row locks).
+  A Venue whose city or state changed is geocoded again in the same transaction, the blocking
+  keys of duplicate detection are replaced when the name, city or state changed.
+  Used in following Views:
+    - POST /venues/<venue_id>/edit, PATCH /venues/<venue_id>
+    - POST /artists/<artist_id>/edit, PATCH /artists/<artist_id>
+  '''
+  if not changes:
+    return version
+  table = model.__table__
+  statement = (table.update()
+    .where(table.c.id == entity_id)
+    .where(table.c.deleted_at.is_(None))
+    .where(table.c.version == version)
+    .values(version=table.c.version + 1, **changes)
+    .returning(table.c.version, table.c.name, table.c.city, table.c.state))
+  try:
+    updated = db.session.execute(statement).first()
+    new_version = updated.version if updated is not None else None
+    if new_version is not None and model is Venue and ('city' in changes or 'state' in changes):
+      db.session.execute(table.update()
+        .where(table.c.id == entity_id)
+        .values(**venue_location(updated.city, updated.state)))
+    if new_version is not None and changes.keys() & {'name', 'city', 'state'}:
+      index_duplicate_keys(model.__name__.lower(), entity_id, updated.name, updated.city, updated.state)
+    db.session.commit()
+  finally:
+    # Always close session
+    db.session.close()
+  if new_version is not None:
+    invalidate_catalog_names(model)
+  return new_version
+
+def entity_exists(model, entity_id):
+  return db.session.query(db.exists().where(model.id == entity_id).where(model.deleted_at.is_(None))).scalar()
+
+def submit_edit_form(model, form, entity_id):
+  '''Writes the fields changed in an edit form, handles errors with flashes'''
+  if not form.validate():
+    flash(form.errors) # Flashes reason, why form is unsuccessful (not really pretty)
+    flash('An error occurred due to form validation. {} could not be updated.'.format(model.__name__))
+    return
+  try:
+    original = json.loads(form.original.data)
+    version = int(form.version.data)
+  except (TypeError, ValueError):
+    flash('An error occurred. {} could not be updated, please reload the form.'.format(model.__name__))
+    return
+  columns = updatable_columns(model, form)
+  changes = {name: form[name].data for name in original if name in columns and form[name].data != original[name]}
+  try:
+    new_version = update_entity(model, entity_id, changes, version)
+  except SQLAlchemyError:
+    app.logger.exception('{} {} could not be updated'.format(model.__name__, entity_id))
+    flash('An error occurred due to database error. {} could not be updated.'.format(model.__name__))
+    return
+  if new_version is None:
+    flash('{} was changed by someone else in the meantime. Please edit it again.'.format(model.__name__))
+
+def patch_entity(model, form_class, entity_id):
+  '''Partially updates a Venue or Artist from a JSON object
+  * Input: Venue or Artist, VenueForm or ArtistForm, <int> entity_id
+  The version the changes are based on is taken from the "If-Match" header or a "version" key.
+  Responds with the new version, 409 if the entity was changed concurrently.
+  '''
+  payload = request.get_json(silent=True)
+  if not isinstance(payload, dict):
+    return jsonify({ 'success': False, 'errors': 'Expected a JSON object.' }), 400
+  payload = dict(payload)
+  version = request.headers.get('If-Match', payload.pop('version', None))
+  payload.pop('version', None)
+  if version is None:
+    return jsonify({ 'success': False, 'errors': 'The version to update is missing.' }), 428
+  try:
+    version = int(str(version).strip('"'))
+  except ValueError:
+    return jsonify({ 'success': False, 'errors': 'Invalid version.' }), 400
+
+  # Validate only the fields that are being changed
+  form = form_class(formdata=None, data=payload, meta={'csrf': False})
+  columns = updatable_columns(model, form)
+  errors = {name: ['Unknown field.'] for name in payload if name not in columns}
+  for name in payload:
+    if name in columns and not form[name].validate(form):
+      errors[name] = form[name].errors
+  if errors:
+    return jsonify({ 'success': False, 'errors': errors }), 400
+
+  new_version = update_entity(model, entity_id, {name: form[name].data for name in payload}, version)
+  if new_version is None:
+    if not entity_exists(model, entity_id):
+      abort(404)
+    return jsonify({ 'success': False, 'errors': 'Changed by someone else, reload and try again.' }), 409
+  response = jsonify({ 'success': True, 'version': new_version })
+  response.headers['ETag'] = '"{}"'.format(new_version)
+  return response
+
+@app.route('/venues/<int:venue_id>', methods=['PATCH'])
+def patch_venue(venue_id):
+  '''Partially update existing Venue
+  * Input: <int> venue_id
+  Contains following features:
+    - Takes a JSON object with the changed fields, e.g. {"phone": "123-123-1234"}
+    - Needs the current version as "If-Match" header or "version" key
+    - Issues a single UPDATE without reading the venue
+  '''
+  return patch_entity(Venue, VenueForm, venue_id)
+
+@app.route('/artists/<int:artist_id>', methods=['PATCH'])
+def patch_artist(artist_id):
+  '''Partially update existing Artist
+  * Input: <int> artist_id
+  Contains following features:
+    - Takes a JSON object with the changed fields, e.g. {"phone": "123-123-1234"}
+    - Needs the current version as "If-Match" header or "version" key
+    - Issues a single UPDATE without reading the artist
+  '''
+  return patch_entity(Artist, ArtistForm, artist_id)
+
 
 #  Create Artist
 #  ----------------------------------------------------------------
@@ -789,6 +1833,7 @@ def create_artist_submission():
   Contains following features:
     - Called upon submitting the new Artist listing form
     - Handle data from ArtistForm
+    - Warn about likely duplicates in the same city, listing them needs a confirmation
     - Create new Artist with given data
     - Handle success & error with declerative flashes & messages
   Corresponding HTML:
@@ -802,6 +1847,11 @@ def create_artist_submission():
   form = ArtistForm(request.form)
   flashType = 'danger' # Initialize flashType to danger. Either it will be changed to "success" on successfully db insert, or in all other cases it should be equal to "danger"
   if form.validate():
+    if not form.confirm_duplicate.data:
+      duplicates = find_duplicates(Artist, 'artist', DUPLICATE_ARTIST, form.name.data, form.city.data, form.state.data)
+      if duplicates:
+        flash('Artist {} may already be listed. Please check the Artists below.'.format(form.name.data))
+        return render_template('forms/new_artist.html', form=form, duplicates=duplicates, flashType='warning')
     try:
       # Create a new instance of Artist with data from ArtistForm
       newArtist = Artist(
@@ -813,7 +1863,10 @@ def create_artist_submission():
         genres = request.form.getlist('genres')
         )
       db.session.add(newArtist)
+      db.session.flush()
+      index_duplicate_keys('artist', newArtist.id, newArtist.name, newArtist.city, newArtist.state)
       db.session.commit()
+      invalidate_catalog_names(Artist)
       # on successful db insert, flash success
       flashType = 'success'
       flash('Artist {} was successfully listed!'.format(newArtist.name))
@@ -886,23 +1939,124 @@ def shows():
   Corresponding HTML:
     - templates/pages/shows.html'''
 
-  shows = (db.session.query(
+  shows = (SHOW_LISTING.select()
+    .where(ShowHistory.c.Venue_id == Venue.id)
+    .where(ShowHistory.c.Artist_id == Artist.id)
+    .where(Venue.deleted_at.is_(None))
+    .where(Artist.deleted_at.is_(None)))
+
+  # Rows get fetched in batches while the page streams to the browser
+  return stream_template('pages/shows.html', shows=SHOW_LISTING.iter(db.session, shows, app.config['STREAM_BATCH_SIZE']))
+
+@app.route('/shows/stream')
+def stream_shows():
+  '''Server-Sent Events of newly listed Shows
+  * Input: optional query parameters venue_id, artist_id & city to only get those Shows
+  Contains following features:
+    - One "shows" event per listing (a single Show or a whole series), see announce_shows
+    - Reconnecting clients get missed events by their Last-Event-ID
+  Used in following HTML:
+    - templates/pages/shows.html
+    - templates/pages/show_venue.html
+    - templates/pages/show_artist.html
+  '''
+  return live_events.response(
+    venue_id=request.args.get('venue_id', type=int),
+    artist_id=request.args.get('artist_id', type=int),
+    city=request.args.get('city') or None)
+
+@tasks.task
+def announce_shows(venue_id, artist_id, start_times):
+  '''Sends a "shows" event for new Shows, delivered when the transaction commits
+  * Input: <int> venue_id, <int> artist_id, start times as ISO 8601 strings
+  Background task, added in the transaction of the insert (see tasks.py).
+  Used in following Views:
+    - /shows/create
+  '''
+  venue = db.session.query(Venue.name, Venue.city, Venue.state, Venue.image_link).filter(Venue.id == venue_id).one()
+  artist = db.session.query(Artist.name, Artist.image_link).filter(Artist.id == artist_id).one()
+  live_events.notify('shows',
+    venue_id=venue_id,
+    venue_name=venue.name,
+    venue_image_link=venue.image_link,
+    city=venue.city,
+    state=venue.state,
+    artist_id=artist_id,
+    artist_name=artist.name,
+    artist_image_link=artist.image_link,
+    start_times=start_times)
+
+def show_export_query(start=None, end=None, venue_id=None):
+  '''Builds the query for exporting Shows
+  * Input: <datetime> start, <datetime> end, <int> venue_id (all optional filters)
+  * Output: SQLAlchemy select with one row per Show, including venue and artist names
+  Used in following Views:
+    - /shows/export
+    - flask export
+  '''
+  query = (db.select([
+    ShowHistory.c.start_time,
     Venue.id.label("venue_id"),
     Venue.name.label("venue_name"),
+    Venue.city.label("venue_city"),
+    Venue.state.label("venue_state"),
     Artist.id.label("artist_id"),
-    Artist.name.label("artist_name"),
-    Artist.image_link.label("artist_image_link"),
-    Show)
-    .filter(Show.c.Venue_id == Venue.id)
-    .filter(Show.c.Artist_id == Artist.id)
-    .all())
+    Artist.name.label("artist_name")])
+    .where(ShowHistory.c.Venue_id == Venue.id)
+    .where(ShowHistory.c.Artist_id == Artist.id)
+    .where(Venue.deleted_at.is_(None))
+    .where(Artist.deleted_at.is_(None))
+    .order_by(ShowHistory.c.start_time))
+  if start is not None:
+    query = query.where(ShowHistory.c.start_time >= start)
+  if end is not None:
+    query = query.where(ShowHistory.c.start_time < end)
+  if venue_id is not None:
+    query = query.where(ShowHistory.c.Venue_id == venue_id)
+  return query
+
+def stream_show_export(query, batch_size):
+  '''Executes the export query with a server-side cursor
+  * Output: Throughput counter wrapping the batches of rows
+  '''
+  connection = db.session.connection().execution_options(stream_results=True)
+  return Throughput(iter_batches(connection.execute(query), batch_size))
 
-  return render_template('pages/shows.html', shows=shows)
+@app.route('/shows/export')
+def export_shows():
+  '''Download Shows with venue & artist names as a file
+  * Input: None
+  Contains following features:
+    - Choose the file type with "format" (csv or parquet)
+    - Filter by date range with "start" & "end" and by "venue_id"
+    - The file is streamed in batches of EXPORT_BATCH_SIZE rows, so memory stays flat
+    - Throughput gets logged once the download is done
+  '''
+  file_format = request.args.get('format', 'csv')
+  try:
+    writer = get_writer(file_format)
+    start = request.args.get('start')
+    start = dateutil.parser.parse(start) if start else None
+    end = request.args.get('end')
+    end = dateutil.parser.parse(end) if end else None
+  except (ValueError, OverflowError) as error:
+    abort(400, description=str(error))
+  query = show_export_query(start, end, request.args.get('venue_id', type=int))
+
+  def generate():
+    rows = stream_show_export(query, app.config['EXPORT_BATCH_SIZE'])
+    for chunk in writer(query.c, rows):
+      yield chunk
+    app.logger.info('Exported {}'.format(rows.report()))
+
+  return Response(stream_with_context(generate()), mimetype=FORMATS[file_format],
+    headers={'Content-Disposition': 'attachment; filename=shows.{}'.format(file_format)})
 
 @app.route('/shows/create')
 def create_shows():
   # renders form. do not touch.
-  form = ShowForm()
+  # Venue & Artist choices come from the cache, so rendering the form needs no query
+  form = populate_show_form(ShowForm())
   return render_template('forms/new_show.html', form=form)
 
 @app.route('/shows/create', methods=['POST'])
@@ -915,30 +2069,67 @@ def create_show_submission():
     - Called upon submitting the new Show listing form
     - Handle data from ShowForm
     - Create new Show with given data
+    - Create a whole recurring series of Shows with a single INSERT
     - Handle success & error with declerative flashes & messages
   Corresponding HTML:
       - templates/pages/new_artist.html"""
 
   form = ShowForm(request.form) # Initialize form instance with values from the request
+  # Ids get validated against the cached Venues & Artists, so unknown ids never reach the database
+  populate_show_form(form)
   flashType = 'danger' # Initialize flashType to danger. Either it will be changed to "success" on successfully db insert, or in all other cases it should be equal to "danger"
   if form.validate():
     # NOTE: Form could not be validated due to a missing csrf-token.
     # I solved this issue by putting a "{{ form.csrf_token() }}"
     # under the respective <form> tag in forms/new_show.html
     try:
-      # Create a new instance of Show with data from ShowForm
-      newShow = Show.insert().values(
-        Venue_id = request.form['venue_id'],
-        Artist_id = request.form['artist_id'],
-        start_time = request.form['start_time']
-      )
-      db.session.execute(newShow)
-      db.session.commit()
-      # on successful db insert, flash success
-      flashType = 'success'
-      flash('Show was successfully listed!')
-    except :
+      # Expand a recurring series into all of its occurrences (a single Show otherwise)
+      occurrences = expand_show_series(
+        form.start_time.data,
+        interval_days=form.repeat_interval.data,
+        count=form.repeat_count.data,
+        until=form.repeat_until.data)
+    except ValueError as error:
+      flash(str(error))
+      return render_template('pages/home.html', flashType=flashType)
+    try:
+      # Validate every occurrence: the venue must not already have a Show at that time
+      booked = (db.session.query(Show.c.start_time)
+        .filter(Show.c.Venue_id == form.venue_id.data)
+        .filter(Show.c.start_time.in_(occurrences))
+        .all())
+      if booked:
+        flash('Show could not be listed. The venue is already booked on {}.'.format(
+          ', '.join(str(row.start_time) for row in booked)))
+      else:
+        # Insert all occurrences with a single multi-row INSERT in one transaction
+        newShows = Show.insert().values([{
+          'Venue_id': form.venue_id.data,
+          'Artist_id': form.artist_id.data,
+          'start_time': start_time
+        } for start_time in occurrences])
+        db.session.execute(newShows)
+        # Monthly booking statistics of the venue & live pages learn about the new Shows
+        # in the background, the tasks are committed together with the Shows
+        tasks.enqueue('refresh_venue_stats', venue_id=form.venue_id.data, start_times=occurrences)
+        tasks.enqueue('announce_shows', venue_id=form.venue_id.data, artist_id=form.artist_id.data,
+                      start_times=occurrences)
+        # The detail pages of the venue & artist list the new Shows (see "flask prerender")
+        record_catalog_changes([('venue', form.venue_id.data), ('artist', form.artist_id.data)])
+        db.session.commit()
+        tasks.wake()
+        # Other processes show the new Shows on the homepage after HOME_FEED_TTL seconds
+        invalidate_home_feeds()
+        # on successful db insert, flash success
+        flashType = 'success'
+        if len(occurrences) > 1:
+          flash('{} Shows were successfully listed!'.format(len(occurrences)))
+        else:
+          flash('Show was successfully listed!')
+    except SQLAlchemyError:
       # TODO-Done: on unsuccessful db insert, flash an error instead.
+      db.session.rollback()
+      app.logger.exception('Show could not be listed')
       flash('An error occurred due to database insertion error. Show could not be listed.')
     finally:
       # Always close session
@@ -972,11 +2163,502 @@ if not app.debug:
     app.logger.addHandler(file_handler)
     app.logger.info('errors')
 
+#----------------------------------------------------------------------------#
+# Commands.
+#----------------------------------------------------------------------------#
+
+def month_start(date, months=0):
+  '''Returns the first day of the month, which is <months> months after the month of date'''
+  month_index = date.year * 12 + date.month - 1 + months
+  return datetime(month_index // 12, month_index % 12 + 1, 1)
+
+def show_partition_bounds(month):
+  return "FOR VALUES FROM ('{:%Y-%m-%d}') TO ('{:%Y-%m-%d}')".format(month, month_start(month, 1))
+
+def show_partitions():
+  '''Returns the monthly partition tables of Show & Show_archive
+  * Output: dict name -> (month, name of the parent table), parent None for tables attached to neither
+  '''
+  partitions = {}
+  for name, parent in db.session.execute("""SELECT c.relname, p.relname FROM pg_class c
+                                              LEFT JOIN pg_inherits i ON i.inhrelid = c.oid
+                                              LEFT JOIN pg_class p ON p.oid = i.inhparent
+                                            WHERE c.relkind = 'r' AND c.relname LIKE 'Show\\_p%'
+                                              AND c.relnamespace = current_schema()::regnamespace"""):
+    try:
+      partitions[name] = (datetime.strptime(name, 'Show_p%Y_%m'), parent)
+    except ValueError:
+      pass
+  return partitions
+
+def create_show_partition(month, parent):
+  '''Creates the partition of <month> in <parent> ("Show" or "Show_archive")
+  Shows of the month in "Show_default" are moved into it before it is attached. Run it
+  in a transaction holding "Show_default" locked, so no Show of the month gets inserted
+  into the default partition between the move and the ATTACH.
+  * Output: number of Shows moved
+  '''
+  name = 'Show_p{:%Y_%m}'.format(month)
+  db.session.execute('CREATE TABLE "{}" (LIKE "{}" INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'.format(name, parent))
+  moved = move_default_shows(month, name)
+  db.session.execute('ALTER TABLE "{}" ATTACH PARTITION "{}" {}'.format(parent, name, show_partition_bounds(month)))
+  return moved
+
+def move_default_shows(month, table):
+  '''Moves the Shows of <month> from "Show_default" to <table>, returns their number'''
+  return db.session.execute("""WITH moved AS (
+                                 DELETE FROM "Show_default" WHERE start_time >= :start AND start_time < :end RETURNING *)
+                               INSERT INTO "{}" SELECT * FROM moved""".format(table),
+                            {'start': month, 'end': month_start(month, 1)}).rowcount
+
+def migrate_show_table(cutoff):
+  '''Converts an unpartitioned Show table into the partitioned one, in one transaction
+  The old table is locked & renamed, the Shows are copied into monthly partitions
+  (Show_archive for months before <cutoff>) and the old table is dropped.
+  '''
+  connection = db.session.connection()
+  db.session.execute('LOCK TABLE "Show" IN ACCESS EXCLUSIVE MODE')
+  db.session.execute('ALTER TABLE "Show" RENAME TO "Show_unpartitioned"')
+  # The index names are taken by the new table
+  for index in Show.indexes:
+    db.session.execute('DROP INDEX IF EXISTS "{}"'.format(index.name))
+  Show.create(bind=connection)
+  ShowArchive.create(bind=connection, checkfirst=True)
+  months = [month for (month,) in db.session.execute("""SELECT DISTINCT date_trunc('month', start_time)
+                                                          FROM "Show_unpartitioned" WHERE start_time IS NOT NULL""")]
+  # Empty partitions first, the copy then writes every Show once
+  for month in months:
+    create_show_partition(month, 'Show_archive' if month < cutoff else 'Show')
+  columns = '"Venue_id", "Artist_id", start_time'
+  db.session.execute("""INSERT INTO "Show" ({0}) SELECT {0} FROM "Show_unpartitioned"
+                        WHERE start_time IS NULL OR start_time >= :cutoff""".format(columns), {'cutoff': cutoff})
+  db.session.execute("""INSERT INTO "Show_archive" ({0}) SELECT {0} FROM "Show_unpartitioned"
+                        WHERE start_time < :cutoff""".format(columns), {'cutoff': cutoff})
+  db.session.execute('DROP TABLE "Show_unpartitioned"')
+  db.session.commit()
+  return len(months)
+
+@app.cli.command('partition-shows')
+@click.option('--months-ahead', type=int, help='Number of future months to create partitions for.')
+@click.option('--retention-months', type=int, help='Number of past months to keep in the Show table.')
+@click.option('--migrate', is_flag=True,
+  help='Convert an unpartitioned Show table, it is locked while the Shows are copied.')
+def partition_shows(months_ahead, retention_months, migrate):
+  '''Maintains the monthly partitions of the Show table
+  Contains following features:
+    - Convert an unpartitioned Show table (--migrate)
+    - Create partitions for the current and the next <months-ahead> months
+    - Move Shows out of "Show_default" into partitions of their months: Shows listed before
+      their partition existed, and the Shows of tables partitioned after they were listed
+    - Detach partitions older than <retention-months> and attach them to "Show_archive"
+  After a run "Show_default" only holds Shows listed since then for months without partition.
+  Run it regularly, e.g. once a day from cron: "FLASK_APP=app flask partition-shows"
+  '''
+  if months_ahead is None:
+    months_ahead = app.config['SHOW_PARTITION_MONTHS_AHEAD']
+  if retention_months is None:
+    retention_months = app.config['SHOW_PARTITION_RETENTION_MONTHS']
+  if db.engine.dialect.name != 'postgresql':
+    raise click.ClickException('Partitioning is only supported on PostgreSQL.')
+  this_month = month_start(datetime.now())
+  cutoff = month_start(this_month, -retention_months)
+  if not db.session.execute("""SELECT count(*) FROM pg_partitioned_table WHERE partrelid = '"Show"'::regclass""").scalar():
+    if not migrate:
+      raise click.ClickException('Table "Show" is not partitioned. Run "flask partition-shows --migrate" to convert it.')
+    click.echo('Migrated the Show table into {} monthly partitions'.format(migrate_show_table(cutoff)))
+
+  # Step 1: Attach tables detached from Show to Show_archive, past Shows are read from there
+  for name, (month, parent) in sorted(show_partitions().items()):
+    if parent is None:
+      db.session.execute('ALTER TABLE "Show_archive" ATTACH PARTITION "{}" {}'.format(name, show_partition_bounds(month)))
+      db.session.commit()
+      click.echo('Archived partition {}'.format(name))
+
+  # Step 2: Partitions for this month, the coming months and every month with Shows in the default partition
+  months = {month_start(this_month, months) for months in range(months_ahead + 1)}
+  months.update(month for (month,) in db.session.execute("""SELECT DISTINCT date_trunc('month', start_time)
+                                                              FROM "Show_default" WHERE start_time IS NOT NULL"""))
+  db.session.commit()
+  for month in sorted(months):
+    name = 'Show_p{:%Y_%m}'.format(month)
+    # Inserts of Shows into the default partition wait until the month has its partition
+    db.session.execute('LOCK TABLE "Show_default" IN ACCESS EXCLUSIVE MODE')
+    parent = show_partitions().get(name, (None, None))[1]
+    archived = month_start(month, 1) <= cutoff
+    if parent == 'Show_archive':
+      # Shows listed for a month that was archived already
+      moved = move_default_shows(month, name)
+    elif parent is None:
+      moved = create_show_partition(month, 'Show_archive' if archived else 'Show')
+      click.echo('Created partition {}{}'.format(name, ' in Show_archive' if archived else ''))
+    else:
+      moved = 0
+    db.session.commit()
+    if moved:
+      click.echo('Moved {} Shows from Show_default to {}'.format(moved, name))
+
+  # Step 3: Detach partitions that only contain Shows older than the retention period
+  for name, (month, parent) in sorted(show_partitions().items()):
+    if parent != 'Show' or month_start(month, 1) > cutoff:
+      continue
+    db.session.execute('ALTER TABLE "Show" DETACH PARTITION "{}"'.format(name))
+    db.session.execute('ALTER TABLE "Show_archive" ATTACH PARTITION "{}" {}'.format(name, show_partition_bounds(month)))
+    db.session.commit()
+    click.echo('Archived partition {}'.format(name))
+
+@app.cli.command('purge-deleted')
+@click.option('--batch-size', type=int, help='Maximum number of Shows deleted per transaction.')
+def purge_deleted_command(batch_size):
+  '''Deletes soft deleted Venues & Artists and their Shows in batches
+  Finishes purges that were interrupted, e.g. by a restart of the server.
+  '''
+  purged = purge_deleted(batch_size or app.config['PURGE_BATCH_SIZE'])
+  click.echo('Purged {} Shows'.format(purged))
+
+@app.cli.command('export')
+@click.option('--format', 'file_format', type=click.Choice(sorted(FORMATS)), default='csv')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), default='-', help='File to write to, default: stdout.')
+@click.option('--start', type=click.DateTime(), help='Only export Shows starting at or after this time.')
+@click.option('--end', type=click.DateTime(), help='Only export Shows starting before this time.')
+@click.option('--venue-id', type=int, help='Only export Shows of this venue.')
+@click.option('--batch-size', type=int, help='Number of rows fetched from the database at a time.')
+def export_shows_command(file_format, output, start, end, venue_id, batch_size):
+  '''Exports Shows with venue & artist names as CSV or Parquet
+  Rows are streamed from a server-side cursor, so memory stays flat regardless of the number of Shows.
+  '''
+  try:
+    writer = get_writer(file_format)
+  except ValueError as error:
+    raise click.ClickException(str(error))
+  query = show_export_query(start, end, venue_id)
+  rows = stream_show_export(query, batch_size or app.config['EXPORT_BATCH_SIZE'])
+  with click.open_file(output, 'wb') as file:
+    for chunk in writer(query.c, rows):
+      file.write(chunk)
+  click.echo('Exported {}'.format(rows.report()), err=True)
+
+@app.cli.command('recommend')
+@click.option('--top-k', type=int, help='Number of similar Venues & Artists stored per entity.')
+def recommend_command(top_k):
+  '''Computes similar Venues & Artists from genres and co-bookings
+  Replaces the contents of the Recommendation table in one transaction, the detail pages
+  keep showing the previous results until it commits. Run it e.g. nightly.
+  '''
+  # Imported when the command runs, the server processes never need recommend.py or scipy.sparse
+  from recommend import compute_recommendations
+  started = time.perf_counter()
+  venues = [(venue_id, genres_list(genres)) for venue_id, genres in
+    db.session.query(Venue.id, Venue.genres).filter(Venue.deleted_at.is_(None)).order_by(Venue.id)]
+  artists = [(artist_id, genres_list(genres)) for artist_id, genres in
+    db.session.query(Artist.id, Artist.genres).filter(Artist.deleted_at.is_(None)).order_by(Artist.id)]
+  bookings = (db.session.query(ShowHistory.c.Venue_id, ShowHistory.c.Artist_id, func.count())
+    .group_by(ShowHistory.c.Venue_id, ShowHistory.c.Artist_id)
+    .all())
+  results = compute_recommendations(venues, artists, bookings, top_k or app.config['RECOMMENDATION_TOP_K'])
+
+  db.session.query(Recommendation).delete()
+  for kind, rows in results.items():
+    bulk_insert(Recommendation.__table__, ['kind', 'entity_id', 'rank', 'similar_id', 'score'],
+      [(kind,) + row for row in rows])
+  db.session.commit()
+  click.echo('Stored {} similar Venues & {} similar Artists in {:.1f}s'.format(
+    len(results['venue']), len(results['artist']), time.perf_counter() - started))
+
+@app.cli.command('rollup-venue-stats')
+@click.option('--batch-size', type=int, help='Number of Shows fetched from the database at a time.')
+def rollup_venue_stats_command(batch_size):
+  '''Rebuilds the monthly booking statistics of all Venues from all Shows
+  New Shows update the statistics themselves, run it after deleting Shows or to fill the table initially.
+  The table is replaced in one transaction.
+  '''
+  from rollup import ShowArrays, monthly_venue_stats
+  started = time.perf_counter()
+  shows = ShowArrays()
+  result = db.session.execute(db.select([ShowHistory.c.Venue_id, ShowHistory.c.Artist_id, ShowHistory.c.start_time])
+    .where(ShowHistory.c.Venue_id.isnot(None))
+    .where(ShowHistory.c.Artist_id.isnot(None))
+    .where(ShowHistory.c.start_time.isnot(None))
+    .execution_options(stream_results=True))
+  while True:
+    rows = result.fetchmany(batch_size or app.config['EXPORT_BATCH_SIZE'])
+    if not rows:
+      break
+    shows.add(rows)
+  stats = monthly_venue_stats(*shows.arrays())
+
+  db.session.query(VenueMonthlyStats).delete()
+  bulk_insert(VenueMonthlyStats.__table__,
+    ['venue_id', 'month', 'show_count', 'distinct_artists', 'booked_days'], stats)
+  db.session.commit()
+  click.echo('Stored {} venue months in {:.1f}s'.format(len(stats), time.perf_counter() - started))
+
+@app.cli.command('geocode-venues')
+@click.option('--all', 'everything', is_flag=True, help='Geocode all Venues again, not only the ones without location.')
+@click.option('--batch-size', type=int, help='Number of cities updated per transaction.')
+def geocode_venues_command(everything, batch_size):
+  '''Stores the location of Venues from the gazetteer (GAZETTEER_FILE)
+  New & edited Venues are geocoded when they are saved, run it once to fill in the existing ones
+  and with --all after updating the gazetteer. Venues are updated city by city.
+  '''
+  table = Venue.__table__
+  pending = table.c.deleted_at.is_(None)
+  if not everything:
+    pending = db.and_(pending, table.c.geohash.is_(None))
+  areas = db.session.execute(db.select([table.c.city, table.c.state]).where(pending).distinct()).fetchall()
+  statement = (table.update()
+    .where(pending)
+    .where(table.c.city == db.bindparam('area_city'))
+    .where(table.c.state == db.bindparam('area_state')))
+  batch_size = batch_size or app.config['BULK_INSERT_BATCH_SIZE']
+  located = venues = 0
+  for start in range(0, len(areas), batch_size):
+    batch = [dict(venue_location(city, state), area_city=city, area_state=state) for city, state in areas[start:start + batch_size]]
+    # Cities missing from the gazetteer stay without location, --all clears their old one
+    batch = [area for area in batch if everything or area['geohash'] is not None]
+    located += sum(1 for area in batch if area['geohash'] is not None)
+    if batch:
+      venues += db.session.execute(statement, batch).rowcount
+      db.session.commit()
+  click.echo('Updated {} Venues, {} of {} cities found in the gazetteer'.format(venues, located, len(areas)))
+
+@app.cli.command('run-tasks')
+@click.option('--once', is_flag=True, help='Run the due tasks and exit, instead of running forever.')
+@click.option('--retry-failed', is_flag=True, help='Run the tasks that failed TASK_MAX_ATTEMPTS times again.')
+def run_tasks_command(once, retry_failed):
+  '''Runs the background tasks of the outbox (see tasks.py)
+  Server processes run them with TASK_WORKERS threads each. Run it as a process of its own
+  with TASK_WORKERS = 0, or to work off a backlog of tasks.
+  '''
+  if retry_failed:
+    table = tasks.table
+    retried = db.session.execute(table.update()
+      .where(table.c.failed_at.isnot(None))
+      .values(failed_at=None, attempts=0, run_after=func.now())).rowcount
+    db.session.commit()
+    click.echo('Retrying {} failed tasks'.format(retried))
+  while True:
+    started = time.perf_counter()
+    succeeded, failed = tasks.drain()
+    if succeeded or failed:
+      click.echo('Ran {} tasks, {} failed, in {:.1f}s'.format(succeeded + failed, failed, time.perf_counter() - started))
+    if once:
+      break
+    time.sleep(app.config['TASK_POLL_SECONDS'])
+  click.echo('Tasks: {}'.format(', '.join('{} {}'.format(number, state) for state, number in tasks.counts().items())))
+
+def insert_duplicate_keys(kind, rows):
+  '''Inserts (entity_id, key, city, state) rows of one kind with a single statement, returns their number
+  The columns are sent as arrays, millions of keys would take a round trip each with executemany.
+  '''
+  if rows:
+    entity_ids, keys, cities, states = map(list, zip(*rows))
+    db.session.execute('''INSERT INTO "DuplicateKey" (kind, entity_id, key, city, state)
+                          SELECT :kind, * FROM unnest(CAST(:entity_ids AS integer[]), CAST(:keys AS varchar[]),
+                                                      CAST(:cities AS varchar[]), CAST(:states AS varchar[]))''',
+                       {'kind': kind, 'entity_ids': entity_ids, 'keys': keys, 'cities': cities, 'states': states})
+  return len(rows)
+
+@app.cli.command('index-duplicates')
+@click.option('--batch-size', type=int, help='Number of entities read from the database at a time.')
+def index_duplicates_command(batch_size):
+  '''Rebuilds the blocking keys of duplicate detection of all Venues & Artists (see duplicates.py)
+  New & edited entities get their keys when they are saved, run it once to index the existing ones.
+  The table is replaced in one transaction.
+  '''
+  started = time.perf_counter()
+  table = DuplicateKey.__table__
+  db.session.execute(table.delete())
+  indexed = keys = 0
+  for kind, listing, model in (('venue', DUPLICATE_VENUE, Venue), ('artist', DUPLICATE_ARTIST, Artist)):
+    records = listing.iter(db.session, listing.select().where(model.deleted_at.is_(None)),
+                           batch_size or app.config['EXPORT_BATCH_SIZE'])
+    rows = []
+    for record in records:
+      city, state = area(record.city, record.state)
+      rows.extend((record.id, key, city, state) for key in blocking_keys(record.name))
+      indexed += 1
+      if len(rows) >= app.config['BULK_INSERT_BATCH_SIZE']:
+        keys += insert_duplicate_keys(kind, rows)
+        rows = []
+    keys += insert_duplicate_keys(kind, rows)
+  db.session.commit()
+  click.echo('Indexed {} Venues & Artists with {} keys in {:.1f}s'.format(indexed, keys, time.perf_counter() - started))
+
+@app.cli.command('catalog-snapshot')
+def catalog_snapshot_command():
+  '''Loads the catalog snapshot of /venues & /artists and reports its memory
+  Prints the bytes held per column and per 100k entities, as every server process holds one.
+  '''
+  catalog.get(db.session)
+  usage = catalog.memory_usage()
+  for kind, table in catalog.tables.items():
+    total = sum(usage[kind].values())
+    per_100k = total * 100000 / max(len(table), 1)
+    click.echo('{}: {} entities, {:.1f} MB, {:.1f} MB per 100k'.format(kind, len(table), total / 2 ** 20, per_100k / 2 ** 20))
+    for column, size in usage[kind].items():
+      click.echo('  {:<12}{:>12} bytes'.format(column, size))
+  click.echo('interned strings: {} ({} bytes)'.format(len(catalog.pool.strings), usage['strings']['interned']))
+
+@app.cli.command('prune-catalog-changes')
+@click.option('--days', type=int, help='Days of changes to keep.')
+def prune_catalog_changes_command(days):
+  '''Deletes old entries of the catalog change log
+  Snapshots are reloaded from scratch every CATALOG_SNAPSHOT_MAX_AGE seconds,
+  so they never need changes older than that.
+  '''
+  if days is None:
+    days = app.config['CATALOG_CHANGE_RETENTION_DAYS']
+  deleted = db.session.execute(CatalogChange.__table__.delete()
+    .where(CatalogChange.changed_at < datetime.now() - timedelta(days=days))).rowcount
+  db.session.commit()
+  click.echo('Deleted {} catalog changes'.format(deleted))
+
+# Static copies of the detail pages (see prerender.py): loader & template per kind
+DETAIL_PAGES = {
+  'venue': (venue_page, 'pages/show_venue.html'),
+  'artist': (artist_page, 'pages/show_artist.html'),
+}
+
+def render_detail_pages(pages):
+  '''Renders detail pages to PRERENDER_DIR, runs in the processes of "flask prerender"
+  * Input: list of (kind, id)
+  * Output: (number of pages written, number of pages removed)
+  Pages of deleted Venues & Artists are removed, the web server then passes their
+  requests on to the app, which answers 404.
+  '''
+  directory = app.config['PRERENDER_DIR']
+  written = removed = 0
+  for kind, entity_id in pages:
+    load, template = DETAIL_PAGES[kind]
+    # Rendered as a request of the page, so the templates see the same request.endpoint
+    with app.test_request_context('/{}s/{}'.format(kind, entity_id)):
+      # Read from the primary, like the change log
+      g.db_replica = None
+      entity = load(entity_id)
+      path = page_path(directory, kind, entity_id)
+      if entity is None:
+        removed += remove_file(path)
+      else:
+        write_file(path, render_template(template, **{kind: entity}))
+        written += 1
+  return written, removed
+
+def touched_pages(manifest, now):
+  '''Returns the detail pages that changed since the build of <manifest>
+  * Input: manifest of the previous build, <datetime> start of this build
+  * Output: set of (kind, id), last change id & missing change ids for the next manifest
+  '''
+  # Step 1: Venues & Artists created, edited, deleted or booked for new Shows
+  changes, version, gaps = read_changes(db.session, CatalogChange.__table__, manifest['version'], manifest['gaps'],
+    gap_seconds=app.config['PRERENDER_GAP_SECONDS'])
+  changed = {'venue': set(), 'artist': set()}
+  for change_id, kind, entity_id in changes:
+    changed[kind].add(entity_id)
+  pages = {(kind, entity_id) for kind, entity_ids in changed.items() for entity_id in entity_ids}
+
+  # Step 2: Pages showing the name or image of a changed Venue or Artist,
+  # in their list of Shows or of similar Venues & Artists
+  for kind, other, column, other_column in (('venue', 'artist', 'Venue_id', 'Artist_id'),
+                                            ('artist', 'venue', 'Artist_id', 'Venue_id')):
+    if not changed[kind]:
+      continue
+    played = (db.session.query(ShowHistory.c[other_column])
+      .filter(ShowHistory.c[column].in_(changed[kind]))
+      .distinct())
+    pages.update((other, entity_id) for entity_id, in played)
+    similar = (db.session.query(Recommendation.entity_id)
+      .filter(Recommendation.kind == kind)
+      .filter(Recommendation.similar_id.in_(changed[kind])))
+    pages.update((kind, entity_id) for entity_id, in similar)
+
+  # Step 3: Pages of Shows that started since, they moved from upcoming to past Shows
+  started = (db.session.query(ShowHistory.c.Venue_id, ShowHistory.c.Artist_id)
+    .filter(ShowHistory.c.start_time > dateutil.parser.parse(manifest['built_at']))
+    .filter(ShowHistory.c.start_time <= now)
+    .distinct())
+  for venue_id, artist_id in started:
+    pages.add(('venue', venue_id))
+    pages.add(('artist', artist_id))
+  return pages, version, gaps
+
+@app.cli.command('prerender')
+@click.option('--full', is_flag=True, help='Render all pages, not only the ones changed since the last build.')
+@click.option('--processes', type=int, help='Number of processes rendering pages, default: number of CPUs.')
+def prerender_command(full, processes):
+  '''Renders the detail pages of Venues & Artists to static files in PRERENDER_DIR
+  Only the pages changed since the last build are rendered, unless --full is given
+  or there was no build yet. Run it every minute, e.g. by cron.
+  '''
+  directory = app.config['PRERENDER_DIR']
+  processes = processes or app.config['PRERENDER_PROCESSES'] or os.cpu_count()
+  manifest = None if full else load_manifest(directory)
+  started = time.perf_counter()
+
+  # Step 1: Pages to render. Changes from now on are left to the next build.
+  now = datetime.now()
+  stale = set()
+  if manifest is None:
+    # Changes of transactions still running are missing below version, they are read next time
+    version, gaps = last_change(db.session, CatalogChange.__table__)
+    pages = {(kind, entity_id) for kind, (model, column) in (('venue', (Venue, Venue.id)), ('artist', (Artist, Artist.id)))
+             for entity_id, in db.session.query(column).filter(model.deleted_at.is_(None))}
+    # Pages of Venues & Artists deleted since
+    stale = {(kind, entity_id) for kind in DETAIL_PAGES for entity_id in rendered_ids(directory, kind)} - pages
+  else:
+    pages, version, gaps = touched_pages(manifest, now)
+
+  # Step 2: Render the pages in a pool of processes, each opening its own database connections
+  db.session.remove()
+  db.get_engine(app).dispose()
+  written, removed = run_pool(render_detail_pages, sorted(pages), processes, app.config['PRERENDER_CHUNK_SIZE']) or (0, 0)
+  removed += sum(remove_file(page_path(directory, kind, entity_id)) for kind, entity_id in stale)
+
+  # Step 3: The next build continues from here
+  save_manifest(directory, {'version': version, 'gaps': gaps, 'built_at': now.isoformat()})
+  click.echo('{} build: rendered {} pages, removed {} in {:.1f}s'.format(
+    'Full' if manifest is None else 'Incremental', written, removed, time.perf_counter() - started))
+
+@app.cli.command('profile-token')
+@click.argument('path')
+def profile_token_command(path):
+  '''Prints the header that profiles requests to PATH, e.g. /venues/1
+  The signature is made with SECRET_KEY, so it is only valid for servers sharing that key.
+  '''
+  click.echo('{}: {}'.format(app.config['PROFILE_HEADER'], sign_path(app.config['SECRET_KEY'], path)))
+
 #----------------------------------------------------------------------------#
 # Launch.
 #----------------------------------------------------------------------------#
 
+# Templates rendered by the busiest pages, compiled ahead of the first request
+WARM_UP_TEMPLATES = (
+  'pages/home.html', 'pages/venues.html', 'pages/artists.html', 'pages/shows.html',
+  'pages/show_venue.html', 'pages/show_artist.html', 'forms/new_show.html')
+
+def warm_up(connections=1):
+  '''Prepares a server process before it accepts requests
+  * Input: <int> connections, number of database connections to open per engine
+  Compiles templates, fills the Venue & Artist caches & the catalog snapshot and opens connections to the
+  primary and every read replica, so the first requests don't pay for it. Starts the background task workers.
+  Used by serve.py in every worker process.
+  '''
+  for template in WARM_UP_TEMPLATES:
+    app.jinja_env.get_template(template)
+  with app.app_context():
+    get_catalog_names(Venue)
+    get_catalog_names(Artist)
+    catalog.get(db.session)
+    db.session.remove()
+    engines = [db.get_engine(app)]
+    engines += [db.get_engine(app, bind=replica) for replica in db.replicas if db.replica_available(replica)]
+    for engine in engines:
+      opened = [engine.connect() for number in range(connections)]
+      for connection in opened:
+        connection.close()
+  tasks.start_workers()
+
 # Default port:
+# Development server only, use "python serve.py" in production
 if __name__ == '__main__':
     app.run()
 
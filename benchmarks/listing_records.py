@@ -0,0 +1,90 @@
+"""
+Compares ways of loading a 100k row listing for a template
+
+    $ python benchmarks/listing_records.py --rows 100000
+
+Inserts <rows> Artists into the database of config.py (or DATABASE_URL)
+inside a transaction that is rolled back at the end, then loads them as
+    - ORM objects converted with the former object_as_dict()
+    - selected columns converted with the former get_dict_list_from_result()
+    - records of records.py
+Prints the time per load and the memory held by the loaded rows.
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import inspect
+from app import app, db, Artist
+from records import RecordType
+
+COLUMNS = ('id', 'name', 'city', 'state', 'image_link')
+
+
+def orm_dicts():
+    return [{c.key: getattr(artist, c.key) for c in inspect(artist).mapper.column_attrs}
+            for artist in Artist.query.all()]
+
+
+def column_dicts():
+    return [row._asdict() for row in db.session.query(*(getattr(Artist, column) for column in COLUMNS))]
+
+
+def records():
+    return LISTING.all(db.session, LISTING.select())
+
+
+LISTING = RecordType.for_model('ArtistBenchmark', Artist, *COLUMNS)
+LOADERS = (
+    ('ORM + object_as_dict', orm_dicts),
+    ('columns + _asdict', column_dicts),
+    ('records', records),
+)
+
+
+def measure(loader, repeat):
+    timings = []
+    for number in range(repeat):
+        db.session.expunge_all()
+        started = time.perf_counter()
+        loader()
+        timings.append(time.perf_counter() - started)
+    db.session.expunge_all()
+    tracemalloc.start()
+    rows = loader()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del rows
+    return min(timings), held
+
+
+@click.command()
+@click.option('--rows', type=int, default=100000, show_default=True, help='Number of Artists to list.')
+@click.option('--repeat', type=int, default=3, show_default=True, help='Timed loads per strategy, the best one counts.')
+def benchmark(rows, repeat):
+    '''Measures time & memory of loading listings'''
+    with app.app_context():
+        db.session.execute(Artist.__table__.insert().from_select(
+            ['name', 'city', 'state', 'genres', 'image_link', 'seeking_venue'],
+            db.select([
+                db.literal('Artist ') + db.cast(db.func.generate_series(1, rows), db.String),
+                db.literal('San Francisco'), db.literal('CA'), db.literal('{Jazz}'),
+                db.literal('https://images.unsplash.com/photo-1549213783-8284d0336c4f'), db.false()])))
+        try:
+            total = db.session.query(db.func.count(Artist.id)).scalar()
+            click.echo('{} Artists'.format(total))
+            click.echo('{:<24}{:>12}{:>14}'.format('loader', 'ms', 'MB held'))
+            for name, loader in LOADERS:
+                seconds, held = measure(loader, repeat)
+                click.echo('{:<24}{:>12.0f}{:>14.1f}'.format(name, seconds * 1000, held / 2 ** 20))
+        finally:
+            db.session.rollback()
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,107 @@
+"""
+Compares the throughput of the development server ("python app.py") with
+the production server ("python serve.py")
+
+    $ python benchmarks/serve_throughput.py --duration 10 --concurrency 16
+
+Both servers are started with the database of config.py (or DATABASE_URL)
+and get the same requests from <concurrency> keep-alive clients for
+<duration> seconds. Prints requests per second and latency percentiles.
+"""
+
+import http.client
+import os
+import subprocess
+import sys
+import threading
+import time
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PATHS = ('/', '/venues', '/artists', '/shows')
+
+
+def start_server(command, port):
+    server = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/')
+            connection.getresponse().read()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise click.ClickException('Server "{}" did not start'.format(' '.join(command)))
+
+
+def run_clients(port, duration, concurrency):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.time() + duration
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        measured = []
+        number = 0
+        while time.time() < stop_at:
+            started = time.perf_counter()
+            try:
+                connection.request('GET', PATHS[number % len(PATHS)])
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    raise http.client.HTTPException(response.status)
+                measured.append(time.perf_counter() - started)
+            except (OSError, http.client.HTTPException):
+                with lock:
+                    errors[0] += 1
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            number += 1
+        with lock:
+            latencies.extend(measured)
+
+    threads = [threading.Thread(target=client) for number in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return latencies, errors[0]
+
+
+def percentile(latencies, share):
+    if not latencies:
+        return float('nan')
+    return latencies[min(len(latencies) - 1, int(len(latencies) * share))] * 1000
+
+
+@click.command()
+@click.option('--duration', type=int, default=10, show_default=True, help='Seconds of load per server.')
+@click.option('--concurrency', type=int, default=16, show_default=True, help='Concurrent clients.')
+@click.option('--workers', type=int, default=4, show_default=True, help='Workers of serve.py.')
+@click.option('--threads', type=int, default=4, show_default=True, help='Threads per worker of serve.py.')
+def benchmark(duration, concurrency, workers, threads):
+    '''Measures requests per second of the development and the production server'''
+    servers = (
+        ('python app.py', [sys.executable, '-c', 'from app import app; app.run(port=5101, use_reloader=False)'], 5101),
+        ('python serve.py', [sys.executable, 'serve.py', '--bind', '127.0.0.1:5102',
+                             '--workers', str(workers), '--threads', str(threads)], 5102),
+    )
+    click.echo('{:<18}{:>10}{:>10}{:>10}{:>10}'.format('server', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    for name, command, port in servers:
+        server = start_server(command, port)
+        try:
+            latencies, errors = run_clients(port, duration, concurrency)
+        finally:
+            server.terminate()
+            server.wait()
+        click.echo('{:<18}{:>10.1f}{:>10.1f}{:>10.1f}{:>10}'.format(
+            name, len(latencies) / duration, percentile(latencies, 0.5), percentile(latencies, 0.99), errors))
+
+
+if __name__ == '__main__':
+    benchmark()
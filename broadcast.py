@@ -0,0 +1,219 @@
+"""
+Live updates with Server-Sent Events
+
+New Shows are announced with a Postgres NOTIFY in the transaction that
+inserts them, so the announcement is only delivered if the insert commits.
+Every server process runs one listener thread (started with its first
+subscriber) that receives the notifications and hands them to the
+BroadcastHub of that process. The hub puts every event into the queue of
+each subscribed client whose filter matches, and the SSE responses send
+the events from their queues.
+
+    - a client too slow to keep up (full queue) is disconnected, browsers
+      reconnect by themselves and get the missed events replayed from a
+      short history by their Last-Event-ID
+    - each open stream occupies one server thread, so the number of
+      subscribers per process is capped (SSE_MAX_SUBSCRIBERS) and streams
+      end after SSE_MAX_DURATION seconds (browsers reconnect)
+"""
+
+import json
+import queue
+import select
+import threading
+import time
+from collections import deque
+from flask import Response, request
+from sqlalchemy import Sequence, func, select as sql_select
+
+
+class Subscription(object):
+    """
+    Queue of events for one client, with the filter its events must match
+    """
+    def __init__(self, filters, size):
+        self.filters = filters
+        self.queue = queue.Queue(maxsize=size)
+        self.closed = False
+
+    def matches(self, event):
+        for key, value in self.filters.items():
+            if value is None:
+                continue
+            actual = event.get(key)
+            # Text, e.g. a city, matches case-insensitively
+            if isinstance(value, str) and isinstance(actual, str):
+                actual, value = actual.lower(), value.lower()
+            if actual != value:
+                return False
+        return True
+
+
+class BroadcastHub(object):
+    """
+    Fans out events to all matching subscriptions of this process
+    """
+    def __init__(self, max_subscribers=100, queue_size=100, history=200):
+        self.lock = threading.Lock()
+        self.subscriptions = set()
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self.history = deque(maxlen=history)
+
+    def subscribe(self, filters):
+        '''Returns a new Subscription, None when the process has max_subscribers already'''
+        with self.lock:
+            if len(self.subscriptions) >= self.max_subscribers:
+                return None
+            subscription = Subscription(filters, self.queue_size)
+            self.subscriptions.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def publish(self, event):
+        '''Hands <event> to all matching subscriptions, never blocks
+        <event> is a dict with an increasing 'id', the same in all processes, and a 'type'.
+        '''
+        with self.lock:
+            self.history.append(event)
+            for subscription in list(self.subscriptions):
+                if not subscription.matches(event):
+                    continue
+                try:
+                    subscription.queue.put_nowait(event)
+                except queue.Full:
+                    # Too slow, drop it. The browser reconnects and catches up from the history.
+                    self.subscriptions.discard(subscription)
+                    subscription.closed = True
+
+    def missed(self, subscription, last_event_id):
+        '''Events of the history after <last_event_id> matching the subscription'''
+        with self.lock:
+            return [event for event in self.history
+                    if event['id'] > last_event_id and subscription.matches(event)]
+
+    def stream(self, subscription, last_event_id=None, keepalive=15, max_duration=300):
+        '''Yields the subscription as text/event-stream, until max_duration or the client leaves'''
+        try:
+            # Reconnecting browsers wait 3 seconds before reconnecting
+            yield 'retry: 3000\n\n'
+            sent = last_event_id or 0
+            if last_event_id is not None:
+                for event in self.missed(subscription, last_event_id):
+                    sent = event['id']
+                    yield format_event(event)
+            ends_at = time.monotonic() + max_duration
+            while not subscription.closed and time.monotonic() < ends_at:
+                try:
+                    event = subscription.queue.get(timeout=keepalive)
+                except queue.Empty:
+                    # Comment line, keeps proxies from closing the idle connection
+                    yield ': keepalive\n\n'
+                    continue
+                # Already sent from the history
+                if event['id'] <= sent:
+                    continue
+                yield format_event(event)
+        finally:
+            self.unsubscribe(subscription)
+
+
+def format_event(event):
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(event['id'], event['type'], json.dumps(event))
+
+
+class NotifyListener(threading.Thread):
+    """
+    Publishes the Postgres notifications of <channel> to <hub>, reconnects after errors
+    """
+    def __init__(self, engine, channel, hub, logger):
+        super(NotifyListener, self).__init__(daemon=True, name='notify-' + channel)
+        self.engine = engine
+        self.channel = channel
+        self.hub = hub
+        self.logger = logger
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                self.logger.exception('Listening to %s failed, reconnecting', self.channel)
+                time.sleep(5)
+
+    def listen(self):
+        # A connection of its own, outside of the pool, in autocommit mode for LISTEN
+        connection = self.engine.raw_connection()
+        connection.detach()
+        dbapi_connection = connection.connection
+        try:
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute('LISTEN "{}"'.format(self.channel))
+            while True:
+                if select.select([dbapi_connection], [], [], 60) == ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notify = dbapi_connection.notifies.pop(0)
+                    self.hub.publish(json.loads(notify.payload))
+        finally:
+            connection.close()
+
+
+class LiveEvents(object):
+    """
+    Flask extension publishing events to SSE clients of all server processes
+    """
+    def __init__(self, app=None, db=None):
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        app.config.setdefault('SSE_CHANNEL', 'fyyur_events')
+        app.config.setdefault('SSE_MAX_SUBSCRIBERS', 100)
+        app.config.setdefault('SSE_QUEUE_SIZE', 100)
+        app.config.setdefault('SSE_HISTORY', 200)
+        app.config.setdefault('SSE_KEEPALIVE', 15)
+        app.config.setdefault('SSE_MAX_DURATION', 300)
+        self.app = app
+        self.db = db
+        self.channel = app.config['SSE_CHANNEL']
+        # Event ids, increasing across all processes, so Last-Event-ID works on any of them
+        self.sequence = Sequence(self.channel + '_id_seq', metadata=db.Model.metadata)
+        self.hub = BroadcastHub(app.config['SSE_MAX_SUBSCRIBERS'], app.config['SSE_QUEUE_SIZE'],
+                                app.config['SSE_HISTORY'])
+        self.listener = None
+        self.lock = threading.Lock()
+
+    def notify(self, event_type, **data):
+        '''Announces an event once the transaction of the session commits'''
+        session = self.db.session
+        event_id = session.execute(sql_select([func.nextval(self.sequence.name)])).scalar()
+        payload = json.dumps(dict(data, id=event_id, type=event_type), default=str)
+        session.execute(sql_select([func.pg_notify(self.channel, payload)]))
+
+    def start_listener(self):
+        with self.lock:
+            if self.listener is None:
+                self.listener = NotifyListener(self.db.engine, self.channel, self.hub, self.app.logger)
+                self.listener.start()
+
+    def response(self, **filters):
+        '''text/event-stream Response with the events matching <filters> (None matches all)'''
+        self.start_listener()
+        subscription = self.hub.subscribe(filters)
+        if subscription is None:
+            return Response('Too many live connections, please try again later.', status=503,
+                            headers={'Retry-After': '30'}, mimetype='text/plain')
+        last_event_id = request.headers.get('Last-Event-ID', type=int)
+        stream = self.hub.stream(subscription, last_event_id,
+                                 self.app.config['SSE_KEEPALIVE'], self.app.config['SSE_MAX_DURATION'])
+        return Response(stream, mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            # Tells nginx not to buffer the stream
+            'X-Accel-Buffering': 'no',
+        })
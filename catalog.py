@@ -0,0 +1,362 @@
+"""
+Columnar snapshot of the Venue & Artist catalog
+
+Every server process keeps the columns of the list pages (/venues, /artists)
+in numpy arrays instead of querying them on every request:
+    - ids as a sorted int64 array, names as an array of str
+    - cities & states as int32 codes of interned strings (StringPool), a city
+      is stored once however many entities are located there
+    - genres as bitmasks, one bit per genre (GenreBits)
+    - optionally latitude & longitude as float64, NaN if unknown, searchable
+      with a KD-tree built on first use (see geo.KDTree)
+Filtering by city, state & genre, sorting and grouping by area are numpy
+operations on these arrays, no per-entity Python code runs before the rows
+of the page are built.
+
+Inserts, updates & deletes of Venues & Artists are recorded in a change log
+table by database triggers (see CatalogChange in app.py). Its increasing id
+is the change counter: a refresh reads the changes after the last id it has
+seen and reloads only the entities they name. Ids missing in between belong
+to transactions that had not committed yet (or rolled back), they are read
+again on the following refreshes for GAP_SECONDS. A full load looks for
+missing ids among the last MAX_GAPS ids of the log (see last_change).
+
+    catalog = CatalogSnapshot(CatalogChange.__table__, {'venue': (CATALOG_VENUE, Venue)})
+    venues = catalog.get(db.session)['venue']
+    rows = venues.where(state='CA', genre='Jazz')
+
+Tables are never changed once built, a refresh builds new ones and swaps
+them in, so requests running during a refresh keep a consistent view.
+"""
+
+import sys
+import threading
+import time
+import numpy as np
+from sqlalchemy import func, or_, select
+from geo import KDTree
+
+# Ids missing from the change log are looked up again for this many seconds
+GAP_SECONDS = 60
+# More missing ids or changes than this and the whole snapshot gets reloaded instead
+MAX_GAPS = 1000
+MAX_CHANGES = 10000
+
+
+def read_changes(session, changes, version, gaps, gap_seconds=GAP_SECONDS):
+    '''Reads the change log after <version>, plus the ids of <gaps> that committed since
+    * Input: change log Table, last id seen, dict of missing id -> time.time() it was first missed,
+      seconds a missing id is looked for
+    * Output: list of (id, kind, entity_id), new last id seen, new gaps
+    '''
+    now = time.time()
+    condition = changes.c.id > version
+    if gaps:
+        condition = or_(condition, changes.c.id.in_(list(gaps)))
+    rows = session.execute(select([changes.c.id, changes.c.kind, changes.c.entity_id]).where(condition)).fetchall()
+    gaps = dict(gaps)
+    seen = {change_id for change_id, kind, entity_id in rows}
+    for change_id in seen:
+        gaps.pop(change_id, None)
+    if seen:
+        latest = max(seen)
+        for change_id in range(version + 1, latest):
+            if change_id not in seen:
+                gaps[change_id] = now
+        version = max(version, latest)
+    gaps = {change_id: since for change_id, since in gaps.items() if now - since < gap_seconds}
+    return rows, version, gaps
+
+
+def last_change(session, changes):
+    '''Last id of the change log, plus the ids missing among its last MAX_GAPS ids
+    * Input: change log Table
+    * Output: last id, dict of missing id -> time.time()
+    A missing id may belong to a transaction still running, which commits after the
+    last id was read. Returned as gaps, it is read again like the gaps of read_changes().
+    '''
+    version = session.execute(select([func.coalesce(func.max(changes.c.id), 0)])).scalar()
+    low = max(version - MAX_GAPS, 0)
+    seen = {change_id for change_id, in session.execute(
+        select([changes.c.id]).where(changes.c.id > low).where(changes.c.id <= version))}
+    now = time.time()
+    return version, {change_id: now for change_id in range(low + 1, version) if change_id not in seen}
+
+
+class StringPool(object):
+    """
+    Interned strings, each distinct string gets an int32 code that never changes
+    """
+    def __init__(self):
+        self.codes = {}
+        self.strings = []
+        # Codes by string in lower case without surrounding spaces, for matching()
+        self.folded = {}
+
+    def code(self, string):
+        code = self.codes.get(string)
+        if code is None:
+            code = self.codes[string] = len(self.strings)
+            self.strings.append(string)
+            self.folded.setdefault(string.strip().lower(), []).append(code)
+        return code
+
+    def encode(self, strings):
+        '''Codes of <strings>, None is stored as an empty string'''
+        return np.array([self.code(string or '') for string in strings], dtype=np.int32)
+
+    def matching(self, string):
+        '''Codes of all strings equal to <string> ignoring case & surrounding spaces'''
+        return np.array(self.folded.get(string.strip().lower(), ()), dtype=np.int32)
+
+    def ranks(self):
+        '''Position of every code in the alphabetical order of the strings'''
+        strings = list(self.strings)
+        ranks = np.empty(len(strings), dtype=np.int32)
+        ranks[sorted(range(len(strings)), key=strings.__getitem__)] = np.arange(len(strings), dtype=np.int32)
+        return ranks
+
+    def memory_usage(self):
+        return (sys.getsizeof(self.codes) + sys.getsizeof(self.strings) + sum(map(sys.getsizeof, self.strings))
+                + sys.getsizeof(self.folded) + sum(map(sys.getsizeof, self.folded.values())))
+
+
+class GenreBits(object):
+    """
+    Bit of every genre, the genres of an entity are stored as a row of uint64 words
+    """
+    def __init__(self):
+        self.bits = {}
+
+    @property
+    def words(self):
+        return max(1, (len(self.bits) + 63) // 64)
+
+    def encode(self, genre_lists):
+        '''(entities × words) bitmasks of <genre_lists>, new genres get the next free bit'''
+        for genres in genre_lists:
+            for genre in genres or ():
+                self.bits.setdefault(genre, len(self.bits))
+        masks = np.zeros((len(genre_lists), self.words), dtype=np.uint64)
+        for row, genres in enumerate(genre_lists):
+            for genre in genres or ():
+                bit = self.bits[genre]
+                masks[row, bit // 64] |= np.uint64(1 << (bit % 64))
+        return masks
+
+    def mask(self, genre):
+        '''(word, bit value) of <genre>, None for genres nobody has'''
+        bit = self.bits.get(genre)
+        if bit is None:
+            return None
+        return bit // 64, np.uint64(1 << (bit % 64))
+
+
+def pad_words(masks, words):
+    '''<masks> with zero words appended up to <words> columns'''
+    if masks.shape[1] >= words:
+        return masks
+    return np.hstack([masks, np.zeros((masks.shape[0], words - masks.shape[1]), dtype=np.uint64)])
+
+
+class ColumnarTable(object):
+    """
+    Columns of one kind of entity (Venues or Artists), ordered by id
+    """
+    def __init__(self, ids, names, cities, states, genres, pool, genre_bits, locations=None):
+        self.ids = ids
+        self.names = names
+        self.cities = cities
+        self.states = states
+        self.genres = genres
+        self.pool = pool
+        self.genre_bits = genre_bits
+        # (entities × 2) latitudes & longitudes, None for records without location
+        self.locations = locations
+        self.tree = None
+        # Rows sorted by city, state & id, computed once per table for the area listing
+        ranks = pool.ranks()
+        self.area_order = np.lexsort((ids, ranks[states], ranks[cities])) if len(ids) else np.zeros(0, dtype=np.int64)
+
+    @classmethod
+    def from_rows(cls, rows, pool, genre_bits):
+        '''Table of records with id, name, city, state & genres, optionally followed by latitude & longitude'''
+        if not rows:
+            return cls(np.zeros(0, dtype=np.int64), np.empty(0, dtype=object), np.zeros(0, dtype=np.int32),
+                       np.zeros(0, dtype=np.int32), np.zeros((0, genre_bits.words), dtype=np.uint64),
+                       pool, genre_bits)
+        ids, names, cities, states, genres, *coordinates = zip(*rows)
+        ids = np.array(ids, dtype=np.int64)
+        order = np.argsort(ids, kind='stable')
+        names_array = np.empty(len(names), dtype=object)
+        names_array[:] = names
+        # None becomes NaN
+        locations = np.array(coordinates[:2], dtype=np.float64).T[order] if coordinates else None
+        return cls(ids[order], names_array[order], pool.encode(cities)[order], pool.encode(states)[order],
+                   genre_bits.encode(genres)[order], pool, genre_bits, locations)
+
+    def replace(self, changed_ids, rows):
+        '''New table without the entities of <changed_ids>, plus <rows> (their current version)
+        Entities of <changed_ids> missing from <rows> were deleted.
+        '''
+        added = ColumnarTable.from_rows(rows, self.pool, self.genre_bits)
+        keep = ~np.isin(self.ids, np.asarray(changed_ids, dtype=np.int64))
+        words = self.genre_bits.words
+        ids = np.concatenate([self.ids[keep], added.ids])
+        order = np.argsort(ids, kind='stable')
+        locations = None
+        if self.locations is not None or added.locations is not None:
+            locations = np.vstack([self.location_rows()[keep], added.location_rows()])[order]
+        return ColumnarTable(
+            ids[order],
+            np.concatenate([self.names[keep], added.names])[order],
+            np.concatenate([self.cities[keep], added.cities])[order],
+            np.concatenate([self.states[keep], added.states])[order],
+            np.vstack([pad_words(self.genres[keep], words), pad_words(added.genres, words)])[order],
+            self.pool, self.genre_bits, locations)
+
+    def location_rows(self):
+        '''(entities × 2) latitudes & longitudes, NaN for tables without locations'''
+        if self.locations is None:
+            return np.full((len(self.ids), 2), np.nan)
+        return self.locations
+
+    def kdtree(self):
+        '''geo.KDTree of the locations, built on first use'''
+        if self.tree is None:
+            locations = self.location_rows()
+            self.tree = KDTree(self.ids, locations[:, 0], locations[:, 1])
+        return self.tree
+
+    def __len__(self):
+        return len(self.ids)
+
+    def where(self, city=None, state=None, genre=None):
+        '''Boolean mask of the rows matching all given filters
+        * Input: city (ignoring case), state & genre, None or '' match everything
+        '''
+        mask = np.ones(len(self.ids), dtype=bool)
+        if city:
+            mask &= np.isin(self.cities, self.pool.matching(city))
+        if state:
+            mask &= self.states == self.pool.codes.get(state, -1)
+        if genre:
+            bit = self.genre_bits.mask(genre)
+            if bit is None or bit[0] >= self.genres.shape[1]:
+                mask[:] = False
+            else:
+                mask &= (self.genres[:, bit[0]] & bit[1]) != 0
+        return mask
+
+    def areas(self, mask):
+        '''Yields (city, state, row positions) of the rows in <mask>, grouped by area
+        Areas are ordered by city & state, the rows of an area by id.
+        '''
+        order = self.area_order[mask[self.area_order]]
+        if not len(order):
+            return
+        cities = self.cities[order]
+        states = self.states[order]
+        starts = np.flatnonzero(np.concatenate([[True], (cities[1:] != cities[:-1]) | (states[1:] != states[:-1])]))
+        ends = np.append(starts[1:], len(order))
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            yield self.pool.strings[cities[start]], self.pool.strings[states[start]], order[start:end]
+
+    def memory_usage(self):
+        '''Bytes held per column, names include the str objects they point to'''
+        return {
+            'ids': self.ids.nbytes,
+            'names': self.names.nbytes + sum(map(sys.getsizeof, self.names)),
+            'cities': self.cities.nbytes,
+            'states': self.states.nbytes,
+            'genres': self.genres.nbytes,
+            'area_order': self.area_order.nbytes,
+            'locations': self.locations.nbytes if self.locations is not None else 0,
+        }
+
+
+class CatalogSnapshot(object):
+    """
+    Columnar tables of the catalog, kept up to date from the change log
+    """
+    def __init__(self, changes, sources, check_seconds=1, max_age=3600):
+        '''<changes>: change log Table with id, kind & entity_id
+        <sources>: dict kind -> (RecordType with id, name, city, state & genres, model)
+        '''
+        self.changes = changes
+        self.sources = sources
+        self.check_seconds = check_seconds
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.pool = StringPool()
+        self.genre_bits = GenreBits()
+        self.tables = None
+        self.version = None
+        self.gaps = {}
+        self.checked_at = 0
+        self.loaded_at = 0
+
+    def expire(self):
+        '''The next get() looks for changes, whenever the last check was'''
+        self.checked_at = 0
+
+    def get(self, session):
+        '''Tables by kind, refreshed first if the last check is older than check_seconds
+        Only one thread refreshes at a time, the others keep using the current tables.
+        '''
+        if self.tables is None or time.monotonic() - self.checked_at >= self.check_seconds:
+            if self.lock.acquire(blocking=self.tables is None):
+                try:
+                    if self.tables is None or time.monotonic() - self.checked_at >= self.check_seconds:
+                        self.refresh(session)
+                finally:
+                    self.lock.release()
+        return self.tables
+
+    def load(self, session):
+        '''Loads all entities, used for the first load and every max_age seconds'''
+        version, gaps = last_change(session, self.changes)
+        self.pool = StringPool()
+        self.genre_bits = GenreBits()
+        tables = {}
+        for kind, (record, model) in self.sources.items():
+            statement = record.select().where(model.deleted_at.is_(None))
+            tables[kind] = ColumnarTable.from_rows(list(record.iter(session, statement)), self.pool, self.genre_bits)
+        self.tables = tables
+        self.version = version
+        self.gaps = gaps
+        self.checked_at = self.loaded_at = time.monotonic()
+
+    def refresh(self, session):
+        '''Applies the changes since the last refresh'''
+        now = time.monotonic()
+        if self.tables is None or now - self.loaded_at >= self.max_age:
+            return self.load(session)
+
+        # Step 1: Changes after the last one seen, and the ones missing before it
+        changes, self.version, self.gaps = read_changes(session, self.changes, self.version, self.gaps)
+        if len(self.gaps) > MAX_GAPS or len(changes) > MAX_CHANGES:
+            return self.load(session)
+
+        # Step 2: Reload the changed entities, deleted ones are not found and get dropped
+        changed = {}
+        for change_id, kind, entity_id in changes:
+            changed.setdefault(kind, set()).add(entity_id)
+        tables = dict(self.tables)
+        for kind, entity_ids in changed.items():
+            if kind not in self.sources:
+                continue
+            record, model = self.sources[kind]
+            entity_ids = sorted(entity_ids)
+            rows = record.all(session, record.select()
+                              .where(model.deleted_at.is_(None))
+                              .where(model.id.in_(entity_ids)))
+            tables[kind] = tables[kind].replace(entity_ids, rows)
+        self.tables = tables
+        self.checked_at = now
+
+    def memory_usage(self):
+        '''Bytes held per kind & column, plus the interned strings'''
+        usage = {kind: table.memory_usage() for kind, table in self.tables.items()}
+        usage['strings'] = {'interned': self.pool.memory_usage()}
+        return usage
@@ -0,0 +1,124 @@
+"""
+WSGI middleware compressing responses with brotli or gzip
+
+Responses are compressed when the client accepts it, the content type is
+compressible and the body is at least COMPRESS_MIN_SIZE bytes. Streamed
+responses (no Content-Length) are always compressed and flushed chunk by
+chunk, so the browser still receives the page progressively.
+Brotli is used if the optional "brotli" package is installed.
+"""
+
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'text/javascript',
+    'application/javascript', 'application/json', 'image/svg+xml',
+)
+
+
+def accepted_encodings(header):
+    '''Returns the content codings of an Accept-Encoding header, without those with q=0'''
+    encodings = set()
+    for item in header.split(','):
+        name, _, params = item.strip().partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+class _GzipEncoder(object):
+    def __init__(self, level):
+        # wbits 16 + 15: gzip header & trailer
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def process(self, chunk):
+        return self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+class _BrotliEncoder(object):
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=min(level, 11))
+
+    def process(self, chunk):
+        return self.compressor.process(chunk) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class CompressionMiddleware(object):
+    """
+    Wraps a WSGI app, e.g. app.wsgi_app = CompressionMiddleware(app.wsgi_app)
+    """
+    def __init__(self, wsgi_app, minimum_size=1024, level=6):
+        self.wsgi_app = wsgi_app
+        self.minimum_size = minimum_size
+        self.level = level
+
+    def choose_encoding(self, environ):
+        accepted = accepted_encodings(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if brotli is not None and 'br' in accepted:
+            return 'br'
+        if 'gzip' in accepted:
+            return 'gzip'
+        return None
+
+    def __call__(self, environ, start_response):
+        encoding = self.choose_encoding(environ)
+        if encoding is None or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.wsgi_app(environ, start_response)
+        compress = []
+
+        def compressing_start_response(status, headers, exc_info=None):
+            if self.should_compress(status, headers):
+                compress.append(True)
+                headers = [(name, value) for name, value in headers if name.lower() != 'content-length']
+                headers = [(name, 'W/' + value if name.lower() == 'etag' and not value.startswith('W/') else value)
+                           for name, value in headers]
+                headers.append(('Content-Encoding', encoding))
+                headers.append(('Vary', 'Accept-Encoding'))
+            return start_response(status, headers, exc_info)
+
+        app_iter = self.wsgi_app(environ, compressing_start_response)
+        if not compress:
+            return app_iter
+        return self.compressed(app_iter, encoding)
+
+    def should_compress(self, status, headers):
+        if not status.startswith('200'):
+            return False
+        headers = {name.lower(): value for name, value in headers}
+        if 'content-encoding' in headers:
+            return False
+        content_type = headers.get('content-type', '').split(';')[0].strip().lower()
+        if content_type not in COMPRESSIBLE_TYPES:
+            return False
+        length = headers.get('content-length')
+        return length is None or int(length) >= self.minimum_size
+
+    def compressed(self, app_iter, encoding):
+        encoder = _BrotliEncoder(self.level) if encoding == 'br' else _GzipEncoder(self.level)
+        try:
+            for chunk in app_iter:
+                if chunk:
+                    data = encoder.process(chunk)
+                    if data:
+                        yield data
+            yield encoder.finish()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
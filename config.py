@@ -1,11 +1,129 @@
 import os
-SECRET_KEY = os.urandom(32)
+# All processes serving the app need the same key (serve.py sets FYYUR_SECRET_KEY for its workers)
+SECRET_KEY = os.environ.get('FYYUR_SECRET_KEY') or os.urandom(32)
 # Grabs the folder where the script runs.
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-# Enable debug mode.
-DEBUG = True
+# Enable debug mode. serve.py turns it off with FYYUR_DEBUG=false
+DEBUG = os.environ.get('FYYUR_DEBUG', 'true').lower() == 'true'
 
 # Connect to the database
 # TODO: IMPLEMENT DATABASE URL
-SQLALCHEMY_DATABASE_URI = 'postgresql://rui@localhost:5432/fyyur'
+SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql://rui@localhost:5432/fyyur')
+
+# Read replicas of the database above. GET requests read from them (see routing.py)
+# e.g. ['postgresql://rui@localhost:5433/fyyur']
+SQLALCHEMY_REPLICAS = []
+# Seconds a client keeps reading from the primary after submitting a write
+SQLALCHEMY_REPLICA_STICKY_SECONDS = 5
+# Seconds an unreachable replica is skipped before it is tried again
+SQLALCHEMY_REPLICA_RETRY_SECONDS = 30
+
+# Upper bound for the number of Shows a single recurring series may create
+SHOW_SERIES_MAX_OCCURRENCES = 104
+
+# Monthly partitions of the Show table (see "flask partition-shows")
+SHOW_PARTITION_MONTHS_AHEAD = 12
+SHOW_PARTITION_RETENTION_MONTHS = 24
+
+# Number of rows fetched at a time when exporting Shows (see "/shows/export" and "flask export")
+EXPORT_BATCH_SIZE = 5000
+
+# Admission control (see admission.py), by endpoint name
+# Token bucket per client: (requests per second, burst)
+ADMISSION_RATE_LIMITS = {
+  'search_venues': (2, 10),
+  'search_artists': (2, 10),
+}
+# Concurrent requests, further requests get a 503 instead of waiting
+ADMISSION_CONCURRENCY_LIMITS = {
+  'search_venues': 4,
+  'search_artists': 4,
+}
+# Average database statement time (seconds) above which the endpoints above are shed
+ADMISSION_LATENCY_THRESHOLD = 0.5
+# URL of the admission counters (JSON), e.g. '/_admission'. Off by default, only serve it where the public can't reach it
+ADMISSION_STATS_URL = None
+# Number of reverse proxies in front of the app, the client address is then read from X-Forwarded-For
+PROXY_COUNT = 0
+
+# Seconds the id -> name mapping of Venues & Artists for ShowForm is cached
+CATALOG_NAMES_TTL = 60
+
+# Purging the Shows of soft deleted Venues & Artists: Shows per transaction, seconds between batches
+PURGE_BATCH_SIZE = 1000
+PURGE_BATCH_PAUSE = 0.1
+
+# Streamed list pages: template outputs per chunk sent, rows fetched from the database at a time
+STREAM_BUFFER_SIZE = 50
+STREAM_BATCH_SIZE = 500
+
+# Responses smaller than COMPRESS_MIN_SIZE bytes are sent uncompressed
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+
+# Request profiling (see profiler.py). Share of requests profiled at random, 0 turns it off
+PROFILE_SAMPLE_RATE = 0.0
+# Requests with this header signed by "flask profile-token" are always profiled
+PROFILE_HEADER = 'X-Fyyur-Profile'
+# Seconds between two samples of a profiled request
+PROFILE_INTERVAL = 0.005
+PROFILE_DIR = os.path.join(basedir, 'profiles')
+
+# Slow query log (see slowlog.py). Statements taking longer (seconds) are logged with their plan, None turns it off
+SLOW_QUERY_THRESHOLD = 0.25
+SLOW_QUERY_LOG = os.path.join(basedir, 'slow_queries.log')
+# Seconds during which further slow runs of the same query are only counted
+SLOW_QUERY_DEDUP_SECONDS = 300
+
+# Similar Venues & Artists (see "flask recommend"): number stored per entity
+RECOMMENDATION_TOP_K = 6
+
+# Rows per INSERT statement of the batch commands ("flask recommend", "flask rollup-venue-stats")
+BULK_INSERT_BATCH_SIZE = 10000
+
+# Entries per page of /venues/seeking and /artists/seeking
+BROWSE_PAGE_SIZE = 24
+
+# Seconds browsers & proxies may reuse a search result (see search_entities)
+SEARCH_CACHE_MAX_AGE = 60
+
+# Live updates of new Shows (see broadcast.py): open streams per server process, seconds before a stream ends
+SSE_MAX_SUBSCRIBERS = 100
+SSE_MAX_DURATION = 300
+
+# Catalog snapshot of /venues & /artists (see catalog.py): seconds between checks of the
+# change log, seconds after which the snapshot is reloaded from scratch
+CATALOG_SNAPSHOT_CHECK_SECONDS = 1
+CATALOG_SNAPSHOT_MAX_AGE = 3600
+# Days of changes kept in the change log (see "flask prune-catalog-changes")
+CATALOG_CHANGE_RETENTION_DAYS = 7
+
+# Static detail pages of Venues & Artists (see "flask prerender"): output directory,
+# rendering processes (None: one per CPU) and pages rendered per task of a process
+PRERENDER_DIR = os.path.join(basedir, 'prerendered')
+PRERENDER_PROCESSES = None
+PRERENDER_CHUNK_SIZE = 100
+# Seconds a build looks for change ids missing from the log, much longer than the interval between builds,
+# so changes committing late are still rendered when a build runs late or is skipped
+PRERENDER_GAP_SECONDS = 3600
+
+# "What's on next" of the homepage: number of upcoming Shows, seconds they are cached, cities cached
+HOME_FEED_SIZE = 12
+HOME_FEED_TTL = 10
+HOME_FEED_MAX_CITIES = 500
+
+# Venues near a location (see geo.py): city locations used to geocode Venues, number of
+# nearest Venues returned by default, most Venues returned by one search
+GAZETTEER_FILE = os.path.join(basedir, 'data', 'gazetteer.csv')
+NEAR_DEFAULT_K = 10
+NEAR_MAX_RESULTS = 50
+
+# Background tasks (see tasks.py): worker threads per server process (0: only "flask run-tasks"
+# runs tasks), seconds between looks at the outbox, seconds a task may run before another
+# worker runs it again, seconds before the first retry (doubling after every attempt), attempts
+TASK_WORKERS = 2
+TASK_POLL_SECONDS = 5
+TASK_LEASE_SECONDS = 300
+TASK_RETRY_SECONDS = 10
+TASK_MAX_ATTEMPTS = 5
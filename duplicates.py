@@ -0,0 +1,79 @@
+"""
+Fuzzy duplicate detection of Venues & Artists
+
+"The Musical Hop" and "Musical Hop, The" are the same Venue. Names are
+compared as normalized tokens: lower case, without accents & punctuation,
+"&" spelled "and" and without the words of STOP_WORDS.
+
+Comparing a new name with every Venue would take a scan of the table per
+insert. Instead every entity has a few blocking keys: the first KEY_LENGTH
+characters of each token of its name, stored together with its city & state
+in the DuplicateKey table (see app.py). The candidates of a new name are
+the entities of the same city & state sharing a key with it, read from one
+index. Only the MAX_CANDIDATES sharing the most keys are scored:
+
+    - score() compares the sorted tokens character by character (difflib),
+      so word order and small typos barely count
+    - names scoring at least THRESHOLD are reported as likely duplicates
+
+A typo within the first KEY_LENGTH characters of every word is not found.
+"""
+
+import difflib
+import re
+import unicodedata
+
+STOP_WORDS = frozenset(['the', 'a', 'an', 'and', 'of', 'at'])
+# Characters of a token used as blocking key
+KEY_LENGTH = 3
+# Candidates scored per lookup, the ones sharing most keys
+MAX_CANDIDATES = 50
+# Lowest score() reported as duplicate
+THRESHOLD = 0.85
+
+
+def tokens(name):
+    '''Normalized words of a name, e.g. "Musical Hop, The" -> ['musical', 'hop']'''
+    folded = unicodedata.normalize('NFKD', name or '').encode('ascii', 'ignore').decode('ascii').lower()
+    words = re.findall(r'[a-z0-9]+', folded.replace('&', ' and '))
+    meaningful = [word for word in words if word not in STOP_WORDS]
+    # Names made of stop words only, e.g. "The The", keep them
+    return meaningful or words
+
+
+def blocking_keys(name):
+    '''Distinct blocking keys of a name'''
+    return sorted({token[:KEY_LENGTH] for token in tokens(name)})
+
+
+def area(city, state):
+    '''(city, state) as stored with the keys, the city ignoring case & surrounding spaces'''
+    return ' '.join((city or '').lower().split()), state or ''
+
+
+def score(name, other):
+    '''Similarity of two names from 0 to 1, ignoring word order, case, accents & punctuation'''
+    first = ' '.join(sorted(tokens(name)))
+    second = ' '.join(sorted(tokens(other)))
+    if not first or not second:
+        return 0.0
+    return difflib.SequenceMatcher(None, first, second, autojunk=False).ratio()
+
+
+def likely_duplicates(name, candidates, threshold=THRESHOLD):
+    '''Candidates similar to <name>, most similar first
+    * Input: list of records with a name field
+    * Output: list of (score, record)
+    '''
+    matcher = difflib.SequenceMatcher(None, autojunk=False)
+    # SequenceMatcher caches what it learns about its second sequence
+    matcher.set_seq2(' '.join(sorted(tokens(name))))
+    scored = []
+    for candidate in candidates:
+        matcher.set_seq1(' '.join(sorted(tokens(candidate.name))))
+        # Cheap upper bounds of ratio() first, most candidates are not similar at all
+        if matcher.real_quick_ratio() >= threshold and matcher.quick_ratio() >= threshold:
+            similarity = matcher.ratio()
+            if similarity >= threshold:
+                scored.append((similarity, candidate))
+    return sorted(scored, key=lambda item: -item[0])
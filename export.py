@@ -0,0 +1,142 @@
+"""
+Streams query results as CSV or Parquet files in fixed-size batches
+
+The writers take an iterable of row batches (e.g. from fetchmany()) and
+yield the encoded file piece by piece, so memory use only depends on the
+batch size and not on the number of rows exported.
+Parquet support needs the optional "pyarrow" package.
+"""
+
+import csv
+import io
+import time
+from datetime import date, datetime
+
+FORMATS = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def iter_batches(result, batch_size):
+    '''Yields lists of at most batch_size rows from a (server-side cursor) result'''
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        yield rows
+
+
+def iter_csv(columns, batches):
+    '''Yields a CSV file with a header line as one bytes chunk per batch
+    columns are the SQLAlchemy columns of the query, e.g. query.c
+    '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column.name for column in columns])
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+class _ChunkSink(object):
+    """
+    Write-only file object handing the bytes written by pyarrow back to the caller
+    """
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _arrow_schema(columns):
+    import pyarrow
+    types = {
+        bool: pyarrow.bool_(),
+        int: pyarrow.int64(),
+        float: pyarrow.float64(),
+        datetime: pyarrow.timestamp('us'),
+        date: pyarrow.date32(),
+    }
+    fields = []
+    for column in columns:
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            python_type = str
+        fields.append(pyarrow.field(column.name, types.get(python_type, pyarrow.string())))
+    return pyarrow.schema(fields)
+
+
+def iter_parquet(columns, batches):
+    '''Yields a Parquet file with one row group per batch
+    columns are the SQLAlchemy columns of the query, e.g. query.c
+    '''
+    import pyarrow
+    import pyarrow.parquet
+    schema = _arrow_schema(columns)
+    sink = _ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    for rows in batches:
+        writer.write_table(pyarrow.Table.from_pydict({
+            field.name: [row[index] for row in rows] for index, field in enumerate(schema)
+        }, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def get_writer(file_format):
+    '''Returns the writer for a file format, raises ValueError if it is unknown or unavailable'''
+    if file_format == 'csv':
+        return iter_csv
+    if file_format == 'parquet':
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError('Parquet export needs the "pyarrow" package.')
+        return iter_parquet
+    raise ValueError('Unknown export format "{}".'.format(file_format))
+
+
+class Throughput(object):
+    """
+    Counts the rows passing through a batch iterator
+    """
+    def __init__(self, batches):
+        self.batches = batches
+        self.rows = 0
+        self.started = time.time()
+
+    def __iter__(self):
+        for rows in self.batches:
+            self.rows += len(rows)
+            yield rows
+
+    def report(self):
+        seconds = max(time.time() - self.started, 1e-6)
+        return '{} rows in {:.2f}s ({:.0f} rows/s)'.format(self.rows, seconds, self.rows / seconds)
@@ -4,27 +4,77 @@ Contains WTFforms with fields and their respective validation logic
 
 from datetime import datetime
 from flask_wtf import Form
-from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField
-from wtforms.validators import DataRequired, AnyOf, URL
+from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField, IntegerField, FloatField, HiddenField, BooleanField
+from wtforms.validators import DataRequired, InputRequired, AnyOf, URL, Optional, NumberRange, ValidationError
+
+from config import SHOW_SERIES_MAX_OCCURRENCES, NEAR_MAX_RESULTS
+
+class IdSelectField(SelectField):
+    """
+    Select field for database ids.
+    Its choices are a mapping of id -> name, so submitted ids are checked
+    with a single dict lookup instead of scanning a list of choices.
+    """
+    def __init__(self, label=None, validators=None, **kwargs):
+        super(IdSelectField, self).__init__(label, validators, coerce=int, **kwargs)
+
+    def iter_choices(self):
+        for value, label in (self.choices or {}).items():
+            yield (value, label, value == self.data)
+
+    def pre_validate(self, form):
+        if self.data not in (self.choices or {}):
+            raise ValueError(self.gettext('Not a valid choice'))
 
 class ShowForm(Form):
     """
     Form to create and edit new Shows.
+    Choices of artist_id & venue_id are set by the view (see populate_show_form)
     Corresponding HTML: 
         - templates/forms/new_show.html
         - templates/forms/edit_show.html
     """
-    artist_id = StringField(
-        'artist_id'
+    artist_id = IdSelectField(
+        'artist_id', validators=[DataRequired()]
     )
-    venue_id = StringField(
-        'venue_id'
+    venue_id = IdSelectField(
+        'venue_id', validators=[DataRequired()]
     )
     start_time = DateTimeField(
         'start_time',
         validators=[DataRequired()],
         default= datetime.today()
     )
+    # Optional recurring series: repeat every <repeat_interval> days,
+    # either <repeat_count> times or until <repeat_until>
+    repeat_interval = IntegerField(
+        'repeat_interval',
+        validators=[Optional(), NumberRange(min=1)]
+    )
+    repeat_count = IntegerField(
+        'repeat_count',
+        validators=[Optional(), NumberRange(min=1, max=SHOW_SERIES_MAX_OCCURRENCES)]
+    )
+    # Same format as the placeholder of the form, YYYY-MM-DD HH:MM
+    repeat_until = DateTimeField(
+        'repeat_until',
+        validators=[Optional()],
+        format='%Y-%m-%d %H:%M'
+    )
+
+    def validate_repeat_interval(form, field):
+        if field.data and not (form.repeat_count.data or form.repeat_until.data):
+            raise ValidationError('A recurring show needs a number of occurrences or an end date.')
+
+    def validate_repeat_count(form, field):
+        if field.data and not form.repeat_interval.data:
+            raise ValidationError('A number of shows needs the days between them (repeat every).')
+
+    def validate_repeat_until(form, field):
+        if field.data and not form.repeat_interval.data:
+            raise ValidationError('An end date needs the days between the shows (repeat every).')
+        if field.data and form.start_time.data and field.data < form.start_time.data:
+            raise ValidationError('The series cannot end before the first show.')
 
 class VenueForm(Form):
     """
@@ -133,6 +183,18 @@ class VenueForm(Form):
     facebook_link = StringField(
         'facebook_link', validators=[URL()]
     )
+    # Only used when editing: the version the form was rendered from and the
+    # prefilled values as JSON, so only changed columns get written
+    version = HiddenField(
+        'version'
+    )
+    original = HiddenField(
+        'original'
+    )
+    # Only used when creating: lists the entity although similar ones exist
+    confirm_duplicate = BooleanField(
+        'confirm_duplicate'
+    )
 
 class ArtistForm(Form):
     """
@@ -238,4 +300,67 @@ class ArtistForm(Form):
         'facebook_link', 
         validators=[URL()]
     )
+    # Only used when editing: the version the form was rendered from and the
+    # prefilled values as JSON, so only changed columns get written
+    version = HiddenField(
+        'version'
+    )
+    original = HiddenField(
+        'original'
+    )
+    # Only used when creating: lists the entity although similar ones exist
+    confirm_duplicate = BooleanField(
+        'confirm_duplicate'
+    )
+
+class CatalogFilterForm(Form):
+    """
+    Filters of the Venue & Artist lists, submitted as query parameters
+    """
+    class Meta:
+        csrf = False
+
+    city = StringField(
+        'city', validators=[Optional()]
+    )
+    state = SelectField(
+        'state',
+        validators=[Optional()],
+        choices=[('', 'Any state')] + VenueForm.state.kwargs['choices']
+    )
+    genre = SelectField(
+        'genre',
+        validators=[Optional()],
+        choices=[('', 'Any genre')] + VenueForm.genres.kwargs['choices']
+    )
 
+class SeekingFilterForm(CatalogFilterForm):
+    """
+    Filters of the seeking talent / seeking venue pages, submitted as query parameters
+    """
+    # Id of the last entry on the previous page
+    after = IntegerField(
+        'after', validators=[Optional()]
+    )
+
+class NearbyForm(Form):
+    """
+    Location of the Venues near me search, submitted as query parameters
+    Without radius & k, the NEAR_DEFAULT_K nearest Venues are returned.
+    """
+    class Meta:
+        csrf = False
+
+    lat = FloatField(
+        'lat', validators=[InputRequired(), NumberRange(-90, 90)]
+    )
+    lon = FloatField(
+        'lon', validators=[InputRequired(), NumberRange(-180, 180)]
+    )
+    # Kilometers
+    radius = FloatField(
+        'radius', validators=[Optional(), NumberRange(0.1, 20000)]
+    )
+    k = IntegerField(
+        'k', validators=[Optional(), NumberRange(1, NEAR_MAX_RESULTS)]
+    )
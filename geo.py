@@ -0,0 +1,161 @@
+"""
+Venue locations without PostGIS
+
+Venues are geocoded from a local gazetteer file (GAZETTEER_FILE, CSV with
+city, state, latitude & longitude), no geocoding service is called. Their
+location is stored as latitude/longitude and as a geohash: the base32 code
+of the grid cell containing the location, where every further character
+splits the cell into 32 smaller ones. All locations in a cell share the
+cell's geohash as prefix, so the locations of a cell are one range of an
+ordinary btree index on the geohash.
+
+A search around a point reads the cells covering the circle of the search
+radius, at most MAX_CELLS of them as small as possible, and keeps the
+candidates within the radius (haversine distance). Searches that would need
+cells larger than MIN_PRECISION characters, covering a large share of all
+Venues, use a KD-tree of all locations in the process instead (KDTree).
+"""
+
+import csv
+import math
+import numpy as np
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+# Longest geohash stored (cells of about 37 × 19 mm)
+MAX_PRECISION = 12
+# Largest cells searched in the database, about 156 × 156 km
+MIN_PRECISION = 3
+# Most cells (index ranges) read by one search
+MAX_CELLS = 16
+
+
+def encode(latitude, longitude, precision=MAX_PRECISION):
+    '''Geohash of a location'''
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    code = []
+    bits = 0
+    value = 0
+    even = True
+    while len(code) < precision:
+        interval, coordinate = (lon_range, longitude) if even else (lat_range, latitude)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            code.append(BASE32[value])
+            bits = value = 0
+    return ''.join(code)
+
+
+def cell_size(precision):
+    '''(height, width) in degrees of the cells of a geohash precision'''
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+
+def covering_cells(latitude, longitude, radius_km):
+    '''Geohashes of the cells covering all points within <radius_km> of a location
+    * Output: list of at most MAX_CELLS geohashes, the longest (smallest cells) possible,
+      None if that would take cells larger than MIN_PRECISION
+    '''
+    # Bounding box of the circle, wider in degrees of longitude towards the poles
+    delta_latitude = radius_km / KM_PER_DEGREE
+    extreme_latitude = min(abs(latitude) + delta_latitude, 89.999)
+    delta_longitude = delta_latitude / math.cos(math.radians(extreme_latitude))
+    if delta_longitude >= 180:
+        return None
+    cells = None
+    for precision in range(MIN_PRECISION, MAX_PRECISION + 1):
+        height, width = cell_size(precision)
+        rows = range(math.floor((max(latitude - delta_latitude, -90) + 90) / height),
+                     math.floor((min(latitude + delta_latitude, 90 - 1e-9) + 90) / height) + 1)
+        columns = range(math.floor((longitude - delta_longitude + 180) / width),
+                        math.floor((longitude + delta_longitude + 180) / width) + 1)
+        if len(rows) * len(columns) > MAX_CELLS:
+            break
+        cells = []
+        for row in rows:
+            for column in columns:
+                # Centers of the cells, longitudes wrapped around the antimeridian
+                cell = encode((row + 0.5) * height - 90, ((column + 0.5) * width) % 360 - 180, precision)
+                if cell not in cells:
+                    cells.append(cell)
+    return cells
+
+
+def haversine(latitude, longitude, latitudes, longitudes):
+    '''Great circle distances (km) from a location to numpy arrays of locations'''
+    lat1 = math.radians(latitude)
+    lat2 = np.radians(latitudes)
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * np.cos(lat2) * np.sin(np.radians(longitudes - longitude) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def unit_vectors(latitudes, longitudes):
+    '''Locations as points on the unit sphere, for the KD-tree'''
+    lat = np.radians(latitudes)
+    lon = np.radians(longitudes)
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def chord(distance_km):
+    '''Straight line distance on the unit sphere of a great circle distance'''
+    return 2 * math.sin(min(distance_km / EARTH_RADIUS_KM, math.pi) / 2)
+
+
+class KDTree(object):
+    """
+    Locations of a list of ids, searchable by radius & k nearest in the process
+    """
+    def __init__(self, ids, latitudes, longitudes):
+        from scipy.spatial import cKDTree
+        located = np.isfinite(latitudes) & np.isfinite(longitudes)
+        self.ids = ids[located]
+        self.latitudes = latitudes[located]
+        self.longitudes = longitudes[located]
+        self.tree = cKDTree(unit_vectors(self.latitudes, self.longitudes)) if len(self.ids) else None
+
+    def search(self, latitude, longitude, radius_km=None, k=None):
+        '''(ids, distances in km) of the locations within <radius_km> and/or the <k> nearest, nearest first'''
+        if self.tree is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        point = unit_vectors(np.array([latitude]), np.array([longitude]))[0]
+        if k is not None:
+            k = min(k, len(self.ids))
+            bound = chord(radius_km) if radius_km is not None else np.inf
+            distances, positions = self.tree.query(point, k=[k] if k == 1 else k, distance_upper_bound=bound)
+            positions = np.atleast_1d(positions)[np.isfinite(np.atleast_1d(distances))]
+        else:
+            positions = np.array(self.tree.query_ball_point(point, chord(radius_km)), dtype=np.int64)
+        distances = haversine(latitude, longitude, self.latitudes[positions], self.longitudes[positions])
+        order = np.argsort(distances, kind='stable')
+        return self.ids[positions[order]], distances[order]
+
+
+class Gazetteer(object):
+    """
+    Locations of cities, read from a CSV file with columns city, state, latitude, longitude
+    """
+    def __init__(self, path):
+        self.locations = {}
+        with open(path, newline='', encoding='utf-8') as file:
+            for row in csv.DictReader(file):
+                self.locations[self.key(row['city'], row['state'])] = (float(row['latitude']), float(row['longitude']))
+
+    @staticmethod
+    def key(city, state):
+        return (city or '').strip().lower(), (state or '').strip().upper()
+
+    def locate(self, city, state):
+        '''(latitude, longitude) of a city, None if the gazetteer doesn't know it'''
+        return self.locations.get(self.key(city, state))
@@ -0,0 +1,102 @@
+"""
+Static detail pages
+
+"flask prerender" renders the pages of /venues/<id> and /artists/<id> to
+PRERENDER_DIR/venues/<id>.html and PRERENDER_DIR/artists/<id>.html, so a
+front web server can answer them without running the app (see README).
+
+A build only renders the pages that changed since the previous one. The
+manifest (PRERENDER_DIR/manifest.json) records how far the previous build
+got: the last id of the catalog change log it applied, the ids still
+missing from it (see catalog.read_changes) and the time it started, to find
+upcoming Shows that have become past Shows since. Missing ids are looked for
+by every build for PRERENDER_GAP_SECONDS, so a late or skipped build doesn't
+lose changes that committed after the previous one.
+
+Pages are rendered by a pool of processes, each process rendering chunks of
+pages with its own database connections.
+"""
+
+import json
+import multiprocessing
+import os
+import tempfile
+
+MANIFEST = 'manifest.json'
+
+
+def page_path(directory, kind, entity_id):
+    '''File of the page of a Venue or Artist, e.g. <directory>/venues/1.html'''
+    return os.path.join(directory, kind + 's', '{}.html'.format(entity_id))
+
+
+def write_file(path, content):
+    '''Writes <content> to a temporary file first and renames it, readers never see half a file'''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as file:
+            file.write(content)
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+def remove_file(path):
+    '''Removes <path>, returns False if there was no such file'''
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def rendered_ids(directory, kind):
+    '''Ids of all rendered pages of a kind'''
+    try:
+        names = os.listdir(os.path.join(directory, kind + 's'))
+    except FileNotFoundError:
+        return set()
+    return {int(name[:-5]) for name in names if name.endswith('.html') and name[:-5].isdigit()}
+
+
+def load_manifest(directory):
+    '''Manifest of the previous build, None if there was none'''
+    try:
+        with open(os.path.join(directory, MANIFEST), encoding='utf-8') as file:
+            manifest = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+    # JSON object keys are strings
+    manifest['gaps'] = {int(change_id): since for change_id, since in manifest.get('gaps', {}).items()}
+    return manifest
+
+
+def save_manifest(directory, manifest):
+    write_file(os.path.join(directory, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True))
+
+
+def chunks(items, size):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def run_pool(function, pages, processes, chunk_size):
+    '''Calls <function> on chunks of <pages> in <processes> processes and sums up its results
+    * Input: picklable function taking a list of pages & returning a tuple of counts
+    * Output: tuple of the summed counts, None if there were no pages
+    Close all database connections before, the processes must not share them.
+    '''
+    pages = list(pages)
+    if not pages:
+        return None
+    if processes <= 1:
+        results = map(function, chunks(pages, chunk_size))
+        return tuple(map(sum, zip(*results)))
+    # Forked processes start with the app already imported & configured
+    with multiprocessing.get_context('fork').Pool(processes) as pool:
+        results = list(pool.imap_unordered(function, chunks(pages, chunk_size)))
+    return tuple(map(sum, zip(*results)))
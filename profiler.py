@@ -0,0 +1,172 @@
+"""
+Opt-in sampling profiler for requests
+
+A profiled request is sampled every PROFILE_INTERVAL seconds by a
+background thread reading the stack of the thread serving the request
+(sys._current_frames), so the view itself runs unmodified. A request is
+profiled when
+    - it carries PROFILE_HEADER with a valid signature of its path
+      (see "flask profile-token"), or
+    - it is picked at random, PROFILE_SAMPLE_RATE being the share of
+      requests to profile (e.g. 0.01)
+Every profile is written to PROFILE_DIR as two files:
+    - <id>.folded: collapsed stacks, one "frame;frame;frame count" line per
+      distinct stack, as read by flamegraph.pl or speedscope
+    - <id>.json: duration of the request and the time spent in templates,
+      in the ORM/database and in the view itself
+With both triggers off a request costs one header lookup.
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from flask import g, request
+
+# Innermost frame of a sample decides where the time went
+ORM_MODULES = ('sqlalchemy', 'psycopg2', 'flask_sqlalchemy')
+TEMPLATE_MODULES = ('jinja2',)
+
+
+def sign_path(secret_key, path):
+    '''Signature to send in PROFILE_HEADER to profile requests to <path>'''
+    if isinstance(secret_key, str):
+        secret_key = secret_key.encode()
+    return hmac.new(secret_key, path.encode(), hashlib.sha256).hexdigest()
+
+
+def frame_label(code):
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def frame_category(code):
+    filename = code.co_filename
+    if filename.endswith('.html'):
+        return 'template'
+    parts = filename.replace('\\', '/').split('/')
+    if any(module in parts for module in ORM_MODULES):
+        return 'orm'
+    if any(module in parts for module in TEMPLATE_MODULES):
+        return 'template'
+    return None
+
+
+class Sampler(threading.Thread):
+    """
+    Collects the stack of thread <thread_id> every <interval> seconds until stopped
+    """
+    def __init__(self, thread_id, interval):
+        super(Sampler, self).__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.categories = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            labels = []
+            category = None
+            while frame is not None:
+                code = frame.f_code
+                labels.append(frame_label(code))
+                if category is None:
+                    category = frame_category(code)
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(labels))] += 1
+            self.categories[category or 'view'] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class RequestProfiler(object):
+    """
+    Flask extension profiling selected requests, configured in config.py
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+        app.config.setdefault('PROFILE_HEADER', 'X-Fyyur-Profile')
+        app.config.setdefault('PROFILE_INTERVAL', 0.005)
+        app.config.setdefault('PROFILE_DIR', os.path.join(app.root_path, 'profiles'))
+        self.app = app
+        app.before_request(self.start)
+        app.after_request(self.add_header)
+        # Teardown runs once a streamed response has been sent completely
+        app.teardown_request(self.finish)
+
+    def wanted(self):
+        signature = request.headers.get(self.app.config['PROFILE_HEADER'])
+        if signature is not None:
+            expected = sign_path(self.app.config['SECRET_KEY'], request.path)
+            # Header values may hold any characters, compare_digest only takes ASCII str
+            return hmac.compare_digest(signature.encode('utf-8', 'surrogateescape'), expected.encode('utf-8'))
+        rate = self.app.config['PROFILE_SAMPLE_RATE']
+        return rate > 0 and random.random() < rate
+
+    def start(self):
+        if not self.wanted():
+            return None
+        sampler = Sampler(threading.get_ident(), self.app.config['PROFILE_INTERVAL'])
+        g.profile = {
+            'id': '{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), uuid.uuid4().hex[:8]),
+            'sampler': sampler,
+            'started': time.perf_counter(),
+        }
+        sampler.start()
+        return None
+
+    def add_header(self, response):
+        profile = g.get('profile')
+        if profile is not None:
+            response.headers['X-Profile-Id'] = profile['id']
+        return response
+
+    def finish(self, exception=None):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return
+        duration = time.perf_counter() - profile['started']
+        sampler = profile['sampler']
+        sampler.stop()
+        samples = sum(sampler.stacks.values())
+        summary = {
+            'id': profile['id'],
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'duration': round(duration, 4),
+            'samples': samples,
+            'interval': self.app.config['PROFILE_INTERVAL'],
+            # Estimated seconds: duration split by the share of samples in each category
+            'time': {category: round(duration * sampler.categories[category] / samples, 4) if samples else None
+                     for category in ('view', 'template', 'orm')},
+            'error': repr(exception) if exception is not None else None,
+        }
+        try:
+            self.write(profile['id'], sampler.stacks, summary)
+        except OSError:
+            self.app.logger.exception('Could not write profile %s', profile['id'])
+
+    def write(self, profile_id, stacks, summary):
+        directory = self.app.config['PROFILE_DIR']
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, profile_id + '.folded'), 'w') as folded:
+            for stack, count in stacks.most_common():
+                folded.write('{} {}\n'.format(stack, count))
+        with open(os.path.join(directory, profile_id + '.json'), 'w') as summary_file:
+            json.dump(summary, summary_file, indent=2)
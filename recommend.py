@@ -0,0 +1,120 @@
+"""
+Similar artists & similar venues
+
+Computed in batch by "flask recommend" and stored in the Recommendation
+table, the detail pages only read the stored results.
+
+Every artist and every venue is described by a sparse vector of
+    - its genres (one column per genre, 1 if listed)
+    - its co-bookings: for an artist the venues it played at, for a venue
+      the artists that played there, weighted by log(1 + number of shows)
+Both parts are L2 normalized and weighted by GENRE_WEIGHT, so the cosine
+similarity of two vectors mixes genre overlap and shared bookings. The
+top-k most similar rows are taken from a sparse product X·Xᵀ computed in
+blocks of rows, memory stays bounded by the block size.
+"""
+
+import numpy as np
+import scipy.sparse as sp
+
+# Share of the similarity coming from genres, the rest comes from co-bookings
+GENRE_WEIGHT = 0.4
+
+
+def genre_matrix(genre_lists, vocabulary):
+    '''Sparse (entities × genres) matrix with 1 where an entity lists a genre
+    * Input: list of genre lists, one per entity, dict genre -> column
+    '''
+    rows = []
+    columns = []
+    for row, genres in enumerate(genre_lists):
+        for genre in set(genres or ()):
+            column = vocabulary.get(genre)
+            if column is not None:
+                rows.append(row)
+                columns.append(column)
+    data = np.ones(len(rows), dtype=np.float32)
+    return sp.csr_matrix((data, (rows, columns)), shape=(len(genre_lists), len(vocabulary)))
+
+
+def cobooking_matrix(venue_rows, artist_rows, show_counts, n_venues, n_artists):
+    '''Sparse (venues × artists) matrix of log(1 + number of shows)
+    * Input: numpy arrays of venue row, artist row & number of shows per booked pair
+    '''
+    data = np.log1p(np.asarray(show_counts, dtype=np.float32))
+    return sp.csr_matrix((data, (venue_rows, artist_rows)), shape=(n_venues, n_artists))
+
+
+def normalize_rows(matrix):
+    '''Scales every row to unit length, empty rows stay empty'''
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sp.diags(1 / norms).dot(matrix).tocsr()
+
+
+def feature_matrix(genres, cobookings, genre_weight=GENRE_WEIGHT):
+    '''Normalized rows of weighted genre & co-booking parts'''
+    features = sp.hstack([
+        normalize_rows(genres) * np.sqrt(genre_weight),
+        normalize_rows(cobookings) * np.sqrt(1 - genre_weight),
+    ]).tocsr()
+    return normalize_rows(features)
+
+
+def top_k_similar(features, k, block_size=1024):
+    '''Yields (row, rank, similar row, score) of the k most similar rows of every row
+    Similarity is the dot product of normalized rows (cosine), rows never match themselves
+    and rows without anything in common are skipped.
+    '''
+    transposed = features.T.tocsc()
+    for start in range(0, features.shape[0], block_size):
+        similarities = features[start:start + block_size].dot(transposed).tocsr()
+        similarities.eliminate_zeros()
+        for offset in range(similarities.shape[0]):
+            row = start + offset
+            begin, end = similarities.indptr[offset], similarities.indptr[offset + 1]
+            columns = similarities.indices[begin:end]
+            scores = similarities.data[begin:end]
+            keep = columns != row
+            columns, scores = columns[keep], scores[keep]
+            if len(scores) > k:
+                best = np.argpartition(-scores, k)[:k]
+                columns, scores = columns[best], scores[best]
+            # Highest score first, lower id first on ties
+            order = np.lexsort((columns, -scores))
+            for rank, index in enumerate(order, start=1):
+                yield row, rank, int(columns[index]), float(scores[index])
+
+
+def compute_recommendations(venues, artists, bookings, k):
+    '''Similar venues & artists
+    * Input: list of (venue id, genres), list of (artist id, genres),
+      list of (venue id, artist id, number of shows), <int> k
+    * Output: dict 'venue'/'artist' -> list of (entity id, rank, similar id, score)
+    '''
+    venue_ids = np.array([venue_id for venue_id, genres in venues], dtype=np.int64)
+    artist_ids = np.array([artist_id for artist_id, genres in artists], dtype=np.int64)
+    vocabulary = {}
+    for entity_id, genres in list(venues) + list(artists):
+        for genre in genres or ():
+            vocabulary.setdefault(genre, len(vocabulary))
+
+    # Map database ids to matrix rows, bookings of unknown (e.g. deleted) ids are dropped
+    venue_rows = {venue_id: row for row, venue_id in enumerate(venue_ids.tolist())}
+    artist_rows = {artist_id: row for row, artist_id in enumerate(artist_ids.tolist())}
+    pairs = [(venue_rows[venue_id], artist_rows[artist_id], count)
+             for venue_id, artist_id, count in bookings
+             if venue_id in venue_rows and artist_id in artist_rows]
+    pairs = np.array(pairs, dtype=np.float64).reshape(-1, 3)
+    cobookings = cobooking_matrix(pairs[:, 0].astype(np.int64), pairs[:, 1].astype(np.int64), pairs[:, 2],
+                                  len(venue_ids), len(artist_ids))
+
+    results = {}
+    for kind, ids, genres, booked in (
+        ('venue', venue_ids, [genres for venue_id, genres in venues], cobookings),
+        ('artist', artist_ids, [genres for artist_id, genres in artists], cobookings.T),
+    ):
+        features = feature_matrix(genre_matrix(genres, vocabulary), booked)
+        results[kind] = [(int(ids[row]), rank, int(ids[similar]), round(score, 4))
+                         for row, rank, similar, score in top_k_similar(features, k)]
+    return results
@@ -0,0 +1,46 @@
+"""
+Lightweight records for listings
+
+A RecordType is built once, at import time, from the columns a page needs.
+It selects exactly those columns with a Core select and turns every result
+row into a namedtuple (tuple-backed, __slots__ = ()): no ORM objects, no
+identity map, no Query row processing and no per-row dict. Templates read
+the fields as attributes, e.g. {{ venue.name }}.
+
+    VENUE_LISTING = RecordType.for_model('VenueListing', Venue, 'id', 'name')
+    venues = VENUE_LISTING.all(db.session, VENUE_LISTING.select().where(...))
+
+benchmarks/listing_records.py compares it with loading ORM objects.
+"""
+
+from collections import OrderedDict, namedtuple
+from sqlalchemy import select
+
+
+class RecordType(object):
+    """
+    Columns to select and the namedtuple type holding one result row
+    """
+    def __init__(self, name, columns):
+        '''<columns>: OrderedDict or list of (field name, column expression)'''
+        columns = OrderedDict(columns)
+        self.fields = tuple(columns)
+        self.columns = tuple(column.label(field) for field, column in columns.items())
+        self.type = namedtuple(name, self.fields)
+
+    @classmethod
+    def for_model(cls, name, model, *fields):
+        '''Record of model attributes, e.g. RecordType.for_model('ArtistListing', Artist, 'id', 'name')'''
+        return cls(name, [(field, getattr(model, field)) for field in fields])
+
+    def select(self):
+        '''Select of the columns of the record, add where/order_by clauses to it'''
+        return select(self.columns)
+
+    def iter(self, session, statement, batch_size=1000):
+        '''Records of <statement>, fetched from a server-side cursor up to <batch_size> rows at a time'''
+        statement = statement.execution_options(stream_results=True, max_row_buffer=batch_size)
+        return map(self.type._make, session.execute(statement))
+
+    def all(self, session, statement):
+        return list(map(self.type._make, session.execute(statement)))
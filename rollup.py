@@ -0,0 +1,77 @@
+"""
+Monthly booking statistics of venues
+
+Used by "flask rollup-venue-stats" to rebuild the VenueMonthlyStats table
+from all Shows at once. New Shows update the table incrementally (see
+refresh_venue_stats in app.py), so the rebuild is only needed after
+deletes or to fill the table for the first time.
+
+Shows are collected as three numpy arrays (venue id, artist id, day) and
+counted with np.unique on combined int64 keys, no per-show Python code
+runs after the rows are fetched.
+"""
+
+import numpy as np
+
+EPOCH = np.datetime64('1970-01-01', 'D')
+
+
+class ShowArrays(object):
+    """
+    Accumulates batches of (venue id, artist id, start time) rows as numpy arrays
+    """
+    def __init__(self):
+        self.venues = []
+        self.artists = []
+        self.days = []
+
+    def add(self, rows):
+        if not rows:
+            return
+        venue_ids, artist_ids, start_times = zip(*rows)
+        self.venues.append(np.array(venue_ids, dtype=np.int64))
+        self.artists.append(np.array(artist_ids, dtype=np.int64))
+        self.days.append((np.array(start_times, dtype='datetime64[D]') - EPOCH).astype(np.int64))
+
+    def arrays(self):
+        if not self.venues:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+        return np.concatenate(self.venues), np.concatenate(self.artists), np.concatenate(self.days)
+
+
+def month_of_days(days):
+    '''Months since 1970-01 of days since 1970-01-01'''
+    return (EPOCH + days).astype('datetime64[M]').astype(np.int64)
+
+
+def monthly_venue_stats(venue_ids, artist_ids, days):
+    '''Per venue & month: number of shows, distinct artists & days with at least one show
+    * Input: numpy int64 arrays of venue id, artist id & day (days since 1970-01-01), one entry per show
+    * Output: list of (venue id, first day of month as date, show_count, distinct_artists, booked_days)
+    '''
+    if len(venue_ids) == 0:
+        return []
+    # Number venues, artists & days from 0, so combined keys stay far below 2**63
+    venues, venue_rows = np.unique(venue_ids, return_inverse=True)
+    artist_rows = np.unique(artist_ids, return_inverse=True)[1]
+    first_day = days.min()
+    day_rows = days - first_day
+    months = month_of_days(days)
+    month_rows = months - months.min()
+    n_artists = artist_rows.max() + 1
+    n_days = day_rows.max() + 1
+    n_months = month_rows.max() + 1
+
+    group_keys = venue_rows * n_months + month_rows
+    groups, show_counts = np.unique(group_keys, return_counts=True)
+    # Distinct (group, artist) and (venue, day) pairs, counted per group
+    artist_pairs = np.unique(group_keys * n_artists + artist_rows)
+    artist_counts = np.unique(artist_pairs // n_artists, return_counts=True)[1]
+    day_pairs = np.unique(venue_rows * n_days + day_rows)
+    day_months = month_of_days(day_pairs % n_days + first_day) - months.min()
+    day_counts = np.unique(day_pairs // n_days * n_months + day_months, return_counts=True)[1]
+
+    month_dates = (groups % n_months + months.min()).astype('datetime64[M]').astype('datetime64[D]')
+    return list(zip(venues[groups // n_months].tolist(), month_dates.tolist(),
+                    show_counts.tolist(), artist_counts.tolist(), day_counts.tolist()))
@@ -0,0 +1,123 @@
+"""
+Routes database traffic between the primary database and its read replicas
+
+Replicas are configured as a list of database URLs in config.py
+(SQLALCHEMY_REPLICAS) and registered as SQLAlchemy binds named
+"replica_0", "replica_1", ...
+
+Routing rules:
+    - GET/HEAD requests read from a healthy replica
+    - every other request (POST, PATCH, DELETE, ...) and everything outside
+      of a request (CLI commands, migrations) uses the primary
+    - after a write, the same client keeps reading from the primary for
+      SQLALCHEMY_REPLICA_STICKY_SECONDS (read-your-writes)
+    - a replica that fails to connect is skipped for
+      SQLALCHEMY_REPLICA_RETRY_SECONDS, falling back to the primary
+"""
+
+import random
+import time
+from flask import g, request, session, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+STICKY_SESSION_KEY = '_primary_until'
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session that sends statements of read requests to a replica
+    """
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = self.db.choose_replica()
+        if replica is not None:
+            return self.db.get_engine(self.app, bind=replica)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    Drop-in replacement for SQLAlchemy with read replica routing
+    """
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_REPLICAS', [])
+        app.config.setdefault('SQLALCHEMY_REPLICA_STICKY_SECONDS', 5)
+        app.config.setdefault('SQLALCHEMY_REPLICA_RETRY_SECONDS', 30)
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        self.replicas = []
+        for number, uri in enumerate(app.config['SQLALCHEMY_REPLICAS']):
+            name = 'replica_{}'.format(number)
+            binds[name] = uri
+            self.replicas.append(name)
+        app.config['SQLALCHEMY_BINDS'] = binds
+        self._replica_down_until = {}
+        self._replica_checked = set()
+        self._replica_watched = set()
+        self._app = app
+        super(RoutingSQLAlchemy, self).init_app(app)
+
+        @app.after_request
+        def stick_to_primary(response):
+            # Reads following a write by the same client go to the primary
+            if self.replicas and request.method not in READ_METHODS:
+                session[STICKY_SESSION_KEY] = time.time() + app.config['SQLALCHEMY_REPLICA_STICKY_SECONDS']
+            return response
+
+    def _execute_for_all_tables(self, app, bind, operation, skip_tables=False):
+        # create_all()/drop_all() only ever run against the primary, replicas follow it
+        if bind == '__all__':
+            binds = self.get_app(app).config.get('SQLALCHEMY_BINDS') or ()
+            bind = [None] + [name for name in binds if name not in self.replicas]
+        return super(RoutingSQLAlchemy, self)._execute_for_all_tables(app, bind, operation, skip_tables)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def choose_replica(self):
+        '''Returns the bind name of the replica for the current request, or None for the primary
+        The choice is made once per request, so all reads of a request see the same database.
+        '''
+        if not self.replicas or not has_request_context():
+            return None
+        if 'db_replica' not in g:
+            g.db_replica = None
+            if request.method in READ_METHODS and session.get(STICKY_SESSION_KEY, 0) < time.time():
+                available = [name for name in self.replicas if self.replica_available(name)]
+                if available:
+                    g.db_replica = random.choice(available)
+        return g.db_replica
+
+    def replica_available(self, name):
+        '''Checks whether a replica may be used
+        A replica is probed with a connection the first time it is used and after every
+        failure. Failures are remembered for SQLALCHEMY_REPLICA_RETRY_SECONDS.
+        '''
+        if self._replica_down_until.get(name, 0) > time.time():
+            return False
+        engine = self.get_engine(self._app, bind=name)
+        if name not in self._replica_watched:
+            self._replica_watched.add(name)
+            event.listen(engine, 'handle_error', lambda context: self._on_replica_error(name, context))
+        if name not in self._replica_checked:
+            self._replica_checked.add(name)
+            try:
+                engine.connect().close()
+            except Exception:
+                return False
+        return True
+
+    def _on_replica_error(self, name, context):
+        # Only connection problems take a replica out of rotation, not failing statements
+        if context.is_disconnect or context.connection is None:
+            self.mark_replica_down(name)
+
+    def mark_replica_down(self, name):
+        self._app.logger.warning('Read replica {} is unavailable, using primary'.format(name))
+        self._replica_down_until[name] = time.time() + self._app.config['SQLALCHEMY_REPLICA_RETRY_SECONDS']
+        # Probe the replica again once the retry interval has passed
+        self._replica_checked.discard(name)
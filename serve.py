@@ -0,0 +1,83 @@
+"""
+Production server for Fyyur
+
+Runs the app with gunicorn: a master process pre-forks <workers> worker
+processes, each serving requests with <threads> threads.
+
+    $ python serve.py --workers 4 --threads 8
+
+    - Debug mode is turned off and all workers share one secret key
+    - Every worker warms up (templates, caches, database connections)
+      before it accepts its first request
+    - SIGHUP to the master reloads gracefully: new workers with the
+      current code start, old ones finish their requests first
+    - SIGTERM shuts down gracefully, SIGTTIN/SIGTTOU add/remove a worker
+
+"python app.py" remains the development server.
+"""
+
+import multiprocessing
+import os
+import click
+from gunicorn.app.base import BaseApplication
+
+
+class FyyurApplication(BaseApplication):
+    """
+    Gunicorn application serving app.py with the given settings
+    """
+    def __init__(self, options):
+        self.options = options
+        super(FyyurApplication, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from app import app
+        return app
+
+
+def post_worker_init(worker):
+    # Runs in every worker process, before it accepts requests
+    from app import warm_up, live_events
+    warm_up(connections=worker.cfg.threads)
+    # Every open event stream holds a thread, keep at least half of them for pages
+    live_events.hub.max_subscribers = min(live_events.hub.max_subscribers, worker.cfg.threads // 2)
+
+
+@click.command()
+@click.option('--bind', '-b', default='0.0.0.0:5000', show_default=True, help='Address to listen on.')
+@click.option('--workers', '-w', type=int, default=multiprocessing.cpu_count() * 2 + 1, show_default=True,
+              help='Number of worker processes.')
+@click.option('--threads', type=int, default=4, show_default=True, help='Threads per worker process.')
+@click.option('--keepalive', type=int, default=5, show_default=True,
+              help='Seconds to keep idle client connections open.')
+@click.option('--timeout', type=int, default=30, show_default=True,
+              help='Seconds before a hanging worker is restarted, also the graceful shutdown period.')
+def serve(bind, workers, threads, keepalive, timeout):
+    '''Serves Fyyur with a pre-forked gunicorn server'''
+    # Settings for config.py, inherited by every worker process
+    os.environ['FYYUR_DEBUG'] = 'false'
+    # Sessions & CSRF tokens only work across workers with a shared key
+    os.environ.setdefault('FYYUR_SECRET_KEY', os.urandom(32).hex())
+    FyyurApplication({
+        'bind': bind,
+        'workers': workers,
+        'threads': threads,
+        # Threaded workers keep idle keep-alive connections without blocking a worker
+        'worker_class': 'gthread',
+        'keepalive': keepalive,
+        'timeout': timeout,
+        'graceful_timeout': timeout,
+        # Recycle workers now and then, staggered so they don't all restart at once
+        'max_requests': 10000,
+        'max_requests_jitter': 1000,
+        'post_worker_init': post_worker_init,
+        'accesslog': '-',
+    }).run()
+
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,226 @@
+"""
+Slow query log
+
+Every statement taking longer than SLOW_QUERY_THRESHOLD seconds is written
+to SLOW_QUERY_LOG as one JSON line with
+    - the SQL, its bound parameters and its fingerprint (the SQL with all
+      values replaced by "?", identical for every run of the same query)
+    - the route (or command) that ran it and the database it ran on
+    - for read-only SELECT statements, the plan of EXPLAIN (ANALYZE, BUFFERS)
+Statements reading through a server-side cursor (stream_results, e.g. the
+exports) send their rows with every fetch, not when they are executed. They
+are timed from the execute to the last fetch, leaving out the time spent
+between fetches, and logged once the cursor is closed, without plan: EXPLAIN
+ANALYZE would run the whole export again.
+Statements & parameters longer than MAX_LOGGED_CHARS are truncated, so a
+bulk insert doesn't write a line of megabytes.
+Each fingerprint is logged at most once per SLOW_QUERY_DEDUP_SECONDS, the
+entry counting the slow runs skipped since the previous one, so a slow
+page under load does not flood the log or run EXPLAIN on every request.
+The log file rotates at SLOW_QUERY_LOG_MAX_BYTES.
+"""
+
+import hashlib
+import json
+import logging
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from logging.handlers import RotatingFileHandler
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+VALUE_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+# Rows of a multi-row VALUES, collapsed to one whatever the batch size
+ROW_LIST = re.compile(r'\(\?\.\.\.\)(?:\s*,\s*\(\?\.\.\.\))+')
+WHITESPACE = re.compile(r'\s+')
+# Only plain queries run again under EXPLAIN ANALYZE: no row locks, no data-modifying
+# CTEs & no functions with side effects, e.g. the nextval/pg_notify of broadcast.py
+READ_ONLY = re.compile(r'^\s*(SELECT|WITH)\b', re.IGNORECASE)
+SIDE_EFFECTS = re.compile(
+    r'\b(INSERT|UPDATE|DELETE|MERGE|INTO|FOR\s+(NO\s+KEY\s+UPDATE|KEY\s+SHARE|SHARE))\b'
+    r'|\b(nextval|setval|pg_notify|pg_advisory\w*|pg_try_advisory\w*|set_config|lo_\w+|dblink\w*'
+    r'|pg_cancel_backend|pg_terminate_backend)\s*\(',
+    re.IGNORECASE)
+# Longest statement & parameters written to the log
+MAX_LOGGED_CHARS = 4096
+
+
+def fingerprint(statement):
+    '''Short hash of a statement, identical for all runs of a query whatever its values'''
+    normalized = PLACEHOLDER.sub('?', statement)
+    normalized = VALUE_LIST.sub('(?...)', normalized)
+    normalized = ROW_LIST.sub('(?...)', normalized)
+    normalized = WHITESPACE.sub(' ', normalized).strip().lower()
+    return hashlib.sha1(normalized.encode()).hexdigest()[:16]
+
+
+def explainable(statement):
+    '''True for statements that can run again under EXPLAIN ANALYZE without side effects'''
+    return bool(READ_ONLY.match(statement)) and not SIDE_EFFECTS.search(statement)
+
+
+def truncate(text):
+    if len(text) <= MAX_LOGGED_CHARS:
+        return text
+    return '{}... ({} more characters)'.format(text[:MAX_LOGGED_CHARS], len(text) - MAX_LOGGED_CHARS)
+
+
+def origin():
+    '''Route or command that runs the current statement'''
+    if has_request_context():
+        return '{} {} ({})'.format(request.method, request.path, request.endpoint)
+    return ' '.join(sys.argv)
+
+
+class TimedCursor(object):
+    """
+    Server-side DBAPI cursor adding up the time spent in its fetches, calls <on_close>(seconds) when closed
+    """
+    def __init__(self, cursor, on_close):
+        self._cursor = cursor
+        self._on_close = on_close
+        self.duration = 0.0
+
+    def _timed(self, method, *args):
+        started = time.perf_counter()
+        try:
+            return getattr(self._cursor, method)(*args)
+        finally:
+            self.duration += time.perf_counter() - started
+
+    def fetchone(self):
+        return self._timed('fetchone')
+
+    def fetchmany(self, *args):
+        return self._timed('fetchmany', *args)
+
+    def fetchall(self):
+        return self._timed('fetchall')
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def close(self):
+        self._cursor.close()
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close(self.duration)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class SlowQueryLog(object):
+    """
+    Flask extension logging slow statements of all engines with their query plans
+    """
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.seen = OrderedDict()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SLOW_QUERY_THRESHOLD', None)
+        app.config.setdefault('SLOW_QUERY_LOG', 'slow_queries.log')
+        app.config.setdefault('SLOW_QUERY_LOG_MAX_BYTES', 10 * 1024 * 1024)
+        app.config.setdefault('SLOW_QUERY_LOG_BACKUPS', 5)
+        app.config.setdefault('SLOW_QUERY_DEDUP_SECONDS', 300)
+        app.config.setdefault('SLOW_QUERY_MAX_FINGERPRINTS', 10000)
+        self.app = app
+        if app.config['SLOW_QUERY_THRESHOLD'] is None:
+            return
+
+        self.logger = logging.getLogger('fyyur.slow_queries')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        if not self.logger.handlers:
+            self.logger.addHandler(RotatingFileHandler(
+                app.config['SLOW_QUERY_LOG'],
+                maxBytes=app.config['SLOW_QUERY_LOG_MAX_BYTES'],
+                backupCount=app.config['SLOW_QUERY_LOG_BACKUPS']))
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+        event.listen(Engine, 'handle_error', self._handle_error)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('slow_query_started', []).append(time.perf_counter())
+
+    def _handle_error(self, context):
+        # Failed statements never reach after_cursor_execute
+        if context.connection is not None and context.connection.info.get('slow_query_started'):
+            context.connection.info['slow_query_started'].pop()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info['slow_query_started'].pop()
+        if (context is not None and context.execution_options.get('stream_results')
+                and conn.dialect.supports_server_side_cursors):
+            # The result reads its rows from context.cursor, the fetches are timed from here on
+            context.cursor = TimedCursor(cursor, lambda fetched: self.log(
+                conn, statement, parameters, duration + fetched, streamed=True))
+            return
+        self.log(conn, statement, parameters, duration, explain=not executemany)
+
+    def log(self, conn, statement, parameters, duration, explain=False, streamed=False):
+        '''Writes an entry for <statement> if it took at least SLOW_QUERY_THRESHOLD seconds'''
+        if duration < self.app.config['SLOW_QUERY_THRESHOLD']:
+            return
+        key = fingerprint(statement)
+        skipped = self.should_log(key)
+        if skipped is None:
+            return
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'duration': round(duration, 4),
+            'fingerprint': key,
+            'skipped': skipped,
+            'origin': origin(),
+            'database': repr(conn.engine.url),
+            'statement': truncate(statement),
+            'parameters': truncate(json.dumps(parameters, default=str)),
+        }
+        if streamed:
+            entry['streamed'] = True
+        if explain and explainable(statement):
+            entry['plan'] = self.explain(conn, statement, parameters)
+        self.logger.info(json.dumps(entry, default=str))
+
+    def should_log(self, key):
+        '''Number of slow runs skipped since <key> was last logged, None while it should stay skipped'''
+        now = time.monotonic()
+        with self.lock:
+            logged_at, skipped = self.seen.pop(key, (None, 0))
+            if logged_at is not None and now - logged_at < self.app.config['SLOW_QUERY_DEDUP_SECONDS']:
+                self.seen[key] = (logged_at, skipped + 1)
+                return None
+            self.seen[key] = (now, 0)
+            # Forget the least recently logged fingerprint
+            if len(self.seen) > self.app.config['SLOW_QUERY_MAX_FINGERPRINTS']:
+                self.seen.popitem(last=False)
+            return skipped
+
+    def explain(self, conn, statement, parameters):
+        '''Runs the statement again under EXPLAIN (ANALYZE, BUFFERS) and returns the plan
+        A raw DBAPI cursor is used, so this neither fires the listeners above again
+        nor shows up in the session. Whatever the second run did is rolled back to the
+        savepoint, which also keeps a failing EXPLAIN from aborting the transaction of the request.
+        '''
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute('SAVEPOINT slow_query_explain')
+            try:
+                cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + statement, parameters)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+            except Exception as error:
+                plan = 'EXPLAIN failed: {}'.format(error)
+            cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            return plan
+        except Exception as error:
+            return 'EXPLAIN failed: {}'.format(error)
+        finally:
+            cursor.close()
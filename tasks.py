@@ -0,0 +1,188 @@
+"""
+Background tasks with a transactional outbox
+
+Work following a write, e.g. recounting statistics or announcing new Shows,
+is not done by the request that writes. The handler adds a task to the
+outbox table ("OutboxTask") in its own transaction and returns, the task is
+committed together with the write or not at all:
+
+    @tasks.task
+    def announce_shows(venue_id, artist_id, start_times):
+        ...
+
+    tasks.enqueue('announce_shows', venue_id=1, artist_id=2, start_times=[...])
+    db.session.commit()
+    tasks.wake()
+
+Every server process runs a few worker threads (TASK_WORKERS) draining the
+outbox, "flask run-tasks" runs them as a process of their own.
+
+    - a worker claims one task at a time: it moves the task's run_after
+      TASK_LEASE_SECONDS ahead and commits. Claims skip the rows other
+      workers are claiming (FOR UPDATE SKIP LOCKED), so workers of all
+      processes share the outbox without waiting for each other
+    - the task then runs in transactions of its own and is deleted once it
+      succeeded. A worker dying mid-task leaves it claimed, it runs again
+      when the lease expires
+    - failed tasks are retried after TASK_RETRY_SECONDS, doubling with every
+      attempt. After TASK_MAX_ATTEMPTS attempts they are kept with failed_at
+      & last_error set and not run again
+
+Tasks run at least once, possibly more often, so they must be idempotent.
+Their arguments are stored as JSON, datetimes as ISO 8601 strings.
+"""
+
+import json
+import threading
+import traceback
+from datetime import datetime, timedelta
+from sqlalchemy import BigInteger, Column, DateTime, Index, Integer, String, Table, Text, func, select
+from sqlalchemy.dialects.postgresql import JSONB
+
+
+def to_json(value):
+    '''Arguments of a task as stored in the outbox'''
+    return json.loads(json.dumps(value, default=lambda item: item.isoformat()))
+
+
+class BackgroundTasks(object):
+    """
+    Outbox of tasks, drained by worker threads of every server process
+    """
+    def __init__(self, app=None, db=None):
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        app.config.setdefault('TASK_WORKERS', 2)
+        app.config.setdefault('TASK_POLL_SECONDS', 5)
+        app.config.setdefault('TASK_LEASE_SECONDS', 300)
+        app.config.setdefault('TASK_RETRY_SECONDS', 10)
+        app.config.setdefault('TASK_MAX_ATTEMPTS', 5)
+        self.app = app
+        self.db = db
+        # Tasks that failed TASK_MAX_ATTEMPTS times are kept with failed_at set,
+        # "flask run-tasks --retry-failed" runs them again
+        self.table = Table('OutboxTask', db.Model.metadata,
+            Column('id', BigInteger, primary_key=True),
+            Column('name', String(60), nullable=False),
+            Column('arguments', JSONB, nullable=False, server_default='{}'),
+            Column('attempts', Integer, nullable=False, server_default='0'),
+            # Due time, moved ahead while a worker runs the task and between retries
+            Column('run_after', DateTime, nullable=False, server_default=func.now()),
+            Column('created_at', DateTime, nullable=False, server_default=func.now()),
+            Column('failed_at', DateTime),
+            Column('last_error', Text))
+        # Workers look for the next due task, failed tasks are left out
+        Index('ix_outbox_task_due', self.table.c.run_after, self.table.c.id,
+              postgresql_where=self.table.c.failed_at.is_(None))
+        self.handlers = {}
+        self.lock = threading.Lock()
+        self.workers = []
+        self.wakeup = threading.Event()
+
+    def task(self, function):
+        '''Decorator registering <function> as task, under its name'''
+        self.handlers[function.__name__] = function
+        return function
+
+    def enqueue(self, name, **arguments):
+        '''Adds a task to the outbox in the transaction of the session, it runs once that commits'''
+        if name not in self.handlers:
+            raise KeyError('Unknown task {}'.format(name))
+        self.db.session.execute(self.table.insert().values(name=name, arguments=to_json(arguments)))
+
+    def wake(self):
+        '''Lets the workers of this process look for tasks now, call it after committing new tasks'''
+        self.start_workers()
+        self.wakeup.set()
+
+    def start_workers(self):
+        with self.lock:
+            if self.workers:
+                return
+            for number in range(self.app.config['TASK_WORKERS']):
+                worker = threading.Thread(target=self.work, daemon=True, name='task-worker-{}'.format(number))
+                worker.start()
+                self.workers.append(worker)
+
+    def work(self):
+        '''Loop of a worker thread, drains the outbox every TASK_POLL_SECONDS or when woken'''
+        while True:
+            self.wakeup.wait(self.app.config['TASK_POLL_SECONDS'])
+            self.wakeup.clear()
+            try:
+                self.drain()
+            except Exception:
+                self.app.logger.exception('Draining the task outbox failed')
+
+    def drain(self, limit=None):
+        '''Runs due tasks until there are none left (or <limit> ran), returns (succeeded, failed)'''
+        succeeded = failed = 0
+        with self.app.app_context():
+            while limit is None or succeeded + failed < limit:
+                task = self.claim()
+                if task is None:
+                    break
+                if self.run(task):
+                    succeeded += 1
+                else:
+                    failed += 1
+        return succeeded, failed
+
+    def claim(self):
+        '''Claims the next due task for TASK_LEASE_SECONDS, None if there is none'''
+        table = self.table
+        session = self.db.session
+        due = (select([table.c.id])
+               .where(table.c.failed_at.is_(None))
+               .where(table.c.run_after <= func.now())
+               .order_by(table.c.run_after, table.c.id)
+               .limit(1)
+               .with_for_update(skip_locked=True))
+        lease = timedelta(seconds=self.app.config['TASK_LEASE_SECONDS'])
+        try:
+            task = session.execute(table.update()
+                                   .where(table.c.id == due.as_scalar())
+                                   .values(attempts=table.c.attempts + 1, run_after=func.now() + lease)
+                                   .returning(table.c.id, table.c.name, table.c.arguments, table.c.attempts)).first()
+            session.commit()
+        finally:
+            session.close()
+        return task
+
+    def run(self, task):
+        '''Runs a claimed task, deletes it or schedules the next attempt, returns True if it succeeded'''
+        table = self.table
+        session = self.db.session
+        try:
+            self.handlers[task.name](**task.arguments)
+            session.commit()
+        except Exception:
+            session.rollback()
+            self.app.logger.exception('Task {} #{} failed (attempt {})'.format(task.name, task.id, task.attempts))
+            error = traceback.format_exc()
+            if task.attempts >= self.app.config['TASK_MAX_ATTEMPTS']:
+                values = {'failed_at': datetime.now()}
+            else:
+                delay = self.app.config['TASK_RETRY_SECONDS'] * 2 ** (task.attempts - 1)
+                values = {'run_after': func.now() + timedelta(seconds=delay)}
+            session.execute(table.update().where(table.c.id == task.id).values(last_error=error, **values))
+            session.commit()
+            return False
+        finally:
+            session.close()
+        session.execute(table.delete().where(table.c.id == task.id))
+        session.commit()
+        session.close()
+        return True
+
+    def counts(self):
+        '''Numbers of due, scheduled (retries & claimed) and failed tasks'''
+        table = self.table
+        rows = self.db.session.execute(select([
+            func.count().filter(table.c.failed_at.isnot(None)),
+            func.count().filter(table.c.failed_at.is_(None) & (table.c.run_after <= func.now())),
+            func.count().filter(table.c.failed_at.is_(None) & (table.c.run_after > func.now())),
+        ])).first()
+        return {'failed': rows[0], 'due': rows[1], 'scheduled': rows[2]}
@@ -0,0 +1,129 @@
+"""
+Tests of the read replica routing (routing.py) with two local SQLite databases
+
+Each database holds a table "Origin" with the name of the database, so a
+request can tell which one it read from. Run with:
+
+    $ python -m pytest tests
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+from flask import Flask, jsonify
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from routing import RoutingSQLAlchemy, STICKY_SESSION_KEY
+
+
+def create_database(path, name):
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE "Origin" (name TEXT)')
+    connection.execute('INSERT INTO "Origin" VALUES (?)', (name,))
+    connection.commit()
+    connection.close()
+
+
+def create_app(primary, replicas, **config):
+    app = Flask(__name__)
+    app.config.update(
+        SECRET_KEY='test',
+        SQLALCHEMY_DATABASE_URI='sqlite:///' + primary,
+        SQLALCHEMY_REPLICAS=['sqlite:///' + replica for replica in replicas],
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        **config)
+    db = RoutingSQLAlchemy(app)
+
+    @app.route('/origin', methods=['GET', 'POST'])
+    def origin():
+        return jsonify(db.session.execute('SELECT name FROM "Origin"').scalar())
+
+    return app, db
+
+
+class RoutingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.primary = os.path.join(self.directory, 'primary.db')
+        self.replica = os.path.join(self.directory, 'replica.db')
+        create_database(self.primary, 'primary')
+        create_database(self.replica, 'replica')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def origin(self, client, method='get'):
+        return getattr(client, method)('/origin').get_json()
+
+    def test_reads_go_to_the_replica(self):
+        app, db = create_app(self.primary, [self.replica])
+        self.assertEqual(self.origin(app.test_client()), 'replica')
+
+    def test_writes_go_to_the_primary(self):
+        app, db = create_app(self.primary, [self.replica])
+        self.assertEqual(self.origin(app.test_client(), 'post'), 'primary')
+
+    def test_without_replicas_everything_goes_to_the_primary(self):
+        app, db = create_app(self.primary, [])
+        self.assertEqual(self.origin(app.test_client()), 'primary')
+
+    def test_outside_of_requests_the_primary_is_used(self):
+        app, db = create_app(self.primary, [self.replica])
+        with app.app_context():
+            self.assertIsNone(db.choose_replica())
+            self.assertEqual(db.session.execute('SELECT name FROM "Origin"').scalar(), 'primary')
+
+    def test_reads_after_a_write_stick_to_the_primary(self):
+        app, db = create_app(self.primary, [self.replica], SQLALCHEMY_REPLICA_STICKY_SECONDS=60)
+        client = app.test_client()
+        self.origin(client, 'post')
+        self.assertEqual(self.origin(client), 'primary')
+        # Other clients keep reading from the replica
+        self.assertEqual(self.origin(app.test_client()), 'replica')
+
+    def test_sticky_reads_end_after_the_sticky_seconds(self):
+        app, db = create_app(self.primary, [self.replica], SQLALCHEMY_REPLICA_STICKY_SECONDS=60)
+        client = app.test_client()
+        self.origin(client, 'post')
+        with client.session_transaction() as session:
+            session[STICKY_SESSION_KEY] = time.time() - 1
+        self.assertEqual(self.origin(client), 'replica')
+
+    def test_unreachable_replica_falls_back_to_the_primary(self):
+        missing = os.path.join(self.directory, 'missing', 'replica.db')
+        app, db = create_app(self.primary, [missing], SQLALCHEMY_REPLICA_RETRY_SECONDS=60)
+        client = app.test_client()
+        self.assertEqual(self.origin(client), 'primary')
+        # Remembered as down, the next request doesn't probe it again
+        self.assertGreater(db._replica_down_until['replica_0'], time.time())
+        self.assertEqual(self.origin(client), 'primary')
+
+    def test_replica_marked_down_is_used_again_after_the_retry_seconds(self):
+        app, db = create_app(self.primary, [self.replica], SQLALCHEMY_REPLICA_RETRY_SECONDS=60)
+        client = app.test_client()
+        db.mark_replica_down('replica_0')
+        self.assertEqual(self.origin(client), 'primary')
+        db._replica_down_until['replica_0'] = time.time() - 1
+        self.assertEqual(self.origin(client), 'replica')
+
+    def test_disconnect_marks_the_replica_down(self):
+        app, db = create_app(self.primary, [self.replica], SQLALCHEMY_REPLICA_RETRY_SECONDS=60)
+        client = app.test_client()
+        self.assertEqual(self.origin(client), 'replica')
+        os.remove(self.replica)
+        os.mkdir(self.replica)
+        # The pooled connection still works, a new one fails like a lost server
+        with app.app_context():
+            db.get_engine(app, bind='replica_0').dispose()
+        # The read running into the lost replica fails, the following ones go to the primary
+        self.assertEqual(client.get('/origin').status_code, 500)
+        self.assertEqual(self.origin(client), 'primary')
+
+
+if __name__ == '__main__':
+    unittest.main()